@@ -0,0 +1,84 @@
+"""
+Throughput of a single client process, for a number of requests that wait for their response at the same time.
+
+'Client' sends one request at a time on its REQ socket. 'AsyncClient' sends CONCURRENCY requests at the same time on
+one DEALER socket. The service waits IO_WAIT_SEC and is served by an AsyncWorker, so the broker and worker are not the
+bottleneck. Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/async_client.py
+"""
+import asyncio
+import multiprocessing
+import time
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, CLIENT, ENDPOINT, run_broker
+
+IO_WAIT_SEC = 0.01
+CONCURRENCY = [1, 10, 100, 1000]
+DURATION_SEC = 5
+
+
+def run_worker():
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import AsyncWorker
+
+    @ctx_request.route(endpoint=ENDPOINT, methods=['GET'])
+    async def handler(request):
+        await asyncio.sleep(IO_WAIT_SEC)
+        return 'OK'
+
+    AsyncWorker(connect_control=WORKER_CONTROL, tasks=max(CONCURRENCY)).run()
+
+
+def measure_client():
+    from nimbus.client import Client
+    client = Client(connect=CLIENT)
+    client.get(ENDPOINT)  # warm up: wait until the worker answers
+    responses = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION_SEC:
+        client.get(ENDPOINT)
+        responses += 1
+    client.close()
+    return responses / (time.perf_counter() - start)
+
+
+async def measure_async_client(concurrency):
+    from nimbus.client import AsyncClient
+    client = AsyncClient(connect=CLIENT)
+    await client.get(ENDPOINT)
+    responses = 0
+    start = time.perf_counter()
+
+    async def send():
+        nonlocal responses
+        while time.perf_counter() - start < DURATION_SEC:
+            await client.get(ENDPOINT)
+            responses += 1
+
+    await asyncio.gather(*[send() for _ in range(concurrency)])
+    client.close()
+    return responses / (time.perf_counter() - start)
+
+
+def main():
+    from redis import StrictRedis
+    StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+    processes = [multiprocessing.Process(target=run_broker, args=(100,)),
+                 multiprocessing.Process(target=run_worker)]
+    for process in processes:
+        process.start()
+    try:
+        print('{:>12} {:>12} {:>12}'.format('client', 'concurrency', 'requests/s'))
+        print('{:>12} {:>12} {:>12.0f}'.format('Client', 1, measure_client()))
+        for concurrency in CONCURRENCY:
+            print('{:>12} {:>12} {:>12.0f}'.format('AsyncClient', concurrency,
+                                                   asyncio.run(measure_async_client(concurrency))))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
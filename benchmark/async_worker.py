@@ -0,0 +1,62 @@
+"""
+Throughput of a single worker with a service that waits IO_WAIT_SEC for another service or a database.
+
+'inline' and 'thread' are a Worker with a blocking service, 'async' is an AsyncWorker with an async def service. A
+broker, one worker and the load generator of broker_batch.py run in separate processes. Run from a directory with a
+nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/async_worker.py
+"""
+import asyncio
+import multiprocessing
+import time
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, WORKER_RESPONSE, ENDPOINT, \
+    generate_load, run_broker
+
+IO_WAIT_SEC = 0.01
+THREADS = 8
+TASKS = 256
+
+MODES = ['inline', 'thread', 'async']
+
+
+def run_worker(mode):
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker, AsyncWorker
+
+    if mode == 'async':
+        @ctx_request.route(endpoint=ENDPOINT, methods=['GET'])
+        async def handler(request):
+            await asyncio.sleep(IO_WAIT_SEC)
+            return 'OK'
+
+        AsyncWorker(connect_control=WORKER_CONTROL, tasks=TASKS).run()
+    else:
+        @ctx_request.route(endpoint=ENDPOINT, methods=['GET'], execution=mode)
+        def handler(request):
+            time.sleep(IO_WAIT_SEC)
+            return 'OK'
+
+        Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE, threads=THREADS).run()
+
+
+def main():
+    from redis import StrictRedis
+    print('{:>8} {:>12}'.format('mode', 'requests/s'))
+    for mode in MODES:
+        StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+        processes = [multiprocessing.Process(target=run_broker, args=(100,)),
+                     multiprocessing.Process(target=run_worker, args=(mode,))]
+        for process in processes:
+            process.start()
+        try:
+            print('{:>8} {:>12.0f}'.format(mode, generate_load()))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Throughput of a broker for several values of the batch size (messages received per socket per poll).
+
+A broker, a number of workers with a trivial handler and a load generator run in separate processes. The load
+generator keeps a fixed number of requests in flight over DEALER sockets, and counts the responses per second.
+
+Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/broker_batch.py
+"""
+import multiprocessing
+import time
+
+import msgpack
+import zmq
+
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+
+WORKER_CONTROL = 'tcp://127.0.0.1:15001'
+WORKER_RESPONSE = 'tcp://127.0.0.1:15002'
+CLIENT = 'tcp://127.0.0.1:15003'
+
+BATCH_SIZES = [1, 10, 100, 1000]
+WORKERS = 4
+CLIENTS = 8
+IN_FLIGHT_PER_CLIENT = 32
+DURATION_SEC = 5
+ENDPOINT = 'benchmark'
+
+
+def run_broker(batch_size):
+    from nimbus.broker import Broker
+    Broker(worker_response_bind=WORKER_RESPONSE,
+           worker_control_bind=WORKER_CONTROL,
+           client_bind=CLIENT,
+           redis_host=REDIS_HOST,
+           redis_port=REDIS_PORT,
+           redis_db=REDIS_DB,
+           batch_size=batch_size).run()
+
+
+def run_worker():
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker
+
+    @ctx_request.route(endpoint=ENDPOINT, methods=['GET'])
+    def handler(request):
+        return 'OK'
+
+    Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE).run()
+
+
+def generate_load():
+    context = zmq.Context.instance()
+    poller = zmq.Poller()
+    sockets = []
+    request = msgpack.packb({'method': 'GET', 'endpoint': ENDPOINT})
+    for _ in range(CLIENTS):
+        socket = context.socket(zmq.DEALER)
+        socket.connect(CLIENT)
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+
+    # warm up: wait until the workers answer
+    sockets[0].send_multipart([b'', request])
+    sockets[0].recv_multipart()
+
+    for socket in sockets:
+        for _ in range(IN_FLIGHT_PER_CLIENT):
+            socket.send_multipart([b'', request])
+
+    responses = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION_SEC:
+        for socket, _ in poller.poll(1000):
+            while True:
+                try:
+                    socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                responses += 1
+                socket.send_multipart([b'', request])
+    duration = time.perf_counter() - start
+
+    for socket in sockets:
+        socket.close(linger=0)
+    return responses / duration
+
+
+def main():
+    from redis import StrictRedis
+    print('{:>10} {:>12}'.format('batch size', 'requests/s'))
+    for batch_size in BATCH_SIZES:
+        StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+        processes = [multiprocessing.Process(target=run_broker, args=(batch_size,))]
+        processes += [multiprocessing.Process(target=run_worker) for _ in range(WORKERS)]
+        for process in processes:
+            process.start()
+        try:
+            print('{:>10} {:>12.0f}'.format(batch_size, generate_load()))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
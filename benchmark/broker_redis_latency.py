@@ -0,0 +1,93 @@
+"""
+Throughput of the broker request path (append, dispatch, retrieve, remove) as a function of the redis latency.
+
+The latency is added artificially to every round trip to redis. The 'before' numbers replay the redis commands that
+were issued per request before the writes were pipelined: 3 SET on append, SET and GET on dispatch, 2 GET on
+retrieve and 3 DEL on removal.
+
+Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/broker_redis_latency.py
+"""
+import time
+import uuid
+
+import msgpack
+from redis import StrictRedis
+from redis.connection import Connection
+
+from nimbus.broker import ClientRequest, RequestManager
+
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+
+LATENCIES_MS = [0, 0.1, 0.5, 1, 2]
+REQUESTS = 500
+ENDPOINT = 'endpoint'
+WORKER = b'worker'
+SOURCE = [b'client']
+CONTENT = msgpack.packb({'method': 'GET', 'endpoint': ENDPOINT, 'data': b'\x00' * 100})
+
+latency = 0.0
+send_packed_command = Connection.send_packed_command
+
+
+def send_packed_command_with_latency(self, *args, **kwargs):
+    # every call to send_packed_command is exactly one round trip, also for pipelines
+    if latency:
+        time.sleep(latency)
+    return send_packed_command(self, *args, **kwargs)
+
+
+Connection.send_packed_command = send_packed_command_with_latency
+
+
+def run_before(redis):
+    for _ in range(REQUESTS):
+        client_request = ClientRequest(SOURCE, CONTENT)
+        prefix = 'broker:' + uuid.uuid4().hex + ':request:'
+        redis.set(prefix + 'content:' + client_request.id, client_request.cached_data)
+        redis.set(prefix + 'status:' + client_request.id, 'waiting')
+        redis.set(prefix + 'timestamp:' + client_request.id, time.time())
+        redis.set(prefix + 'status:' + client_request.id, 'processing')
+        redis.get(prefix + 'content:' + client_request.id)
+        redis.get(prefix + 'content:' + client_request.id)
+        redis.get(prefix + 'content:' + client_request.id)
+        for key in ['content:', 'status:', 'timestamp:']:
+            redis.delete(prefix + key + client_request.id)
+
+
+def run_after(redis):
+    request_manager = RequestManager(REDIS_HOST, REDIS_PORT, REDIS_DB)
+    request_manager.register(WORKER, [ENDPOINT])
+    for _ in range(REQUESTS):
+        # one iteration of the broker loop for every request
+        request_manager.append(ClientRequest(SOURCE, CONTENT))
+        for worker_id, client_request in request_manager():
+            request = request_manager[client_request.id]
+            del request_manager[request.id]
+            request_manager.worker_available(worker_id)
+        request_manager.flush()
+
+
+def measure(func, redis):
+    redis.flushdb()
+    start = time.perf_counter()
+    func(redis)
+    return REQUESTS / (time.perf_counter() - start)
+
+
+def main():
+    global latency
+    redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    print('{:>12} {:>14} {:>14} {:>8}'.format('latency (ms)', 'before (req/s)', 'after (req/s)', 'speedup'))
+    for latency_ms in LATENCIES_MS:
+        latency = latency_ms / 1000.0
+        before = measure(run_before, redis)
+        after = measure(run_after, redis)
+        print('{:>12} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(latency_ms, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
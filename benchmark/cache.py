@@ -0,0 +1,94 @@
+"""
+Throughput of a broker with and without the response cache.
+
+The workers take a millisecond per request, like a query on a database. The load generator sends GET requests with
+one of PARAMETERS different parameters, so most of them can be answered from the cache once it is warm. Run from a
+directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/cache.py
+"""
+import itertools
+import multiprocessing
+import time
+
+import msgpack
+import zmq
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, WORKER_RESPONSE, CLIENT, CLIENTS, \
+    IN_FLIGHT_PER_CLIENT, DURATION_SEC, ENDPOINT, run_broker
+
+CACHE_TTLS = [None, 1, 60]
+WORKERS = 4
+PARAMETERS = 100
+HANDLER_SEC = 0.001
+
+
+def run_worker(cache_ttl):
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker
+
+    @ctx_request.route(endpoint=ENDPOINT, methods=['GET'], cache_ttl=cache_ttl)
+    def handler(request):
+        time.sleep(HANDLER_SEC)
+        return request.parameters
+
+    Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE).run()
+
+
+def generate_load():
+    context = zmq.Context.instance()
+    poller = zmq.Poller()
+    sockets = []
+    requests = itertools.cycle([msgpack.packb({'method': 'GET', 'endpoint': ENDPOINT, 'parameters': {'id': i}})
+                                for i in range(PARAMETERS)])
+    for _ in range(CLIENTS):
+        socket = context.socket(zmq.DEALER)
+        socket.connect(CLIENT)
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+
+    # warm up: wait until the workers answer
+    sockets[0].send_multipart([b'', next(requests)])
+    sockets[0].recv_multipart()
+
+    for socket in sockets:
+        for _ in range(IN_FLIGHT_PER_CLIENT):
+            socket.send_multipart([b'', next(requests)])
+
+    responses = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION_SEC:
+        for socket, _ in poller.poll(1000):
+            while True:
+                try:
+                    socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                responses += 1
+                socket.send_multipart([b'', next(requests)])
+    duration = time.perf_counter() - start
+
+    for socket in sockets:
+        socket.close(linger=0)
+    return responses / duration
+
+
+def main():
+    from redis import StrictRedis
+    print('{:>10} {:>12}'.format('cache ttl', 'requests/s'))
+    for cache_ttl in CACHE_TTLS:
+        StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+        processes = [multiprocessing.Process(target=run_broker, args=(100,))]
+        processes += [multiprocessing.Process(target=run_worker, args=(cache_ttl,)) for _ in range(WORKERS)]
+        for process in processes:
+            process.start()
+        try:
+            print('{:>10} {:>12.0f}'.format(str(cache_ttl), generate_load()))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Wall time of a batch job that sends REQUESTS requests with the synchronous Client.
+
+'get' calls Client.get in a loop, 'send_many' sends the requests with Client.send_many for several windows. The
+service waits IO_WAIT_SEC and is served by an AsyncWorker. Run from a directory with a nimbus configuration file,
+with redis available on REDIS_HOST:
+
+    python benchmark/client_pipeline.py
+"""
+import multiprocessing
+import time
+
+from async_client import run_worker
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, CLIENT, ENDPOINT, run_broker
+
+REQUESTS = 1000
+WINDOWS = [1, 10, 100, 1000]
+
+
+def main():
+    from redis import StrictRedis
+    from nimbus.client import Client
+    StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+    processes = [multiprocessing.Process(target=run_broker, args=(100,)),
+                 multiprocessing.Process(target=run_worker)]
+    for process in processes:
+        process.start()
+    try:
+        client = Client(connect=CLIENT)
+        client.get(ENDPOINT)  # warm up: wait until the worker answers
+
+        print('{:>10} {:>8} {:>10}'.format('call', 'window', 'seconds'))
+        start = time.perf_counter()
+        for _ in range(REQUESTS):
+            client.get(ENDPOINT)
+        print('{:>10} {:>8} {:>10.2f}'.format('get', '', time.perf_counter() - start))
+
+        for window in WINDOWS:
+            start = time.perf_counter()
+            responses = client.send_many([('GET', ENDPOINT)] * REQUESTS, window=window)
+            assert len(responses) == REQUESTS
+            print('{:>10} {:>8} {:>10.2f}'.format('send_many', window, time.perf_counter() - start))
+        client.close()
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Cost of getting a Client in a thread.
+
+The first table is the latency of a checkout and checkin of a ClientPool with an idle Client. The second table is
+the throughput of THREADS threads that send requests to a trivial service: 'new' creates a Client for every request,
+'pool' checks out a Client of a ClientPool. Run from a directory with a nimbus configuration file, with redis
+available on REDIS_HOST:
+
+    python benchmark/client_pool.py
+"""
+import multiprocessing
+import threading
+import time
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, CLIENT, ENDPOINT, run_broker, run_worker
+
+CHECKOUTS = 1000000
+THREADS = 8
+DURATION_SEC = 5
+
+
+def measure_checkout():
+    from nimbus.client import ClientPool
+    pool = ClientPool(connect=CLIENT)
+    pool.checkin(pool.checkout())
+    start = time.perf_counter()
+    for _ in range(CHECKOUTS):
+        pool.checkin(pool.checkout())
+    duration = time.perf_counter() - start
+    pool.close()
+    return duration / CHECKOUTS
+
+
+def measure_threads(pooled):
+    from nimbus.client import Client, ClientPool
+    pool = ClientPool(connect=CLIENT, size=THREADS)
+    responses = [0] * THREADS
+    start = time.perf_counter()
+
+    def send(i):
+        while time.perf_counter() - start < DURATION_SEC:
+            if pooled:
+                with pool.client() as client:
+                    client.get(ENDPOINT)
+            else:
+                client = Client(connect=CLIENT)
+                client.get(ENDPOINT)
+                client.close()
+            responses[i] += 1
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close()
+    return sum(responses) / (time.perf_counter() - start)
+
+
+def main():
+    from redis import StrictRedis
+    print('{:>20} {:>8.3f}'.format('checkout+checkin us', measure_checkout() * 1e6))
+
+    StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+    processes = [multiprocessing.Process(target=run_broker, args=(100,))]
+    processes += [multiprocessing.Process(target=run_worker) for _ in range(2)]
+    for process in processes:
+        process.start()
+    try:
+        from nimbus.client import Client
+        Client(connect=CLIENT).get(ENDPOINT)  # warm up: wait until the workers answer
+        print('{:>8} {:>12}'.format('client', 'requests/s'))
+        for pooled in [False, True]:
+            print('{:>8} {:>12.0f}'.format('pool' if pooled else 'new', measure_threads(pooled)))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
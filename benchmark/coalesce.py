@@ -0,0 +1,89 @@
+"""
+Worker load of a thundering herd, with and without coalescing of identical requests.
+
+In every round, HERD clients ask for the same cold resource at once. The workers take HANDLER_SEC per request, like a
+slow query on a database. The number of calls of the handler and the time until all clients have their response are
+measured. Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/coalesce.py
+"""
+import multiprocessing
+import time
+
+import msgpack
+import zmq
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, WORKER_RESPONSE, CLIENT, ENDPOINT, \
+    run_broker
+
+WORKERS = 4
+HERD = 100
+ROUNDS = 10
+HANDLER_SEC = 0.05
+
+
+def run_worker(coalesce, calls):
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker
+
+    @ctx_request.route(endpoint=ENDPOINT, methods=['GET'], coalesce=coalesce)
+    def handler(request):
+        with calls.get_lock():
+            calls.value += 1
+        time.sleep(HANDLER_SEC)
+        return request.parameters
+
+    Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE).run()
+
+
+def generate_load():
+    context = zmq.Context.instance()
+    sockets = []
+    for _ in range(HERD):
+        socket = context.socket(zmq.DEALER)
+        socket.connect(CLIENT)
+        sockets.append(socket)
+
+    # warm up: wait until the workers answer
+    warm_up = {'method': 'GET', 'endpoint': ENDPOINT, 'deadline': time.time() + 60}
+    sockets[0].send_multipart([b'', msgpack.packb(warm_up)])
+    sockets[0].recv_multipart()
+
+    start = time.perf_counter()
+    for round_ in range(ROUNDS):
+        request = msgpack.packb({'method': 'GET',
+                                 'endpoint': ENDPOINT,
+                                 'parameters': {'round': round_},
+                                 'deadline': time.time() + 60})
+        for socket in sockets:
+            socket.send_multipart([b'', request])
+        for socket in sockets:
+            socket.recv_multipart()
+    duration = time.perf_counter() - start
+
+    for socket in sockets:
+        socket.close(linger=0)
+    return duration
+
+
+def main():
+    from redis import StrictRedis
+    print('{:>10} {:>10} {:>10}'.format('coalesce', 'calls', 'seconds'))
+    for coalesce in [False, True]:
+        StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+        calls = multiprocessing.Value('i', 0)
+        processes = [multiprocessing.Process(target=run_broker, args=(100,))]
+        processes += [multiprocessing.Process(target=run_worker, args=(coalesce, calls)) for _ in range(WORKERS)]
+        for process in processes:
+            process.start()
+        try:
+            duration = generate_load()
+            print('{:>10} {:>10} {:>10.2f}'.format(str(coalesce), calls.value - 1, duration))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Throughput of a broker for several values of the worker credit (requests a worker holds at the same time).
+
+Uses the same setup as broker_batch.py, with the default batch size. Run from a directory with a nimbus configuration
+file, with redis available on REDIS_HOST:
+
+    python benchmark/credit.py
+"""
+import multiprocessing
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, WORKER_RESPONSE, ENDPOINT, \
+    generate_load, run_broker
+
+CREDITS = [1, 2, 4, 16]
+WORKERS = 2
+BATCH_SIZE = 100
+
+
+def run_worker(credit):
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker
+
+    @ctx_request.route(endpoint=ENDPOINT, methods=['GET'])
+    def handler(request):
+        return 'OK'
+
+    Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE, credit=credit).run()
+
+
+def main():
+    from redis import StrictRedis
+    print('{:>10} {:>12}'.format('credit', 'requests/s'))
+    for credit in CREDITS:
+        StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+        processes = [multiprocessing.Process(target=run_broker, args=(BATCH_SIZE,))]
+        processes += [multiprocessing.Process(target=run_worker, args=(credit,)) for _ in range(WORKERS)]
+        for process in processes:
+            process.start()
+        try:
+            print('{:>10} {:>12.0f}'.format(credit, generate_load()))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Cost of the heartbeat bookkeeping of an idle broker loop iteration, for several numbers of connected workers.
+
+'scan' is the previous implementation, which compared the last contact of every connection with get_utc_int() on
+every call. 'heap' is ConnectionStateManager. Every worker is in contact once per second, spread over the second, and
+an iteration calls get_connections_to_ping and get_connections_to_disconnect, like the broker loop.
+
+Run from a directory with a nimbus configuration file:
+
+    python benchmark/heartbeat.py
+"""
+import time
+
+from nimbus.helpers import get_utc_int
+from nimbus.statemanager import ConnectionStateManager
+
+CONNECTIONS = [100, 1000, 10000]
+ITERATIONS = 200
+SECONDS_BEFORE_CONTACT_CHECK = 5
+SECONDS_BEFORE_DISCONNECT = 10
+
+
+class ScanConnectionStateManager:
+    def __init__(self, seconds_before_contact_check, seconds_before_disconnect):
+        self._last_contact = dict()
+        self._checking_connection = dict()
+        self._seconds_before_contact_check = seconds_before_contact_check
+        self._seconds_before_disconnect = seconds_before_disconnect
+
+    def contact_from(self, connection_id):
+        try:
+            del self._checking_connection[connection_id]
+        except KeyError:
+            pass
+        self._last_contact[connection_id] = get_utc_int()
+
+    def get_connections_to_ping(self):
+        connection_ids = [connection_id
+                          for connection_id, last_contact in self._last_contact.items()
+                          if get_utc_int() - last_contact > self._seconds_before_contact_check]
+        for connection_id in connection_ids:
+            del self._last_contact[connection_id]
+            self._checking_connection[connection_id] = get_utc_int()
+        return connection_ids
+
+    def get_connections_to_disconnect(self):
+        connection_ids = [connection_id
+                          for connection_id, check_time in self._checking_connection.items()
+                          if get_utc_int() - check_time > self._seconds_before_disconnect]
+        for connection_id in connection_ids:
+            del self._checking_connection[connection_id]
+        return connection_ids
+
+
+def run(state_manager, connections):
+    for connection_id in range(connections):
+        state_manager.contact_from(connection_id)
+    contacts_per_iteration = max(connections // ITERATIONS, 1)
+    duration = 0.0
+    for i in range(ITERATIONS):
+        for connection_id in range(i * contacts_per_iteration, (i + 1) * contacts_per_iteration):
+            state_manager.contact_from(connection_id % connections)
+        start = time.perf_counter()
+        state_manager.get_connections_to_ping()
+        state_manager.get_connections_to_disconnect()
+        duration += time.perf_counter() - start
+    return duration / ITERATIONS
+
+
+def main():
+    print('{:>12} {:>14} {:>14}'.format('connections', 'scan us/iter', 'heap us/iter'))
+    for connections in CONNECTIONS:
+        scan = run(ScanConnectionStateManager(SECONDS_BEFORE_CONTACT_CHECK, SECONDS_BEFORE_DISCONNECT), connections)
+        heap = run(ConnectionStateManager(SECONDS_BEFORE_CONTACT_CHECK, SECONDS_BEFORE_DISCONNECT), connections)
+        print('{:>12} {:>14.1f} {:>14.1f}'.format(connections, scan * 1e6, heap * 1e6))
+
+
+if __name__ == '__main__':
+    main()
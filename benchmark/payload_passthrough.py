@@ -0,0 +1,75 @@
+"""
+Broker-side cost of handling a request and its response, for a single-frame message that the broker decodes and
+encodes again, and for a header frame plus an opaque body frame that the broker forwards untouched.
+
+Both paths include what the broker does per request: parse the client message, serialize it for redis, build the
+frames for the worker, and turn the worker response into the client response. Redis and the network are left out.
+
+Run from a directory with a nimbus configuration file:
+
+    python benchmark/payload_passthrough.py
+"""
+import time
+
+import msgpack
+import zmq
+
+from nimbus.broker import ClientRequest
+
+SIZES = [('1 KB', 1024), ('100 KB', 100 * 1024), ('10 MB', 10 * 1024 * 1024)]
+SOURCE = [b'client']
+HEADER = {'method': 'POST', 'endpoint': 'endpoint', 'parameters': {'a': 1}}
+MIN_DURATION_SEC = 1.0
+
+
+def single_frame(data):
+    message = dict(HEADER, data=data)
+    content = msgpack.packb(message)
+    response = msgpack.packb({'id': 'x' * 32, 'status': 200, 'response': data})
+
+    def handle():
+        client_request = ClientRequest(SOURCE, content)
+        client_request.cached_data
+        client_request.frames
+        worker_response = msgpack.unpackb(response)
+        del worker_response[b'id']
+        msgpack.packb(worker_response)
+
+    return handle
+
+
+def header_and_body(data):
+    header = msgpack.packb(HEADER)
+    body = zmq.Frame(msgpack.packb(data))
+    response = [zmq.Frame(b'x' * 32), zmq.Frame(msgpack.packb({'status': 200, 'response': data}))]
+
+    def handle():
+        client_request = ClientRequest(SOURCE, header, body)
+        client_request.cached_data
+        client_request.frames
+        response[0].bytes.decode()
+
+    return handle
+
+
+def measure(handle):
+    handle()
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < MIN_DURATION_SEC:
+        handle()
+        count += 1
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    print('{:>8} {:>18} {:>18} {:>8}'.format('body', 'single frame (us)', 'header+body (us)', 'speedup'))
+    for name, size in SIZES:
+        data = {'payload': b'\x00' * size}
+        before = measure(single_frame(data)) * 1e6
+        after = measure(header_and_body(data)) * 1e6
+        print('{:>8} {:>18.1f} {:>18.1f} {:>7.1f}x'.format(name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Time to recover the queues of a broker from redis with QueueManager.load_storage.
+
+The redis database is filled with the index of REQUESTS ClientRequests spread over ENDPOINTS endpoints, of which
+some are being processed. Recovery only reads these indexes; the content of a ClientRequest is read when it is
+dispatched, so it is not written here.
+
+Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST. The database is flushed:
+
+    python benchmark/recovery.py
+"""
+import time
+import uuid
+
+from redis import StrictRedis
+
+from nimbus.broker import QueueManager, RequestQueue
+
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+
+REQUESTS = 1000000
+ENDPOINTS = 100
+PROCESSING_PER_ENDPOINT = 10
+CHUNK = 10000
+
+
+def fill(redis):
+    redis.flushdb()
+    pipeline = redis.pipeline(transaction=False)
+    timestamp = time.time()
+    for e in range(ENDPOINTS):
+        queue = RequestQueue(REDIS_HOST, REDIS_PORT, REDIS_DB, endpoint='endpoint{}'.format(e))
+        ids = [uuid.uuid4().hex for _ in range(REQUESTS // ENDPOINTS)]
+        for i in range(0, len(ids), CHUNK):
+            args = []
+            for id_ in ids[i:i + CHUNK]:
+                timestamp += 0.000001
+                args += [timestamp, id_]
+            pipeline.execute_command('ZADD', queue.generate_key_index(), *args)
+        pipeline.sadd(queue.generate_key_processing(), *ids[:PROCESSING_PER_ENDPOINT])
+        pipeline.execute()
+
+
+def main():
+    redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    fill(redis)
+    queue_manager = QueueManager(REDIS_HOST, REDIS_PORT, REDIS_DB)
+    start = time.perf_counter()
+    recovered = queue_manager.load_storage()
+    duration = time.perf_counter() - start
+    print('Recovered {} requests for {} endpoints in {:.3f} seconds'.format(recovered, ENDPOINTS, duration))
+
+
+if __name__ == '__main__':
+    main()
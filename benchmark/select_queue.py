@@ -0,0 +1,83 @@
+"""
+Cost of selecting the RequestQueue with the oldest ClientRequest for a worker, with 1k endpoints and 1k workers.
+
+'sorted' is the previous implementation, which sorted all non-empty queues of the worker on every call. 'heap' is
+QueueManager.select_queue. Every selected request is removed from its queue, so the queue heads keep changing.
+Removals are only buffered for redis and never sent, so this benchmark does not need a running redis.
+
+Run from a directory with a nimbus configuration file:
+
+    python benchmark/select_queue.py
+"""
+import random
+import time
+
+import msgpack
+
+from nimbus.broker import ClientRequest, QueueManager, EmptyQueue
+
+ENDPOINTS = ['endpoint{}'.format(i) for i in range(1000)]
+WORKERS = 1000
+REQUESTS = 10000
+SOURCE = [b'client']
+
+
+def select_queue_sorted(queue_manager, endpoints):
+    available_client_requests = []
+    for endpoint in endpoints:
+        queue = queue_manager.get_queue(endpoint)
+        if len(queue) > 0:
+            available_client_requests.append(queue)
+    if len(available_client_requests) == 0:
+        raise EmptyQueue
+    return sorted(available_client_requests, key=lambda q: q.peek().timestamp)[0]
+
+
+def select_queue_heap(queue_manager, endpoints):
+    return queue_manager.select_queue(endpoints)
+
+
+def run(select, endpoints_by_worker, client_requests):
+    queue_manager = QueueManager('localhost', 6379, 0)
+    for client_request in client_requests:
+        queue_manager.append(client_request)
+
+    selected = 0
+    duration = 0.0
+    previously_selected = None
+    while selected != previously_selected:
+        # stop when no worker found anything, requests for endpoints without workers remain queued
+        previously_selected = selected
+        for endpoints in endpoints_by_worker:
+            start = time.perf_counter()
+            try:
+                queue = select(queue_manager, endpoints)
+            except EmptyQueue:
+                continue
+            finally:
+                duration += time.perf_counter() - start
+            queue_manager.remove(queue.peek().id)
+            selected += 1
+    return duration / selected
+
+
+def main():
+    random.seed(0)
+    client_requests = [ClientRequest(SOURCE, msgpack.packb({'method': 'GET', 'endpoint': random.choice(ENDPOINTS)}))
+                       for _ in range(REQUESTS)]
+
+    groups = [frozenset(random.sample(ENDPOINTS, 100)) for _ in range(50)]
+    scenarios = [
+        ('every worker serves all endpoints', [frozenset(ENDPOINTS)] * WORKERS),
+        ('50 worker groups of 100 endpoints', [groups[i % len(groups)] for i in range(WORKERS)]),
+    ]
+
+    print('{:<36} {:>14} {:>14}'.format('scenario', 'sorted (us)', 'heap (us)'))
+    for name, endpoints_by_worker in scenarios:
+        sorted_us = run(select_queue_sorted, endpoints_by_worker, client_requests) * 1e6
+        heap_us = run(select_queue_heap, endpoints_by_worker, client_requests) * 1e6
+        print('{:<36} {:>14.1f} {:>14.1f}'.format(name, sorted_us, heap_us))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Throughput of a ShardedBroker for several numbers of shards.
+
+Like broker_batch.py, but the load is spread over several endpoints, so that every shard gets its share. Every worker
+serves all endpoints. Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/sharded.py
+"""
+import itertools
+import multiprocessing
+import time
+
+import msgpack
+import zmq
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, WORKER_RESPONSE, CLIENT, CLIENTS, \
+    IN_FLIGHT_PER_CLIENT, DURATION_SEC
+
+SHARDS = [1, 2, 4]
+WORKERS = 4
+ENDPOINTS = ['benchmark{}'.format(i) for i in range(16)]
+
+
+def run_broker(shards):
+    from nimbus.broker import Broker, ShardedBroker
+    kwargs = dict(worker_response_bind=WORKER_RESPONSE,
+                  worker_control_bind=WORKER_CONTROL,
+                  client_bind=CLIENT,
+                  redis_host=REDIS_HOST,
+                  redis_port=REDIS_PORT,
+                  redis_db=REDIS_DB)
+    if shards > 1:
+        ShardedBroker(shards=shards, **kwargs).run()
+    else:
+        Broker(**kwargs).run()
+
+
+def run_worker():
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker
+
+    for endpoint in ENDPOINTS:
+        def handler(request):
+            return 'OK'
+
+        handler.__name__ = endpoint
+        ctx_request.route(endpoint=endpoint, methods=['GET'])(handler)
+
+    Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE, credit=4).run()
+
+
+def generate_load():
+    context = zmq.Context.instance()
+    poller = zmq.Poller()
+    sockets = []
+    requests = itertools.cycle([msgpack.packb({'method': 'GET', 'endpoint': endpoint}) for endpoint in ENDPOINTS])
+    for _ in range(CLIENTS):
+        socket = context.socket(zmq.DEALER)
+        socket.connect(CLIENT)
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+
+    # warm up: wait until the workers answer on all endpoints
+    for _ in ENDPOINTS:
+        sockets[0].send_multipart([b'', next(requests)])
+        sockets[0].recv_multipart()
+
+    for socket in sockets:
+        for _ in range(IN_FLIGHT_PER_CLIENT):
+            socket.send_multipart([b'', next(requests)])
+
+    responses = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION_SEC:
+        for socket, _ in poller.poll(1000):
+            while True:
+                try:
+                    socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                responses += 1
+                socket.send_multipart([b'', next(requests)])
+    duration = time.perf_counter() - start
+
+    for socket in sockets:
+        socket.close(linger=0)
+    return responses / duration
+
+
+def main():
+    from redis import StrictRedis
+    print('cores: {}'.format(multiprocessing.cpu_count()))
+    print('{:>10} {:>12}'.format('shards', 'requests/s'))
+    for shards in SHARDS:
+        StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+        processes = [multiprocessing.Process(target=run_broker, args=(shards,))]
+        processes += [multiprocessing.Process(target=run_worker) for _ in range(WORKERS)]
+        for process in processes:
+            process.start()
+        try:
+            print('{:>10} {:>12.0f}'.format(shards, generate_load()))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Throughput of the broker request path (append, dispatch, retrieve, remove) for every storage of the RequestQueues.
+
+Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/storage.py
+"""
+import tempfile
+import time
+
+import msgpack
+from redis import StrictRedis
+
+from nimbus.broker import ClientRequest, RequestManager, MemoryStorage, RedisStorage, LogStorage
+
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+
+REQUESTS = 20000
+REQUESTS_PER_ITERATION = [1, 100]
+ENDPOINT = 'endpoint'
+WORKER = b'worker'
+SOURCE = [b'client']
+CONTENT = msgpack.packb({'method': 'GET', 'endpoint': ENDPOINT, 'data': b'\x00' * 100})
+
+
+def run(storage, requests_per_iteration):
+    request_manager = RequestManager(REDIS_HOST, REDIS_PORT, REDIS_DB, storage=storage)
+    request_manager.register(WORKER, [ENDPOINT])
+    for _ in range(REQUESTS // requests_per_iteration):
+        # one iteration of the broker loop for every batch of requests
+        for _ in range(requests_per_iteration):
+            request_manager.append(ClientRequest(SOURCE, CONTENT))
+            for worker_id, client_request in request_manager():
+                request = request_manager[client_request.id]
+                del request_manager[request.id]
+                request_manager.worker_available(worker_id)
+        request_manager.flush()
+
+
+def measure(storage, requests_per_iteration):
+    start = time.perf_counter()
+    run(storage, requests_per_iteration)
+    return REQUESTS / (time.perf_counter() - start)
+
+
+def main():
+    redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    print('{:>8} {:>20} {:>10}'.format('storage', 'requests / iteration', 'req/s'))
+    for requests_per_iteration in REQUESTS_PER_ITERATION:
+        with tempfile.TemporaryDirectory() as path:
+            redis.flushdb()
+            for name, storage in [('memory', MemoryStorage()),
+                                  ('redis', RedisStorage.connect(REDIS_HOST, REDIS_PORT, REDIS_DB)),
+                                  ('log', LogStorage(path))]:
+                print('{:>8} {:>20} {:>10.0f}'.format(name, requests_per_iteration,
+                                                      measure(storage, requests_per_iteration)))
+                storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Throughput of a single worker for each execution of its route.
+
+The handler of the I/O-bound route waits IO_WAIT_SEC, like a database call, the handler of the CPU-bound route
+computes for about as long. A broker, one worker and the load generator of broker_batch.py run in separate processes.
+Run from a directory with a nimbus configuration file, with redis available on REDIS_HOST:
+
+    python benchmark/worker_pool.py
+"""
+import multiprocessing
+import time
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, WORKER_RESPONSE, ENDPOINT, \
+    generate_load, run_broker
+
+IO_WAIT_SEC = 0.01
+THREADS = 8
+PROCESSES = 2
+
+
+def run_worker(execution, cpu_bound):
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker
+
+    @ctx_request.route(endpoint=ENDPOINT, methods=['GET'], execution=execution)
+    def handler(request):
+        if cpu_bound:
+            end = time.perf_counter() + IO_WAIT_SEC
+            while time.perf_counter() < end:
+                pass
+        else:
+            time.sleep(IO_WAIT_SEC)
+        return 'OK'
+
+    Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE,
+           threads=THREADS, processes=PROCESSES).run()
+
+
+def main():
+    from redis import StrictRedis
+    from nimbus.worker.context import EXECUTIONS
+    print('{:>6} {:>10} {:>12}'.format('route', 'execution', 'requests/s'))
+    for cpu_bound in [False, True]:
+        for execution in EXECUTIONS:
+            StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+            processes = [multiprocessing.Process(target=run_broker, args=(100,)),
+                         multiprocessing.Process(target=run_worker, args=(execution, cpu_bound))]
+            for process in processes:
+                process.start()
+            try:
+                print('{:>6} {:>10} {:>12.0f}'.format('cpu' if cpu_bound else 'io', execution, generate_load()))
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Latency and throughput of the two ways a worker returns a response.
+
+'legacy' sends the response on the REQ response socket, gives back its credit on the control socket and waits for the
+broker to acknowledge the response. 'control' sends the response on the control socket, which also gives back the
+credit, and does not wait. Latency is measured with a single client that sends one request at a time, throughput with
+the load of broker_batch.py. Run from a directory with a nimbus configuration file, with redis available on
+REDIS_HOST:
+
+    python benchmark/worker_protocol.py
+"""
+import multiprocessing
+import statistics
+import time
+
+import msgpack
+import zmq
+
+from broker_batch import REDIS_HOST, REDIS_PORT, REDIS_DB, WORKER_CONTROL, WORKER_RESPONSE, CLIENT, ENDPOINT, \
+    generate_load, run_broker
+
+WORKERS = 2
+LATENCY_REQUESTS = 2000
+
+
+def run_worker(legacy_response):
+    from nimbus.worker.context import ctx_request
+    from nimbus.worker.worker import Worker
+
+    @ctx_request.route(endpoint=ENDPOINT, methods=['GET'])
+    def handler(request):
+        return 'OK'
+
+    Worker(connect_control=WORKER_CONTROL, connect_response=WORKER_RESPONSE, legacy_response=legacy_response).run()
+
+
+def measure_latency():
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.connect(CLIENT)
+    request = msgpack.packb({'method': 'GET', 'endpoint': ENDPOINT})
+
+    # warm up: wait until the workers answer
+    socket.send_multipart([b'', request])
+    socket.recv_multipart()
+
+    latencies = []
+    for _ in range(LATENCY_REQUESTS):
+        start = time.perf_counter()
+        socket.send_multipart([b'', request])
+        socket.recv_multipart()
+        latencies.append(time.perf_counter() - start)
+    socket.close(linger=0)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    from redis import StrictRedis
+    print('{:>10} {:>10} {:>10} {:>12}'.format('protocol', 'p50 ms', 'p99 ms', 'requests/s'))
+    for legacy_response in [True, False]:
+        StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB).flushdb()
+        processes = [multiprocessing.Process(target=run_broker, args=(100,))]
+        processes += [multiprocessing.Process(target=run_worker, args=(legacy_response,)) for _ in range(WORKERS)]
+        for process in processes:
+            process.start()
+        try:
+            p50, p99 = measure_latency()
+            print('{:>10} {:>10.3f} {:>10.3f} {:>12.0f}'.format('legacy' if legacy_response else 'control',
+                                                               p50 * 1000, p99 * 1000, generate_load()))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+
+if __name__ == '__main__':
+    main()
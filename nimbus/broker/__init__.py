@@ -1,14 +1,26 @@
-import copy
+import functools
+import heapq
+import itertools
+import multiprocessing
+import signal
+import sys
+import tempfile
 import time
 import uuid
-from collections import deque, abc, namedtuple
+from collections import Counter, OrderedDict, abc, deque, namedtuple
 
 import msgpack
 import zmq
-from redis import StrictRedis
 
 from nimbus import config
-from nimbus.helpers import decode, extract_source_from_message, extract_content_from_message
+from nimbus.broker.cache import ResponseCache, RequestCoalescer
+from nimbus.broker.metrics import BrokerMetrics, merge_shards
+from nimbus.broker.shard import request_id_prefix, shard_of, shard_of_request, shard_storage_path, \
+    shard_storage_paths
+from nimbus.broker.storage import RedisStorage, LogStorage, create_storage, STORAGE_REDIS, STORAGE_LOG
+from nimbus.broker.storage import MemoryStorage, RedisBatch  # noqa: F401, part of the interface of nimbus.broker
+from nimbus.cluster import Cluster
+from nimbus.helpers import decode, frame_to_bytes, split_message
 from nimbus.log import get_logger
 from nimbus.statemanager import ConnectionStateManager
 
@@ -16,6 +28,14 @@ logger = get_logger(__name__)
 
 SECONDS_BEFORE_CONTACT_CHECK = int(config.get('control', 'seconds_before_contact_check'))
 SECONDS_BEFORE_UNREGISTER = int(config.get('control', 'seconds_before_unregister'))
+BATCH_SIZE = int(config.get('control', 'batch_size', fallback=100))
+STORAGE = config.get('control', 'storage', fallback=STORAGE_REDIS)
+STORAGE_PATH = config.get('control', 'storage_path', fallback='nimbus-broker')
+SHARDS = int(config.get('control', 'shards', fallback=1))
+MAX_ATTEMPTS = int(config.get('control', 'max_attempts', fallback=3))
+CACHE_SIZE = int(config.get('control', 'cache_size', fallback=10000))
+CACHE_MEMORY = int(config.get('control', 'cache_memory', fallback=64 * 1024 * 1024))
+STATS_INTERVAL = float(config.get('control', 'stats_interval', fallback=10))
 
 
 class EmptyQueue(LookupError):
@@ -29,18 +49,21 @@ class WorkerIsAlreadyRegistered(AttributeError):
 class ClientRequest:
     """
     Representation of a client request.
+    A request consists of a small header (content) with method, endpoint and parameters, and an optional body with
+    the data. The broker never decodes the body, it is forwarded to the worker as it was received.
     """
 
-    def __init__(self, source, content):
-        self._id = uuid.uuid4().hex  # str
-        self._source = copy.deepcopy(source)  # list of bytes
+    def __init__(self, source, content, body=None, id_prefix=''):
+        self._id = id_prefix + uuid.uuid4().hex  # str
+        self._source = list(source)  # list of bytes
         self._content = msgpack.unpackb(content)  # dictionary of bytes
+        self._body = body  # msgpack of data, bytes or zmq.Frame
         self._method = decode(self._content[b'method'])  # str
         self._endpoint = decode(self._content[b'endpoint'])  # str
-        logger.debug('Creating or loading ClientRequest {}@{}: {}/{}'.format(self._id,
-                                                                             self._endpoint,
-                                                                             self._source,
-                                                                             self._content))
+        self._deadline = self._content.get(b'deadline')  # unix timestamp after which the client stopped waiting
+        self._received = time.time()
+        self._dispatched = None
+        logger.debug('Creating or loading ClientRequest %s: %s %s', self._id, self._method, self._endpoint)
 
     def __eq__(self, other):
         if isinstance(other, ClientRequest):
@@ -48,19 +71,21 @@ class ClientRequest:
                    and self.source == other.source \
                    and self.method == other.method \
                    and self.endpoint == other.endpoint \
-                   and self.content == other.content
+                   and self.content == other.content \
+                   and frame_to_bytes(self.body) == frame_to_bytes(other.body)
         else:
             return NotImplemented
 
     @classmethod
     def fromcache(cls, cached_data):
         """
-        :param cached_data: msgpack of source and contant, as outputed by cached_data 
+        :param cached_data: msgpack of source, content and body, as outputed by cached_data
         :return: ClientRequest
         """
         cached_data = msgpack.unpackb(cached_data)
         new_instance = cls(source=cached_data[b'source'],
-                           content=msgpack.packb(cached_data[b'content']))
+                           content=msgpack.packb(cached_data[b'content']),
+                           body=cached_data.get(b'body'))
         new_instance._id = cached_data[b'content'][b'id'].decode()
         return new_instance
 
@@ -92,6 +117,47 @@ class ClientRequest:
         """
         return self._endpoint
 
+    @property
+    def deadline(self):
+        """
+        :return: unix timestamp, or None if the ClientRequest has no deadline
+        """
+        return self._deadline
+
+    @property
+    def received(self):
+        """
+        :return: unix timestamp at which the broker received or loaded the ClientRequest
+        """
+        return self._received
+
+    @property
+    def dispatched(self):
+        """
+        :return: unix timestamp at which the ClientRequest was last sent to a Worker, None if it was not sent yet
+        """
+        return self._dispatched
+
+    @dispatched.setter
+    def dispatched(self, timestamp):
+        self._dispatched = timestamp
+
+    def expired(self, now):
+        """
+        :param now: unix timestamp
+        :return: True if the client is no longer waiting for the response
+        """
+        return self._deadline is not None and self._deadline <= now
+
+    def extend_deadline(self, deadline):
+        """
+        Keep the ClientRequest alive for longer, e.g. because another client waits for the same response.
+        :param deadline: unix timestamp
+        :return: None
+        """
+        self._deadline = deadline
+        self._content[b'deadline'] = deadline
+
     @property
     def content(self):
         """
@@ -101,6 +167,13 @@ class ClientRequest:
         content.update({b'id': self._id.encode()})
         return content
 
+    @property
+    def body(self):
+        """
+        :return: msgpack of data, as bytes or zmq.Frame, or None
+        """
+        return self._body
+
     @property
     def packed_data(self):
         """
@@ -108,15 +181,27 @@ class ClientRequest:
         """
         return msgpack.packb(self.content)
 
+    @property
+    def frames(self):
+        """
+        :return: list of frames to send to a worker, the body is sent as it was received
+        """
+        if self._body is None:
+            return [self.packed_data]
+        return [self.packed_data, self._body]
+
     @property
     def cached_data(self):
         """
-        :return: msgpack of source and content
+        :return: msgpack of source, content and body
         """
-        return msgpack.packb({
+        cached_data = {
             'source': self._source,
             'content': self.content
-        })
+        }
+        if self._body is not None:
+            cached_data['body'] = frame_to_bytes(self._body)
+        return msgpack.packb(cached_data)
 
 
 class ControlRequest:
@@ -142,30 +227,53 @@ class ControlRequest:
         return {'control': ControlRequest._CONTENT[self._type]}
 
 
+class QueueEntry:
+    """
+    Bookkeeping of a single ClientRequest in a RequestQueue.
+    """
+    __slots__ = ('timestamp', 'request', 'attempts')
+
+    def __init__(self, timestamp, request=None):
+        self.timestamp = timestamp
+        self.request = request  # None if the ClientRequest is only available in the storage, e.g. after a restart
+        self.attempts = 0  # number of times the ClientRequest was handed out to a Worker
+
+
 class RequestQueue(abc.MutableMapping):
     """
     Queue of ClientRequests for a specific endpoint.
-    Similar to an ordered dict, but with redis storage.
+    Similar to an ordered dict, but every ClientRequest is also written to a Storage.
+    Without a Storage, every operation is written to redis immediately, in one round trip.
+    The ClientRequests are stored by the id of the queue, so the queue can be recovered after a restart of the broker.
     """
 
-    STATUS_WAITING = 'waiting'
-    STATUS_PROCESSING = 'processing'
+    STATUS_WAITING = RedisStorage.STATUS_WAITING
+    STATUS_PROCESSING = RedisStorage.STATUS_PROCESSING
     ClientRequestPeek = namedtuple('ClientRequestPeek', 'id timestamp')
 
-    def __init__(self, redis_host, redis_port, redis_db):
-        self._id = uuid.uuid4().hex
-        self._deque = deque()  # to keep the order of the keys
-        self._timestamps = dict()  # to quickly determine if a key is still in the deque, and keep the timestamp
-        self._redis = StrictRedis(host=redis_host, port=redis_port, db=redis_db)
+    def __init__(self, redis_host, redis_port, redis_db, storage=None, on_new_head=None, endpoint=None):
+        self._id = endpoint if endpoint is not None else uuid.uuid4().hex
+        self._entries = OrderedDict()  # QueueEntry by id, in order; O(1) append, popleft, removal and peek
+        self._processing = dict()  # QueueEntry by id of the ClientRequests that were taken from the queue
+        if storage is None:
+            storage = RedisStorage.connect(redis_host, redis_port, redis_db, autoflush=True)
+        self._storage = storage
+        self._on_new_head = on_new_head  # called without arguments when another ClientRequest is first in line
 
     def generate_key_content(self, id_):
-        return 'broker:' + self._id + ':request:content:' + id_
+        return self._storage.generate_key_content(self._id, id_)
 
     def generate_key_status(self, id_):
-        return 'broker:' + self._id + ':request:status:' + id_
+        return self._storage.generate_key_status(self._id, id_)
 
     def generate_key_timestamp(self, id_):
-        return 'broker:' + self._id + ':request:timestamp:' + id_
+        return self._storage.generate_key_timestamp(self._id, id_)
+
+    def generate_key_index(self):
+        return self._storage.generate_key_index(self._id)
+
+    def generate_key_processing(self):
+        return self._storage.generate_key_processing(self._id)
 
     @property
     def id(self):
@@ -179,259 +287,729 @@ class RequestQueue(abc.MutableMapping):
         return obj is not None
 
     def __len__(self):
-        assert len(self._deque) == len(self._timestamps)
-        return len(self._timestamps)
+        return len(self._entries)
 
     def __setitem__(self, id_, value: ClientRequest):
         """
-        Append a ClientRequest to the queue and store it in redis.
-        :param id_: 
-        :param value: 
-        :return: 
+        Append a ClientRequest to the queue and store it.
+        :param id_:
+        :param value:
+        :return:
         """
-        logger.info('Adding ClientRequest to Queue: {} / {}'.format(value.endpoint, id_))
-        self._deque.append(id_)
-        self._timestamps[id_] = time.time()
-        self._redis.set(self.generate_key_content(id_), value.cached_data)
-        self._redis.set(self.generate_key_status(id_), self.STATUS_WAITING)
-        self._redis.set(self.generate_key_timestamp(id_), self._timestamps[id_])
+        logger.info('Adding ClientRequest to Queue: %s / %s', value.endpoint, id_)
+        entry = QueueEntry(time.time(), value)
+        self._entries[id_] = entry
+        self._storage.add(self._id, id_, value, entry.timestamp)
+        if len(self._entries) == 1:
+            self._new_head()
 
     def __getitem__(self, id_):
         """
         Get a specific ClientRequest by id.
-        :param id_: 
-        :return: 
+        :param id_:
+        :return:
         """
-        key_content = self.generate_key_content(id_)
-        cached_data = self._redis.get(key_content)
+        entry = self._entries.get(id_)
+        if entry is not None and entry.request is not None:
+            return entry.request
+        cached_data = self._storage.get(self._id, id_)
         if cached_data is None:
             raise KeyError
         return ClientRequest.fromcache(cached_data)
 
     def __delitem__(self, id_):
         """
-        Remove a ClientRequest from the queue (if it still exists) and from redis.
-        :param id_: 
-        :return: 
+        Remove a ClientRequest from the queue (if it still exists) and from the storage.
+        :param id_:
+        :return:
         """
-        for redis_key in [self.generate_key_content(id_),
-                          self.generate_key_status(id_),
-                          self.generate_key_timestamp(id_)]:
-            self._redis.delete(redis_key)
-        if id_ in self._timestamps:
-            del self._timestamps[id_]
-            self._deque.remove(id_)
+        self._storage.remove(self._id, id_)
+        self._processing.pop(id_, None)
+        if id_ in self._entries:
+            was_head = next(iter(self._entries)) == id_
+            del self._entries[id_]
+            if was_head:
+                self._new_head()
 
     def __iter__(self):
-        for item in self._deque:
+        for item in self._entries:
             yield self[item]
 
     def append(self, client_request):
         """
         Append a ClientRequest to the queue.
-        :param client_request: 
-        :return: 
+        :param client_request:
+        :return:
         """
         self[client_request.id] = client_request
 
     def popitem(self):
         """
-        Take the next ClientRequest from the queue. The ClientRequest is removed from the queue, and its status in 
-        redis is changed to STATUS_PROCESSING.
-        :return: 
+        Take the next ClientRequest from the queue. The ClientRequest is removed from the queue, and is marked as
+        being processed in the storage.
+        :return:
         """
         try:
-            id_ = self._deque.popleft()
-            del self._timestamps[id_]
-        except (IndexError, KeyError):
+            id_, entry = self._entries.popitem(last=False)
+        except KeyError:
             raise EmptyQueue
-        self._redis.set(self.generate_key_status(id_), self.STATUS_PROCESSING)
-        return self[id_]
+        self._new_head()
+        self._storage.processing(self._id, id_)
+        entry.attempts += 1
+        self._processing[id_] = entry
+        if entry.request is None:
+            # only available in the storage, e.g. after a restart
+            entry.request = self[id_]
+        return entry.request
+
+    def attempts(self, id_):
+        """
+        :param id_:
+        :return: number of times the ClientRequest was taken from the queue
+        """
+        entry = self._entries.get(id_) or self._processing[id_]
+        return entry.attempts
+
+    def requeue(self, id_):
+        """
+        Put a ClientRequest that was taken from the queue back at the head of the queue, e.g. because its Worker is
+        gone. It keeps its original timestamp, so it is also first in line among other endpoints.
+        :param id_:
+        :return: None
+        """
+        entry = self._processing.pop(id_)
+        self._entries[id_] = entry
+        self._entries.move_to_end(id_, last=False)
+        self._storage.waiting(self._id, id_)
+        self._new_head()
+
+    def load(self, ids, timestamps):
+        """
+        Put ClientRequests that are stored back in the queue, e.g. after a restart of the broker.
+        :param ids: list of ids, ordered by timestamp
+        :param timestamps: list of timestamps, one for every id
+        :return: None
+        """
+        was_empty = len(self._entries) == 0
+        self._entries.update(zip(ids, map(QueueEntry, timestamps)))
+        if was_empty:
+            self._new_head()
 
     def peek(self):
         """
-        Get the id and timestamp of the first ClientRequest in the queue, without accessing redis.
-        :return: 
+        Get the id and timestamp of the first ClientRequest in the queue, without accessing the storage.
+        :return:
         """
         try:
-            id_ = self._deque[0]
-        except IndexError:
+            id_ = next(iter(self._entries))
+        except StopIteration:
             raise EmptyQueue
-        return RequestQueue.ClientRequestPeek(id=id_, timestamp=self._timestamps[id_])
+        return RequestQueue.ClientRequestPeek(id=id_, timestamp=self._entries[id_].timestamp)
+
+    def _new_head(self):
+        if self._on_new_head is not None and len(self._entries) > 0:
+            self._on_new_head()
+
+
+class QueueScheduler:
+    """
+    Find the RequestQueue with the oldest ClientRequest for a set of endpoints in logarithmic time.
+    The heads of the RequestQueues are kept in a heap per registered set of endpoints. Entries are invalidated lazily:
+    an entry is only valid as long as its ClientRequest is still the first in line of its RequestQueue.
+    """
+
+    def __init__(self, queue_by_endpoint):
+        self._queue_by_endpoint = queue_by_endpoint
+        self._heap_by_endpoints = dict()  # frozenset of endpoints -> heap of (timestamp, endpoint, id)
+        self._heaps_by_endpoint = dict()  # endpoint -> list of (endpoints, heap) containing that endpoint
+        self._references = Counter()  # frozenset of endpoints -> number of registrations using its heap
+
+    def _head(self, endpoint):
+        queue = self._queue_by_endpoint.get(endpoint)
+        if queue is None or len(queue) == 0:
+            return None
+        peek = queue.peek()
+        return peek.timestamp, endpoint, peek.id
+
+    def _rebuild(self, endpoints, heap):
+        heap[:] = [head for head in (self._head(endpoint) for endpoint in endpoints) if head is not None]
+        heapq.heapify(heap)
+
+    def _get_heap(self, endpoints):
+        try:
+            return self._heap_by_endpoints[endpoints]
+        except KeyError:
+            # not registered, e.g. a one-off selection: build a heap that is not kept up to date
+            heap = []
+            self._rebuild(endpoints, heap)
+            return heap
+
+    def register(self, endpoints):
+        """
+        Keep a heap for the set of endpoints, e.g. of a Worker that registered, until it is unregistered as many times.
+        :param endpoints: frozenset of endpoints
+        :return: None
+        """
+        self._references[endpoints] += 1
+        if endpoints in self._heap_by_endpoints:
+            return
+        heap = []
+        self._rebuild(endpoints, heap)
+        self._heap_by_endpoints[endpoints] = heap
+        for endpoint in endpoints:
+            self._heaps_by_endpoint.setdefault(endpoint, []).append((endpoints, heap))
+
+    def unregister(self, endpoints):
+        """
+        Release a registration of the set of endpoints. The heap is deleted once no registration uses it.
+        :param endpoints: frozenset of endpoints
+        :return: None
+        """
+        if self._references[endpoints] > 1:
+            self._references[endpoints] -= 1
+            return
+        del self._references[endpoints]
+        heap = self._heap_by_endpoints.pop(endpoints, None)
+        if heap is None:
+            return
+        for endpoint in endpoints:
+            heaps = [entry for entry in self._heaps_by_endpoint[endpoint] if entry[1] is not heap]
+            if heaps:
+                self._heaps_by_endpoint[endpoint] = heaps
+            else:
+                del self._heaps_by_endpoint[endpoint]
+
+    def new_head(self, endpoint):
+        """
+        Register that another ClientRequest is first in line in the RequestQueue of the endpoint.
+        :param endpoint:
+        :return: None
+        """
+        head = self._head(endpoint)
+        if head is None:
+            return
+        for endpoints, heap in self._heaps_by_endpoint.get(endpoint, ()):
+            heapq.heappush(heap, head)
+            if len(heap) > 2 * len(endpoints) + 16:
+                # too many invalid entries, e.g. for endpoints of workers that are no longer asking for requests
+                self._rebuild(endpoints, heap)
+
+    def select(self, endpoints) -> RequestQueue:
+        """
+        Select the RequestQueue among the endpoints that has the oldest ClientRequest.
+        :param endpoints: frozenset of endpoints, other iterables are converted
+        :return:
+        """
+        heap = self._get_heap(frozenset(endpoints))
+        while heap:
+            timestamp, endpoint, id_ = heap[0]
+            queue = self._queue_by_endpoint[endpoint]
+            if len(queue) > 0 and queue.peek().id == id_:
+                return queue
+            heapq.heappop(heap)
+        raise EmptyQueue
 
 
 class QueueManager:
     """
     Manage a pool of RequestQueues, where each RequestQueue is assigned to a specific endpoint.
+    All RequestQueues share one Storage, by default redis.
     """
 
-    def __init__(self, redis_host, redis_port, redis_db):
+    def __init__(self, redis_host, redis_port, redis_db, storage=None):
         self._redis = (redis_host, redis_port, redis_db)
+        if storage is None:
+            storage = RedisStorage.connect(redis_host, redis_port, redis_db)
+        self._storage = storage
         self._queue_by_endpoint = dict()
+        self._scheduler = QueueScheduler(self._queue_by_endpoint)
+        self._endpoint_by_request = dict()  # index of all known ClientRequests, waiting or processing
+        self._processing_requests = dict()  # ClientRequests that have been handed out to a Worker
+        self._expiry = []  # heap of (deadline, id) of ClientRequests with a deadline, entries are removed lazily
+        self._extended_deadlines = dict()  # id -> deadline, for ClientRequests of which the deadline was extended
 
     def __len__(self):
         return sum([len(queue) for endpoint, queue in self._queue_by_endpoint.items()])
 
-    def load_redis(self):
+    def __contains__(self, client_request_id):
+        return client_request_id in self._endpoint_by_request
+
+    def depths(self):
         """
-        Load the queue from redis. Useful to recover after a crash.
-        :return: None
+        :return: dict of endpoint -> number of waiting ClientRequests
+        """
+        return dict((endpoint, len(queue)) for endpoint, queue in self._queue_by_endpoint.items())
+
+    def load_storage(self, select=None):
+        """
+        Load the queues from the storage. Useful to recover after a crash.
+        ClientRequests that were being processed are queued again. The content of the ClientRequests is only read for
+        their deadlines, they are kept in the storage until they are dispatched.
+        :param select: function that is True for the endpoints to load, all endpoints are loaded if None
+        :return: number of recovered ClientRequests
+        """
+        start = time.time()
+        requests = self._storage.load(select=select)
+
+        recovered = 0
+        for endpoint, (ids, timestamps) in requests.items():
+            self.get_queue(endpoint).load(ids, timestamps)
+            self._endpoint_by_request.update(dict.fromkeys(ids, endpoint))
+            for id_, cached_data in zip(ids, self._storage.get_many(endpoint, ids)):
+                deadline = msgpack.unpackb(cached_data)[b'content'].get(b'deadline') if cached_data else None
+                if deadline is not None:
+                    self._expiry.append((deadline, id_))
+            recovered += len(ids)
+        heapq.heapify(self._expiry)
+
+        logger.info('Recovered %s ClientRequests for %s endpoints from %s in %.3f seconds',
+                    recovered, len(requests), type(self._storage).__name__, time.time() - start)
+        return recovered
+
+    def take_over(self, storage):
         """
-        raise NotImplementedError
+        Move the ClientRequests of another Storage into the RequestQueues, e.g. of a broker that is gone.
+        :param storage:
+        :return: number of ClientRequests that were moved
+        """
+        moved = 0
+        for endpoint, (ids, timestamps) in storage.load().items():
+            for id_ in ids:
+                cached_data = storage.get(endpoint, id_)
+                if cached_data is not None:
+                    self.append(ClientRequest.fromcache(cached_data))
+                    moved += 1
+                storage.remove(endpoint, id_)
+        storage.flush()
+        return moved
 
     def append(self, client_request: ClientRequest) -> None:
         """
         Append a ClientRequest to the correct RequestQueue, based on its endpoint.
-        :param client_request: 
-        :return: 
+        :param client_request:
+        :return:
         """
         self.get_queue(client_request.endpoint).append(client_request)
+        self._endpoint_by_request[client_request.id] = client_request.endpoint
+        if client_request.deadline is not None:
+            heapq.heappush(self._expiry, (client_request.deadline, client_request.id))
+
+    def expire(self, now):
+        """
+        Remove the waiting ClientRequests of which the deadline has passed. ClientRequests that are being processed are
+        left alone.
+        :param now: unix timestamp
+        :return: number of removed ClientRequests
+        """
+        expired = 0
+        while len(self._expiry) > 0 and self._expiry[0][0] <= now:
+            deadline, id_ = heapq.heappop(self._expiry)
+            if id_ in self._processing_requests or id_ not in self._endpoint_by_request \
+                    or self._extended_deadlines.get(id_, deadline) > now:
+                continue
+            self.remove(id_)
+            expired += 1
+        return expired
+
+    def extend_deadline(self, client_request_id: str, deadline) -> None:
+        """
+        Postpone the deadline of a ClientRequest.
+        :param client_request_id:
+        :param deadline: unix timestamp
+        :return:
+        """
+        self.retrieve(client_request_id).extend_deadline(deadline)
+        self._extended_deadlines[client_request_id] = deadline
+        heapq.heappush(self._expiry, (deadline, client_request_id))
+
+    def popitem(self, endpoints: list) -> ClientRequest:
+        """
+        Take the oldest ClientRequest among the endpoints, and keep it in memory while it is being processed.
+        :param endpoints:
+        :return:
+        """
+        client_request = self.select_queue(endpoints).popitem()
+        self._processing_requests[client_request.id] = client_request
+        return client_request
+
+    def requeue(self, client_request_id: str, max_attempts: int) -> bool:
+        """
+        Put a ClientRequest that is being processed back at the head of its RequestQueue, unless it was already handed
+        out max_attempts times. In that case it is removed.
+        :param client_request_id:
+        :param max_attempts:
+        :return: True if the ClientRequest was put back
+        """
+        self._processing_requests.pop(client_request_id, None)
+        queue = self._queue_by_endpoint[self._endpoint_by_request[client_request_id]]
+        if queue.attempts(client_request_id) >= max_attempts:
+            self.remove(client_request_id)
+            return False
+        queue.requeue(client_request_id)
+        return True
 
     def retrieve(self, client_request_id: str) -> ClientRequest:
         """
         Retrieve the ClientRequest identified by client_request_id.
-        :param client_request_id: 
-        :return: 
+        :param client_request_id:
+        :return:
         """
-        for endpoint, queue in self._queue_by_endpoint.items():
-            if client_request_id in queue:
-                return queue[client_request_id]
-        raise KeyError
+        try:
+            return self._processing_requests[client_request_id]
+        except KeyError:
+            pass
+        endpoint = self._endpoint_by_request[client_request_id]
+        return self._queue_by_endpoint[endpoint][client_request_id]
 
     def remove(self, client_request_id: str) -> None:
         """
         Remove the ClientRequest, identified by client_request_id, from the RequestQueue.
-        :param client_request_id: 
-        :return: 
+        :param client_request_id:
+        :return:
         """
-        for endpoint, queue in self._queue_by_endpoint.items():
-            if client_request_id in queue:
-                logger.debug('Removing ClientRequest {} from RequestQueue for {}'.format(client_request_id, endpoint))
-                del queue[client_request_id]
-                return
-        raise KeyError
+        endpoint = self._endpoint_by_request.pop(client_request_id)
+        self._processing_requests.pop(client_request_id, None)
+        self._extended_deadlines.pop(client_request_id, None)
+        logger.debug('Removing ClientRequest %s from RequestQueue for %s', client_request_id, endpoint)
+        del self._queue_by_endpoint[endpoint][client_request_id]
 
     def get_queue(self, endpoint: str) -> RequestQueue:
         """
-        Get the RequestQueue for the endpoint. 
-        :param endpoint: 
-        :return: 
+        Get the RequestQueue for the endpoint.
+        :param endpoint:
+        :return:
         """
-        return self._queue_by_endpoint.setdefault(endpoint, RequestQueue(*self._redis))
+        try:
+            return self._queue_by_endpoint[endpoint]
+        except KeyError:
+            queue = RequestQueue(*self._redis,
+                                 storage=self._storage,
+                                 on_new_head=functools.partial(self._scheduler.new_head, endpoint),
+                                 endpoint=endpoint)
+            self._queue_by_endpoint[endpoint] = queue
+            return queue
+
+    def flush(self):
+        """
+        Make the buffered writes of all RequestQueues durable at once, e.g. in one round trip to redis.
+        :return: None
+        """
+        self._storage.flush()
 
-    def select_queue(self, endpoints: list) -> RequestQueue:
+    def select_queue(self, endpoints) -> RequestQueue:
         """
         Select the RequestQueue among the endpoints that has the oldest ClientRequest.
-        :param endpoints: 
-        :return: 
+        :param endpoints: preferably a frozenset registered with register_endpoints, which keeps its heap up to date
+        :return:
         """
-        available_client_requests = []
-        for endpoint in endpoints:
-            queue = self.get_queue(endpoint)
-            if len(queue) > 0:
-                available_client_requests.append(queue)
+        return self._scheduler.select(endpoints)
 
-        if len(available_client_requests) == 0:
-            raise EmptyQueue
+    def register_endpoints(self, endpoints):
+        """
+        Keep track of the oldest ClientRequest among the endpoints, for as long as they are not unregistered.
+        :param endpoints: frozenset of endpoints
+        :return: None
+        """
+        self._scheduler.register(endpoints)
 
-        return sorted(available_client_requests, key=lambda q: q.peek().timestamp)[0]
+    def unregister_endpoints(self, endpoints):
+        """
+        :param endpoints: frozenset of endpoints, as registered with register_endpoints
+        :return: None
+        """
+        self._scheduler.unregister(endpoints)
 
 
 class RequestManager:
     """
     Manage all requests and abstract the queues itself.
+    Every Worker has a credit: the number of ClientRequests it can hold at the same time. A Worker is waiting as long
+    as it has credit left, so its next ClientRequests are already on their way while it processes the current one.
     """
 
-    def __init__(self, redis_host, redis_port, redis_db):
-        self._manager = QueueManager(redis_host, redis_port, redis_db)
+    def __init__(self, redis_host, redis_port, redis_db, storage=None, max_attempts=MAX_ATTEMPTS):
+        self._manager = QueueManager(redis_host, redis_port, redis_db, storage=storage)
+        self._max_attempts = max_attempts
+        self._requests_by_worker = dict()  # worker id -> ids of the ClientRequests the Worker is processing
+        self._worker_by_request = dict()
         self._endpoints_by_worker = dict()
-        self._waiting_workers = set()
+        self._capacity_by_worker = dict()  # credit of a Worker without any ClientRequests
+        self._credit_by_worker = dict()  # number of ClientRequests a Worker can still take
+        self._waiting_workers = set()  # workers with credit left
+        self._waiting_workers_by_endpoint = dict()  # endpoint -> waiting workers, as dict keys to keep the order
+        self._new_waiting_workers = set()  # workers that became available since the last call
+        self._endpoints_with_new_requests = set()  # endpoints with waiting workers that got requests since last call
+        self._counters = Counter()
 
     def __len__(self):
         return len(self._manager)
 
+    def __contains__(self, client_request_id):
+        return client_request_id in self._manager
+
+    @property
+    def counters(self):
+        """
+        :return: dict of counter name -> value, e.g. the number of expired ClientRequests
+        """
+        return dict(self._counters)
+
     @property
     def registered_workers(self):
         return list(self._endpoints_by_worker.keys())
 
-    def register(self, worker_id, endpoints):
+    def register(self, worker_id, endpoints, credit=1):
         """
         Registers a Worker to handle ClientRequests for endpoints.
-        :param worker_id: 
-        :param endpoints: 
-        :return: 
+        :param worker_id:
+        :param endpoints:
+        :param credit: number of ClientRequests the Worker can hold at the same time
+        :return:
         """
-        logger.info('Registering worker {} to RequestManager for endpoints {}'.format(worker_id, endpoints))
+        logger.info('Registering worker %s to RequestManager for endpoints %s with credit %s',
+                    worker_id, endpoints, credit)
         if worker_id in self._endpoints_by_worker:
             raise WorkerIsAlreadyRegistered
-        self._endpoints_by_worker[worker_id] = set(endpoints)
-        self.worker_available(worker_id)
+        self._endpoints_by_worker[worker_id] = frozenset(endpoints)
+        self._manager.register_endpoints(self._endpoints_by_worker[worker_id])
+        self._capacity_by_worker[worker_id] = max(int(credit), 1)
+        self._credit_by_worker[worker_id] = 0
+        self.worker_available(worker_id, credit=credit)
 
     def unregister(self, worker_id):
         """
-        Unregisters a Worker from all its endpoits.
-        :param worker_id: 
-        :return: 
+        Unregisters a Worker from all its endpoits. The ClientRequests it was processing are delivered again.
+        :param worker_id:
+        :return:
+        """
+        self._redeliver(worker_id)
+        self._worker_busy(worker_id)
+        endpoints = self._endpoints_by_worker.pop(worker_id, None)
+        if endpoints is not None:
+            self._manager.unregister_endpoints(endpoints)
+        self._capacity_by_worker.pop(worker_id, None)
+        self._credit_by_worker.pop(worker_id, None)
+
+    def worker_available(self, worker_id, credit=1):
+        """
+        Give credit back to a Worker, e.g. because it completed a ClientRequest. The credit of a Worker never exceeds
+        the credit it registered with.
+        :param worker_id:
+        :param credit: number of ClientRequests the Worker can take in addition
+        :return:
         """
+        logger.info('Worker %s is waiting for %s more requests', worker_id, credit)
         try:
-            del self._endpoints_by_worker[worker_id]
+            endpoints = self._endpoints_by_worker[worker_id]
         except KeyError:
-            pass
+            logger.warning('Worker %s is not registered', worker_id)
+            return
+        self._credit_by_worker[worker_id] = min(self._credit_by_worker[worker_id] + int(credit),
+                                                self._capacity_by_worker[worker_id])
+        if self._credit_by_worker[worker_id] <= 0 or worker_id in self._waiting_workers:
+            return
+        self._waiting_workers.add(worker_id)
+        for endpoint in endpoints:
+            self._waiting_workers_by_endpoint.setdefault(endpoint, dict())[worker_id] = None
+        self._new_waiting_workers.add(worker_id)
+
+    def credit(self, worker_id):
+        """
+        :param worker_id:
+        :return: number of ClientRequests the Worker can still take
+        """
+        return self._credit_by_worker.get(worker_id, 0)
+
+    def capacity(self, worker_id):
+        """
+        :param worker_id:
+        :return: number of ClientRequests the Worker can hold at the same time
+        """
+        return self._capacity_by_worker.get(worker_id, 0)
+
+    def in_flight(self, worker_id):
+        """
+        :param worker_id:
+        :return: number of ClientRequests the Worker is processing
+        """
+        return len(self._requests_by_worker.get(worker_id, ()))
+
+    def worker_of(self, client_request_id):
+        """
+        :param client_request_id:
+        :return: id of the Worker that is processing the ClientRequest, None if it is not being processed
+        """
+        return self._worker_by_request.get(client_request_id)
+
+    def queue_depths(self):
+        """
+        :return: dict of endpoint -> number of waiting ClientRequests
+        """
+        return self._manager.depths()
+
+    def _redeliver(self, worker_id):
+        for client_request_id in self._requests_by_worker.pop(worker_id, ()):
+            del self._worker_by_request[client_request_id]
+            if self._manager.requeue(client_request_id, self._max_attempts):
+                logger.info('Delivering ClientRequest %s of worker %s again', client_request_id, worker_id)
+                self._counters['redelivered'] += 1
+                endpoint = self._manager.retrieve(client_request_id).endpoint
+                if self._waiting_workers_by_endpoint.get(endpoint):
+                    self._endpoints_with_new_requests.add(endpoint)
+            else:
+                logger.warning('Dropped ClientRequest %s after %s attempts', client_request_id, self._max_attempts)
+                self._counters['attempts_exceeded'] += 1
+
+    def _dispatch(self, worker_id, client_request):
+        self._requests_by_worker.setdefault(worker_id, dict())[client_request.id] = None
+        self._worker_by_request[client_request.id] = worker_id
+        self._take_credit(worker_id)
+
+    def _worker_busy(self, worker_id):
         try:
             self._waiting_workers.remove(worker_id)
         except KeyError:
-            pass
+            return
+        for endpoint in self._endpoints_by_worker[worker_id]:
+            del self._waiting_workers_by_endpoint[endpoint][worker_id]
+        self._new_waiting_workers.discard(worker_id)
+
+    def _take_credit(self, worker_id):
+        self._credit_by_worker[worker_id] -= 1
+        if self._credit_by_worker[worker_id] <= 0:
+            self._worker_busy(worker_id)
 
-    def worker_available(self, worker_id):
+    def load_storage(self, select=None):
         """
-        Mark a Worker as available for new ClientRequests.
-        :param worker_id: 
-        :return: 
+        Recover the ClientRequests that were queued or being processed before a restart of the broker.
+        :param select: function that is True for the endpoints to load, all endpoints are loaded if None
+        :return: number of recovered ClientRequests
         """
-        logger.info('Worker {} is waiting for next request'.format(worker_id))
-        self._waiting_workers.add(worker_id)
+        recovered = self._manager.load_storage(select=select)
+        for endpoint in self._waiting_workers_by_endpoint:
+            self._endpoints_with_new_requests.add(endpoint)
+        return recovered
+
+    def take_over(self, storage):
+        """
+        Take over the ClientRequests of another broker.
+        :param storage: Storage of the other broker
+        :return: number of ClientRequests that were taken over
+        """
+        moved = self._manager.take_over(storage)
+        for endpoint in self._waiting_workers_by_endpoint:
+            self._endpoints_with_new_requests.add(endpoint)
+        return moved
 
     def append(self, client_request: ClientRequest):
         """
         Add a ClientRequest.
-        :param client_request: 
-        :return: 
+        :param client_request:
+        :return:
+        """
+        self._manager.append(client_request)
+        if self._waiting_workers_by_endpoint.get(client_request.endpoint):
+            self._endpoints_with_new_requests.add(client_request.endpoint)
+
+    def expire(self, now=None):
+        """
+        Drop the waiting ClientRequests of which the deadline has passed, before they are dispatched to a Worker.
+        :param now: unix timestamp, the current time if None
+        :return: number of dropped ClientRequests
+        """
+        expired = self._manager.expire(time.time() if now is None else now)
+        if expired > 0:
+            logger.warning('Dropped %s expired ClientRequests', expired)
+            self._counters['expired'] += expired
+        return expired
+
+    def extend_deadline(self, client_request_id, deadline):
+        """
+        Postpone the deadline of a ClientRequest that is waiting or being processed.
+        :param client_request_id:
+        :param deadline: unix timestamp
+        :return: None
         """
-        self._manager.get_queue(client_request.endpoint).append(client_request)
+        self._manager.extend_deadline(client_request_id, deadline)
+
+    def _popitem(self, worker_id, now):
+        # a ClientRequest can expire between two calls of expire
+        while True:
+            client_request = self._manager.popitem(self._endpoints_by_worker[worker_id])
+            if not client_request.expired(now):
+                return client_request
+            logger.warning('Dropped expired ClientRequest %s', client_request.id)
+            self._manager.remove(client_request.id)
+            self._counters['expired'] += 1
 
     def __getitem__(self, client_request_id: str) -> ClientRequest:
         """
         Get a ClientRequest.
-        :param worker_id: 
-        :return: 
+        :param worker_id:
+        :return:
         """
         return self._manager.retrieve(client_request_id)
 
     def __delitem__(self, client_request_id: str):
         """
         Remove a ClientRequest when it is completed.
-        :param client_request_id: 
-        :return: 
+        :param client_request_id:
+        :return:
         """
         self._manager.remove(client_request_id)
+        worker_id = self._worker_by_request.pop(client_request_id, None)
+        if worker_id is not None:
+            del self._requests_by_worker[worker_id][client_request_id]
+
+    def flush(self):
+        """
+        Make all buffered writes durable. Called once per iteration of the broker loop.
+        :return: None
+        """
+        self._manager.flush()
 
     def __call__(self, *args, **kwargs):
         """
-        Get the next ClientRequest for all available Workers.
-        :param args: 
-        :param kwargs: 
-        :return: 
+        Get the next ClientRequests for all Workers with credit left.
+        :param args:
+        :param kwargs:
+        :return: list of (worker_id, ClientRequest)
         """
-        to_process = {}
-        for worker_id in self._waiting_workers.copy():
-            try:
-                to_process[worker_id] = self._manager.select_queue(self._endpoints_by_worker[worker_id]).popitem()
-                self._waiting_workers.remove(worker_id)
-            except EmptyQueue:
-                pass
+        to_process = []
+        now = time.time()
+
+        # workers that became available only look at their own endpoints, and fill up all their credit
+        new_waiting_workers, self._new_waiting_workers = self._new_waiting_workers, set()
+        for worker_id in new_waiting_workers:
+            while worker_id in self._waiting_workers:
+                try:
+                    client_request = self._popitem(worker_id, now)
+                except EmptyQueue:
+                    break
+                to_process.append((worker_id, client_request))
+                self._dispatch(worker_id, client_request)
+
+        # new requests only wake up workers that are waiting for their endpoint, in turn
+        endpoints, self._endpoints_with_new_requests = self._endpoints_with_new_requests, set()
+        for endpoint in endpoints:
+            waiting_workers = self._waiting_workers_by_endpoint[endpoint]
+            queue = self._manager.get_queue(endpoint)
+            while len(waiting_workers) > 0 and len(queue) > 0:
+                worker_id = next(iter(waiting_workers))
+                try:
+                    client_request = self._popitem(worker_id, now)
+                except EmptyQueue:
+                    break
+                to_process.append((worker_id, client_request))
+                self._dispatch(worker_id, client_request)
+                if worker_id in waiting_workers:
+                    # the next request of this endpoint goes to the next worker
+                    del waiting_workers[worker_id]
+                    waiting_workers[worker_id] = None
+
         if len(to_process) > 0:
-            logger.debug('To process: {}'.format(to_process))
-        return to_process.items()
+            logger.debug('To process: %s ClientRequests', len(to_process))
+        return to_process
 
 
 class Broker:
@@ -441,142 +1019,777 @@ class Broker:
                  client_bind,
                  redis_host='localhost',
                  redis_port=6379,
-                 redis_db=0):
+                 redis_db=0,
+                 batch_size=BATCH_SIZE,
+                 storage=STORAGE,
+                 storage_path=STORAGE_PATH,
+                 shard=None,
+                 shards=1,
+                 cluster=None,
+                 cache_size=CACHE_SIZE,
+                 cache_memory=CACHE_MEMORY,
+                 stats_bind=None,
+                 stats_path=None,
+                 stats_interval=STATS_INTERVAL):
+        """
+        :param shard: index of this broker among the shards of a ShardedBroker, None if it is not sharded
+        :param shards: number of shards of the ShardedBroker
+        :param cluster: nimbus.cluster.Cluster to join, None if the broker is not part of a cluster
+        :param cache_size: maximum number of cached responses, 0 to disable the cache
+        :param cache_memory: maximum number of bytes taken by the cached responses
+        :param stats_bind: url of the socket that answers every request with the metrics, None to not bind it
+        :param stats_path: file to write the metrics to every stats_interval seconds, None to not write them
+        """
         self._context = zmq.Context.instance()
 
-        logger.info('Creating worker response socket on {}'.format(worker_response_bind))
+        logger.info('Creating worker response socket on %s', worker_response_bind)
         self._worker_response_socket = self._context.socket(zmq.ROUTER)
         self._worker_response_socket.bind(worker_response_bind)
 
-        logger.info('Creating worker control socket on {}'.format(worker_control_bind))
+        logger.info('Creating worker control socket on %s', worker_control_bind)
         self._worker_control_socket = self._context.socket(zmq.ROUTER)
         self._worker_control_socket.bind(worker_control_bind)
 
-        logger.info('Creating client socket on {}'.format(client_bind))
+        logger.info('Creating client socket on %s', client_bind)
         self._client_socket = self._context.socket(zmq.ROUTER)
         self._client_socket.bind(client_bind)
 
+        self._stats_socket = None
+        if stats_bind is not None:
+            logger.info('Creating stats socket on %s', stats_bind)
+            self._stats_socket = self._context.socket(zmq.ROUTER)
+            self._stats_socket.bind(stats_bind)
+
         self._redis_host = redis_host
         self._redis_port = redis_port
         self._redis_db = redis_db
+        self._batch_size = batch_size
+        self._storage = storage
+        self._storage_path = storage_path
+        self._shard = shard
+        self._shards = shards
+        if shard is not None and storage_path is not None:
+            self._storage_path = shard_storage_path(storage_path, shard)
+        self._id_prefix = request_id_prefix(shard) if shard is not None else ''
+        self._cluster = cluster
+        self._cache = ResponseCache(max_entries=cache_size, max_bytes=cache_memory)
+        self._coalescer = RequestCoalescer()
+        self._metrics = BrokerMetrics()
+        self._stats_path = stats_path
+        if shard is not None and stats_path is not None:
+            self._stats_path = '{}.shard-{}'.format(stats_path, shard)
+        self._stats_interval = stats_interval
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def coalescer(self):
+        return self._coalescer
+
+    def stats(self, request_manager):
+        """
+        :param request_manager:
+        :return: metrics of the broker in the Prometheus text format
+        """
+        counters = dict(request_manager.counters)
+        for prefix, component in [('cache_', self._cache), ('', self._coalescer)]:
+            counters.update((prefix + name, value) for name, value in component.counters.items())
+        return self._metrics.render(request_manager, counters=counters, now=time.time())
+
+    def recv_batch(self, socket, copy=True):
+        """
+        Receive up to batch_size messages that are already waiting on the socket, without blocking.
+        :param socket:
+        :param copy: if False, the frames are received as zmq.Frame objects without copying them
+        :return: list of messages
+        """
+        messages = []
+        for _ in range(self._batch_size):
+            try:
+                messages.append(socket.recv_multipart(zmq.NOBLOCK, copy=copy))
+            except zmq.Again:
+                break
+        return messages
 
     def send_request(self, worker_id, request):
-        self._worker_control_socket.send_multipart([worker_id, b'', msgpack.packb(request.content)])
+        self._worker_control_socket.send_multipart(list(worker_id) + [b''] + request.frames, copy=False)
 
     def send_ping(self, worker_id):
         self._worker_control_socket.send_multipart(
-            [worker_id, b'',
-             msgpack.packb(ControlRequest(ControlRequest.PING).content)]
+            list(worker_id) + [b'', msgpack.packb(ControlRequest(ControlRequest.PING).content)]
+        )
+
+    def send_pong(self, worker_id):
+        self._worker_control_socket.send_multipart(
+            list(worker_id) + [b'', msgpack.packb(ControlRequest(ControlRequest.PONG).content)]
         )
 
     def send_kick(self, worker_id):
         self._worker_control_socket.send_multipart(
-            [worker_id, b'',
-             msgpack.packb(ControlRequest(ControlRequest.KICK).content)]
+            list(worker_id) + [b'', msgpack.packb(ControlRequest(ControlRequest.KICK).content)]
         )
 
+    def respond(self, request_manager, client_request_id, response, worker_id, now):
+        """
+        Send the response of a Worker to the client, and to the clients of coalesced ClientRequests.
+        :param request_manager:
+        :param client_request_id:
+        :param response: msgpack of the response, as bytes or zmq.Frame, that is forwarded as it was received
+        :param worker_id: Worker that sent the response, None if it is not known
+        :param now: unix timestamp
+        :return: None
+        """
+        try:
+            request = request_manager[client_request_id]
+        except KeyError:
+            # e.g. a late response of a worker that was kicked, after the request was delivered again
+            logger.warning('Response for unknown ClientRequest %s', client_request_id)
+            return
+        self._metrics.responded(request, worker_id, now)
+        del request_manager[client_request_id]
+        self._cache.put(request, response)
+
+        for source in [request.source] + self._coalescer.sources(client_request_id):
+            client_response = source + [b''] + [response]
+            self._client_socket.send_multipart(client_response, copy=False)
+
+    def handle_control(self, request_manager, state_manager, message, now):
+        """
+        Handle a message of a Worker on the control socket: a registration, a heartbeat, a disconnect, a response or
+        credit.
+        :param request_manager:
+        :param state_manager:
+        :param message: list of frames, as bytes or zmq.Frame
+        :param now: unix timestamp
+        :return: None
+        """
+        source, frames = split_message(message)
+
+        # one frame, or more when the messages of the worker are forwarded by a ShardedBroker
+        worker_id = tuple(frame_to_bytes(frame) for frame in source)
+        content = decode(msgpack.unpackb(frame_to_bytes(frames[0])))
+
+        state_manager.contact_from(worker_id)
+
+        if 'endpoints' in content:
+            # first connection to register endpoints, the worker is waiting for as many requests as its credit
+            request_manager.register(worker_id, content['endpoints'], credit=content.get('credit', 1))
+            self._metrics.registered(worker_id, now)
+            # endpoints of which the responses can be cached, as [method, endpoint, ttl]
+            for method, endpoint, ttl in content.get('cache', []):
+                self._cache.set_ttl(method, endpoint, ttl)
+            # endpoints of which identical ClientRequests share a response, as [method, endpoint]
+            for method, endpoint in content.get('coalesce', []):
+                self._coalescer.set_coalesce(method, endpoint)
+
+        if 'ping' in content and content['ping']:
+            # ping to check if broker is still available
+            logger.debug('Received ping from %s', worker_id)
+            if worker_id in request_manager.registered_workers:
+                # only respond to registered workers, otherwise disconnect
+                self.send_pong(worker_id)
+            else:
+                # we don't know this worker, so remove it
+                self.send_kick(worker_id)
+                state_manager.disconnect(worker_id)
+
+        if 'pong' in content and content['pong']:
+            logger.debug('Received pong from %s', worker_id)
+
+        if 'disconnect' in content and content['disconnect']:
+            # disconnect worker
+            request_manager.unregister(worker_id)
+            state_manager.disconnect(worker_id)
+
+        if 'r' in content:
+            # acknowledge reception of task, only sent by workers that send responses on the response socket
+            pass
+
+        if 'done' in content:
+            # the response of a ClientRequest, in the frame after the content, which also gives back the credit of
+            # the worker
+            self.respond(request_manager, content['done'], frames[1], worker_id, now)
+            request_manager.worker_available(worker_id)
+
+        if 'w' in content and content['w'] and 'endpoints' not in content:
+            # signal that tasks are done, and the worker can take as many new ones: True counts as one
+            request_manager.worker_available(worker_id, credit=content['w'])
+
+    def owns(self, endpoint):
+        """
+        :param endpoint:
+        :return: True if the RequestQueue of the endpoint belongs to this broker
+        """
+        return self._shard is None or shard_of(endpoint, self._shards) == self._shard
+
+    def take_over_dead_nodes(self, request_manager):
+        """
+        Take over the ClientRequests of the brokers in the cluster that are no longer alive. They are processed, but
+        their responses are lost, because the clients were connected to the dead broker. There is no hand off when a
+        broker joins: the queued ClientRequests of a live broker stay there until they are processed, see Cluster.
+        :param request_manager:
+        :return: None
+        """
+        for node_id in self._cluster.dead_nodes():
+            if not self._cluster.claim(node_id):
+                continue
+            storage = create_storage(self._storage,
+                                     redis_host=self._redis_host,
+                                     redis_port=self._redis_port,
+                                     redis_db=self._redis_db,
+                                     path=self._storage_path,
+                                     namespace=Cluster.namespace(node_id))
+            moved = request_manager.take_over(storage)
+            storage.close()
+            self._cluster.forget(node_id)
+            logger.info('Took over %s ClientRequests of broker %s', moved, node_id)
+
+    def _load(self, storage):
+        """
+        :param storage:
+        :return: RequestManager with the ClientRequests of the Storage that belong to this broker
+        """
+        request_manager = RequestManager(redis_host=self._redis_host,
+                                         redis_port=self._redis_port,
+                                         redis_db=self._redis_db,
+                                         storage=storage)
+        request_manager.load_storage(select=self.owns)
+        return request_manager
+
+    def rejoin(self, request_manager, storage):
+        """
+        Join the cluster again after another node took over the ClientRequests of this broker. The ClientRequests in
+        memory are dropped, only the ones that are still stored are kept, and the workers register again.
+        :param request_manager:
+        :param storage:
+        :return: the new RequestManager
+        """
+        request_manager.flush()
+        self._cluster.wait_for_takeover()
+        for worker_id in request_manager.registered_workers:
+            self.send_kick(worker_id)
+        request_manager = self._load(storage)
+        self._cluster.join()
+        return request_manager
+
     def run(self):
+        try:
+            self._run()
+        finally:
+            if self._cluster is not None:
+                # the ClientRequests that are still stored are taken over by another node
+                self._cluster.leave()
+
+    def _run(self):
         poller = zmq.Poller()
         poller.register(self._client_socket, zmq.POLLIN)
         poller.register(self._worker_control_socket, zmq.POLLIN)
         poller.register(self._worker_response_socket, zmq.POLLIN)
-
-        request_manager = RequestManager(redis_host=self._redis_host,
-                                         redis_port=self._redis_port,
-                                         redis_db=self._redis_db)
+        if self._stats_socket is not None:
+            poller.register(self._stats_socket, zmq.POLLIN)
+
+        if self._shard is None and self._cluster is None and self._storage == STORAGE_LOG:
+            # the logs of the shards of a ShardedBroker that ran before
+            repartition_storage(self._storage, 1, path=self._storage_path)
+        storage = create_storage(self._storage,
+                                 redis_host=self._redis_host,
+                                 redis_port=self._redis_port,
+                                 redis_db=self._redis_db,
+                                 path=self._storage_path,
+                                 namespace=Cluster.namespace(self._cluster.node_id) if self._cluster else None)
+        request_manager = self._load(storage)
 
         state_manager = ConnectionStateManager(seconds_before_contact_check=SECONDS_BEFORE_CONTACT_CHECK,
                                                seconds_before_disconnect=SECONDS_BEFORE_UNREGISTER)
 
+        if self._cluster is not None:
+            self._cluster.join()
+        next_heartbeat = 0
+        next_stats = time.time() + self._stats_interval
+
         poller_timeout = max([int(min([SECONDS_BEFORE_CONTACT_CHECK,
                                        SECONDS_BEFORE_UNREGISTER]) / 10.0 * 1000),
                               500])
         loop = True
         while loop:
             sockets = dict(poller.poll(poller_timeout))
+            loop_start = time.time()
 
             # get a new client request
             if self._client_socket in sockets and sockets[self._client_socket] == zmq.POLLIN:
-                message = self._client_socket.recv_multipart()
-                client_request = ClientRequest(source=extract_source_from_message(message),
-                                               content=extract_content_from_message(message))
-                request_manager.append(client_request)
+                for message in self.recv_batch(self._client_socket, copy=False):
+                    # a header frame, optionally followed by a body frame that is kept as it was received
+                    source, content = split_message(message)
+                    client_request = ClientRequest(source=[frame.bytes for frame in source],
+                                                   content=content[0].bytes,
+                                                   body=content[1] if len(content) > 1 else None,
+                                                   id_prefix=self._id_prefix)
+                    response = self._cache.get(client_request)
+                    if response is not None:
+                        self._client_socket.send_multipart(client_request.source + [b'', response])
+                        continue
+                    # an identical ClientRequest is pending, its response also goes to this client
+                    leader_id = self._coalescer.follow(client_request, is_pending=request_manager.__contains__)
+                    if leader_id is not None:
+                        request_manager.extend_deadline(leader_id, self._coalescer.deadline(leader_id))
+                        continue
+                    request_manager.append(client_request)
 
             # register endpoints of a worker or mark the worker as waiting
             if self._worker_control_socket in sockets and sockets[self._worker_control_socket] == zmq.POLLIN:
-                message = self._worker_control_socket.recv_multipart()
-                source = extract_source_from_message(message)
-                content = extract_content_from_message(message)
-
-                assert len(source) == 1
-                worker_id = source[0]
-                content = decode(msgpack.unpackb(content))
-
-                state_manager.contact_from(worker_id)
-
-                if 'endpoints' in content:
-                    # first connection to register endpoints
-                    request_manager.register(worker_id, content['endpoints'])
-
-                if 'ping' in content and content['ping']:
-                    # ping to check if broker is still available
-                    logger.debug('Received ping from {}'.format(worker_id))
-                    if worker_id in request_manager.registered_workers:
-                        # only respond to registered workers, otherwise disconnect
-                        self._worker_control_socket.send_multipart(
-                            [worker_id, b'',
-                             msgpack.packb(ControlRequest(ControlRequest.PONG).content)]
-                        )
-                    else:
-                        # we don't know this worker, so remove it
-                        self.send_kick(worker_id)
-                        state_manager.disconnect(worker_id)
-
-                if 'pong' in content and content['pong']:
-                    logger.debug('Received pong from {}'.format(worker_id))
-
-                if 'disconnect' in content and content['disconnect']:
-                    # disconnect worker
-                    request_manager.unregister(worker_id)
-                    state_manager.disconnect(worker_id)
-
-                if 'r' in content:
-                    # acknowledge reception of task
-                    pass
-
-                if 'w' in content and content['w']:
-                    # signal that task is done
-                    request_manager.worker_available(worker_id)
+                for message in self.recv_batch(self._worker_control_socket, copy=False):
+                    self.handle_control(request_manager, state_manager, message, loop_start)
 
             # receive responses and send them back to the client
             if self._worker_response_socket in sockets and sockets[self._worker_response_socket] == zmq.POLLIN:
-                message = self._worker_response_socket.recv_multipart()
-                source = extract_source_from_message(message)
-                response = extract_content_from_message(message)
-                response = msgpack.unpackb(response)
+                for message in self.recv_batch(self._worker_response_socket, copy=False):
+                    source, content = split_message(message)
+                    source = [frame.bytes for frame in source]
 
-                worker_response = source + [b''] + [b'OK']
-                self._worker_response_socket.send_multipart(worker_response)
+                    worker_response = source + [b''] + [b'OK']
+                    self._worker_response_socket.send_multipart(worker_response)
 
-                request = request_manager[response[b'id'].decode()]
-                del request_manager[response[b'id'].decode()]
-                del response[b'id']
-
-                client_response = request.source + [b''] + [msgpack.packb(response)]
-                self._client_socket.send_multipart(client_response)
-
-            # send requests to workers
+                    if len(content) > 1:
+                        # an id frame, followed by the response that is forwarded as it was received
+                        client_request_id = content[0].bytes.decode()
+                        response = content[1]
+                    else:
+                        response = msgpack.unpackb(content[0].bytes)
+                        client_request_id = response.pop(b'id').decode()
+                        response = msgpack.packb(response)
+
+                    worker_id = request_manager.worker_of(client_request_id)
+                    if worker_id is not None:
+                        # a response also shows that the worker is alive
+                        state_manager.contact_from(worker_id)
+                    self.respond(request_manager, client_request_id, response, worker_id, loop_start)
+
+            # send requests to workers, once per batch of received messages, but not when the client stopped waiting
+            request_manager.expire()
+            self._coalescer.expire()
+            now = time.time()
             for worker_id, request in request_manager():
-                logger.info('Sending {} to {}'.format(request.id, worker_id))
+                logger.info('Sending %s to %s', request.id, worker_id)
                 self.send_request(worker_id, request)
+                request.dispatched = now
+                self._metrics.dispatched(request, now)
+
+            # answer every message on the stats socket with the metrics
+            if self._stats_socket is not None and self._stats_socket in sockets:
+                stats = self.stats(request_manager).encode()
+                for message in self.recv_batch(self._stats_socket):
+                    source, content = split_message(message)
+                    self._stats_socket.send_multipart(source + [b'', stats])
+
+            if self._stats_path is not None and now >= next_stats:
+                self._metrics.write(self.stats(request_manager), self._stats_path)
+                next_stats = now + self._stats_interval
 
             # send ping messages to workers
             for worker_id in state_manager.get_connections_to_ping():
-                logger.debug('Pinging {}'.format(worker_id))
+                logger.debug('Pinging %s', worker_id)
                 self.send_ping(worker_id)
 
             # send kick messages to non-responsive workers
             for worker_id in state_manager.get_connections_to_disconnect():
-                logger.info('Kicking {}'.format(worker_id))
+                logger.info('Kicking %s', worker_id)
                 self.send_kick(worker_id)
                 request_manager.unregister(worker_id)
+
+            # stay alive in the cluster, and take over from brokers that are not
+            if self._cluster is not None and time.time() >= next_heartbeat:
+                if not self._cluster.heartbeat():
+                    request_manager = self.rejoin(request_manager, storage)
+                self.take_over_dead_nodes(request_manager)
+                next_heartbeat = time.time() + self._cluster.seconds_alive / 3.0
+
+            # make everything that piled up during this iteration durable at once, e.g. in one round trip to redis
+            request_manager.flush()
+            self._metrics.loop(time.time() - loop_start)
+
+
+def _run_shard(**kwargs):
+    Broker(**kwargs).run()
+
+
+def repartition(sources, targets):
+    """
+    Move the stored ClientRequests to the Storage of the shard that owns their endpoint, with the id prefix of that
+    shard, so that their responses are routed to it.
+    :param sources: list of Storage to read the ClientRequests from
+    :param targets: list with the Storage of every shard, or with one Storage for a broker that is not sharded
+    :return: number of moved ClientRequests
+    """
+    shards = len(targets)
+    moved = 0
+    for source in sources:
+        for endpoint, (ids, timestamps) in source.load().items():
+            shard = shard_of(endpoint, shards) if shards > 1 else None
+            target = targets[shard or 0]
+            for id_, timestamp in zip(ids, timestamps):
+                if target is source and (shard is None or shard_of_request(id_) == shard):
+                    continue
+                cached_data = source.get(endpoint, id_)
+                if cached_data is not None:
+                    client_request = ClientRequest.fromcache(cached_data)
+                    client_request = ClientRequest(source=client_request.source,
+                                                   content=msgpack.packb(client_request.content),
+                                                   body=client_request.body,
+                                                   id_prefix=request_id_prefix(shard) if shard is not None else '')
+                    target.add(endpoint, client_request.id, client_request, timestamp)
+                    moved += 1
+                source.remove(endpoint, id_)
+    for storage in sources + targets:
+        storage.flush()
+    return moved
+
+
+def repartition_storage(storage, shards, redis_host=None, redis_port=None, redis_db=None, path=None):
+    """
+    Repartition the ClientRequests of a broker before it starts, because the number of shards may have changed since
+    they were stored. Every shard of a ShardedBroker only loads the ClientRequests of its own endpoints, from its own
+    log, and a worker sends the response to the shard in the id of the ClientRequest.
+    :param storage: STORAGE_MEMORY, STORAGE_REDIS or STORAGE_LOG
+    :param shards: number of shards, 1 for a broker that is not sharded
+    :param redis_host:
+    :param redis_port:
+    :param redis_db:
+    :param path: directory of the log, for STORAGE_LOG
+    :return: number of moved ClientRequests
+    """
+    if storage == STORAGE_REDIS:
+        # the shards share the storage
+        redis_storage = create_storage(storage, redis_host=redis_host, redis_port=redis_port, redis_db=redis_db)
+        sources = [redis_storage]
+        targets = [redis_storage] * shards
+    elif storage == STORAGE_LOG:
+        paths = shard_storage_paths(path)
+        if shards == 1 and len(paths) == 0:
+            return 0
+        if shards == 1:
+            targets = [LogStorage(path)]
+        else:
+            targets = [LogStorage(shard_storage_path(path, shard)) for shard in range(shards)]
+        sources = list(targets)
+        # the log of a broker that was not sharded, and of the shards that no longer exist
+        if shards > 1 and len(LogStorage.segment_numbers(path)) > 0:
+            sources.append(LogStorage(path))
+        sources += [LogStorage(shard_path) for shard, shard_path in sorted(paths.items())
+                    if shards == 1 or shard >= shards]
+    else:
+        return 0
+
+    moved = repartition(sources, targets)
+    if moved > 0:
+        logger.warning('Moved %s ClientRequests to the shard of their endpoint', moved)
+    for source in set(sources):
+        source.close()
+    return moved
+
+
+class ShardedBroker:
+    """
+    Spread the RequestQueues over several Broker processes, to use more than one core.
+    A front-end binds the sockets of a single Broker, and forwards every message to the shard that owns the endpoint,
+    over ipc. Every shard is a Broker with its own RequestManager and ConnectionStateManager. The front-end only
+    stacks envelopes: a shard sees the front-end as an extra frame of the source, and its replies are sent back to the
+    client or worker as they are.
+    Client requests are routed by the hash of their endpoint. The registration of a worker is split over the shards of
+    its endpoints, and so is its credit. Responses and credits of workers are routed by the shard prefix in the id of
+    the ClientRequest.
+    A shard needs at least one credit to send a ClientRequest to a worker. A worker with less credit than shards gets
+    one credit at every shard, and the front-end holds back the ClientRequests that exceed the credit of the worker
+    until it completes others, so a worker never holds more ClientRequests than its credit.
+    The stats socket of the front-end asks every shard for its metrics, and answers with all of them.
+    """
+
+    def __init__(self,
+                 worker_response_bind,
+                 worker_control_bind,
+                 client_bind,
+                 redis_host='localhost',
+                 redis_port=6379,
+                 redis_db=0,
+                 batch_size=BATCH_SIZE,
+                 storage=STORAGE,
+                 storage_path=STORAGE_PATH,
+                 shards=SHARDS,
+                 cache_size=CACHE_SIZE,
+                 cache_memory=CACHE_MEMORY,
+                 stats_bind=None,
+                 stats_path=None,
+                 stats_interval=STATS_INTERVAL):
+        """
+        :param stats_bind: url of the socket that answers every request with the metrics of all shards, with the shard
+        as label, None to not bind it
+        :param stats_path: every shard writes its metrics to this path, with the shard as suffix
+        """
+        self._worker_response_bind = worker_response_bind
+        self._worker_control_bind = worker_control_bind
+        self._client_bind = client_bind
+        self._stats_bind = stats_bind
+        self._shard_kwargs = dict(redis_host=redis_host,
+                                  redis_port=redis_port,
+                                  redis_db=redis_db,
+                                  batch_size=batch_size,
+                                  storage=storage,
+                                  storage_path=storage_path,
+                                  shards=shards,
+                                  cache_size=cache_size,
+                                  cache_memory=cache_memory,
+                                  stats_path=stats_path,
+                                  stats_interval=stats_interval)
+        self._batch_size = batch_size
+        self._shards = shards
+        self._shards_by_worker = dict()  # worker id -> shards the worker is registered with
+        self._last_shard_by_worker = dict()  # worker id -> shard of the last ClientRequest the worker received
+        # for workers with less credit than shards
+        self._capacity_by_worker = dict()  # worker id -> credit the worker registered with
+        self._credit_by_worker = dict()  # worker id -> number of ClientRequests the worker can still take
+        self._held_by_worker = dict()  # worker id -> ClientRequests of the shards that wait for credit of the worker
+
+    def _start_shards(self):
+        directory = tempfile.mkdtemp(prefix='nimbus-broker-')
+        urls = []
+        processes = []
+        for shard in range(self._shards):
+            url = functools.partial('ipc://{}/shard-{}-{}'.format, directory, shard)
+            stats = url('stats') if self._stats_bind is not None else None
+            urls.append((url('response'), url('control'), url('client'), stats))
+            process = multiprocessing.Process(target=_run_shard,
+                                              kwargs=dict(worker_response_bind=url('response'),
+                                                          worker_control_bind=url('control'),
+                                                          client_bind=url('client'),
+                                                          stats_bind=stats,
+                                                          shard=shard,
+                                                          **self._shard_kwargs),
+                                              daemon=True)
+            process.start()
+            processes.append(process)
+        return urls, processes
+
+    def _socket(self, type_, bind=None, connect=None):
+        socket = self._context.socket(type_)
+        if bind is not None:
+            logger.info('Creating socket on %s', bind)
+            socket.bind(bind)
+        if connect is not None:
+            socket.connect(connect)
+        return socket
+
+    def recv_batch(self, socket):
+        messages = []
+        for _ in range(self._batch_size):
+            try:
+                messages.append(socket.recv_multipart(zmq.NOBLOCK, copy=False))
+            except zmq.Again:
+                break
+        return messages
+
+    def _shard_of_credit(self, worker_id, content):
+        # the id of the completed ClientRequest, or for older workers the last ClientRequest they received
+        if 'id' in content:
+            return shard_of_request(content['id'])
+        return self._last_shard_by_worker.get(worker_id)
+
+    def _route_control(self, worker_id, content):
+        """
+        :param worker_id:
+        :param content: decoded control message of the worker
+        :return: list of (shard, content) to forward
+        """
+        if 'endpoints' in content:
+            # a worker that registers again was kicked by one of its shards, the others still know it
+            messages = [(shard, {'disconnect': True}) for shard in self._shards_by_worker.pop(worker_id, ())]
+            # the shards deliver the ClientRequests that were held back again
+            self._release_worker(worker_id)
+            endpoints_by_shard = dict()
+            for endpoint in content['endpoints']:
+                endpoints_by_shard.setdefault(shard_of(endpoint, self._shards), []).append(endpoint)
+            credit = int(content.get('credit', 1))
+            for i, (shard, endpoints) in enumerate(sorted(endpoints_by_shard.items())):
+                shard_credit = credit // len(endpoints_by_shard) + (1 if i < credit % len(endpoints_by_shard) else 0)
+                shard_content = {'endpoints': endpoints, 'credit': max(shard_credit, 1)}
+                for option in ['cache', 'coalesce']:
+                    if option in content:
+                        shard_content[option] = [value for value in content[option] if value[1] in endpoints]
+                messages.append((shard, shard_content))
+            self._shards_by_worker[worker_id] = list(sorted(endpoints_by_shard))
+            if credit < len(endpoints_by_shard):
+                self._capacity_by_worker[worker_id] = self._credit_by_worker[worker_id] = credit
+                self._held_by_worker[worker_id] = deque()
+            return messages
+
+        shards = self._shards_by_worker.get(worker_id)
+        if 'r' in content:
+            self._last_shard_by_worker[worker_id] = shard_of_request(content['r'])
+        if 'w' in content and content['w']:
+            self._credit_back(worker_id, content['w'])
+            shard = self._shard_of_credit(worker_id, content)
+            return [(shard, content)] if shard is not None else []
+        if 'done' in content:
+            self._credit_back(worker_id, 1)
+            shard = shard_of_request(content['done'])
+            return [(shard, content)] if shard is not None else []
+        if 'disconnect' in content and content['disconnect']:
+            self._last_shard_by_worker.pop(worker_id, None)
+            self._release_worker(worker_id)
+            return [(shard, content) for shard in self._shards_by_worker.pop(worker_id, ())]
+        if 'ping' in content or 'pong' in content:
+            # a worker that is not registered is kicked by any shard
+            return [(shard, content) for shard in (shards or [0])]
+        return []
+
+    def _credit_back(self, worker_id, credit):
+        if worker_id in self._credit_by_worker:
+            # True counts as one
+            self._credit_by_worker[worker_id] = min(self._credit_by_worker[worker_id] + int(credit),
+                                                    self._capacity_by_worker[worker_id])
+
+    def _release_worker(self, worker_id):
+        self._capacity_by_worker.pop(worker_id, None)
+        self._credit_by_worker.pop(worker_id, None)
+        self._held_by_worker.pop(worker_id, None)
+
+    def _hold(self, message):
+        """
+        :param message: message of a shard to a worker
+        :return: list of messages to send to the worker now
+        """
+        source, content = split_message(message)
+        worker_id = tuple(frame_to_bytes(frame) for frame in source)
+        held = self._held_by_worker.get(worker_id)
+        # ping, pong and kick are not held back
+        if held is None or b'control' in msgpack.unpackb(frame_to_bytes(content[0])):
+            return [message]
+        held.append(message)
+        return self._release(worker_id)
+
+    def _release(self, worker_id):
+        """
+        :param worker_id:
+        :return: list of held ClientRequests that the worker has credit for
+        """
+        held = self._held_by_worker.get(worker_id)
+        messages = []
+        while held and self._credit_by_worker[worker_id] > 0:
+            self._credit_by_worker[worker_id] -= 1
+            messages.append(held.popleft())
+        return messages
+
+    def run(self):
+        repartition_storage(self._shard_kwargs['storage'],
+                            self._shards,
+                            redis_host=self._shard_kwargs['redis_host'],
+                            redis_port=self._shard_kwargs['redis_port'],
+                            redis_db=self._shard_kwargs['redis_db'],
+                            path=self._shard_kwargs['storage_path'])
+        urls, processes = self._start_shards()
+        # stop the shards as well when the front-end is terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self._forward(urls)
+        finally:
+            for process in processes:
+                process.terminate()
+
+    def _forward(self, urls):
+        self._context = zmq.Context.instance()
+
+        client_socket = self._socket(zmq.ROUTER, bind=self._client_bind)
+        worker_control_socket = self._socket(zmq.ROUTER, bind=self._worker_control_bind)
+        worker_response_socket = self._socket(zmq.ROUTER, bind=self._worker_response_bind)
+        shard_response_sockets = [self._socket(zmq.DEALER, connect=response) for response, _, _, _ in urls]
+        shard_control_sockets = [self._socket(zmq.DEALER, connect=control) for _, control, _, _ in urls]
+        shard_client_sockets = [self._socket(zmq.DEALER, connect=client) for _, _, client, _ in urls]
+        stats_socket = None
+        shard_stats_sockets = []
+        if self._stats_bind is not None:
+            stats_socket = self._socket(zmq.ROUTER, bind=self._stats_bind)
+            shard_stats_sockets = [self._socket(zmq.DEALER, connect=stats) for _, _, _, stats in urls]
+        # number of a stats request -> (source, metrics of every shard)
+        pending_stats = dict()
+        stats_numbers = itertools.count()
+
+        # messages of the shards go back to the client or worker without any change
+        backend = dict()
+        for sockets, frontend in [(shard_response_sockets, worker_response_socket),
+                                  (shard_control_sockets, worker_control_socket),
+                                  (shard_client_sockets, client_socket)]:
+            for socket in sockets:
+                backend[socket] = frontend
+
+        poller = zmq.Poller()
+        for socket in [client_socket, worker_control_socket, worker_response_socket] + list(backend):
+            poller.register(socket, zmq.POLLIN)
+        for socket in ([stats_socket] if stats_socket is not None else []) + shard_stats_sockets:
+            poller.register(socket, zmq.POLLIN)
+
+        logger.info('Forwarding to %s shards', self._shards)
+        while True:
+            sockets = dict(poller.poll())
+
+            for socket in sockets:
+                if socket in backend:
+                    messages = self.recv_batch(socket)
+                    if backend[socket] is worker_control_socket and self._held_by_worker:
+                        messages = [held for message in messages for held in self._hold(message)]
+                    for message in messages:
+                        backend[socket].send_multipart(message, copy=False)
+
+            # client requests go to the shard of their endpoint
+            if client_socket in sockets:
+                for message in self.recv_batch(client_socket):
+                    source, content = split_message(message)
+                    endpoint = decode(msgpack.unpackb(content[0].bytes)[b'endpoint'])
+                    shard_client_sockets[shard_of(endpoint, self._shards)].send_multipart(message, copy=False)
+
+            if worker_control_socket in sockets:
+                for message in self.recv_batch(worker_control_socket):
+                    source, frames = split_message(message)
+                    worker_id = tuple(frame.bytes for frame in source)
+                    content = decode(msgpack.unpackb(frames[0].bytes))
+                    for shard, shard_content in self._route_control(worker_id, content):
+                        # the frames after the content, e.g. a response, are forwarded as they were received
+                        shard_control_sockets[shard].send_multipart(list(worker_id) +
+                                                                    [b'', msgpack.packb(shard_content)] +
+                                                                    frames[1:], copy=False)
+                    for held in self._release(worker_id):
+                        worker_control_socket.send_multipart(held, copy=False)
+
+            # responses go to the shard that created the ClientRequest, which also acknowledges them
+            if worker_response_socket in sockets:
+                for message in self.recv_batch(worker_response_socket):
+                    source, content = split_message(message)
+                    if len(content) > 1:
+                        client_request_id = content[0].bytes.decode()
+                    else:
+                        client_request_id = decode(msgpack.unpackb(content[0].bytes)[b'id'])
+                    shard = shard_of_request(client_request_id)
+                    if shard is None:
+                        logger.warning('Response for ClientRequest %s without shard', client_request_id)
+                        worker_response_socket.send_multipart([frame.bytes for frame in source] + [b'', b'OK'])
+                        continue
+                    shard_response_sockets[shard].send_multipart(message, copy=False)
+
+            # a stats request is answered when every shard sent its metrics
+            if stats_socket is not None and stats_socket in sockets:
+                for message in self.recv_batch(stats_socket):
+                    source, content = split_message(message)
+                    number = next(stats_numbers)
+                    pending_stats[number] = (source, [None] * self._shards)
+                    for socket in shard_stats_sockets:
+                        socket.send_multipart([str(number).encode(), b'', b''])
+            for shard, socket in enumerate(shard_stats_sockets):
+                if socket not in sockets:
+                    continue
+                for message in self.recv_batch(socket):
+                    source, texts = pending_stats.get(int(message[0].bytes), (None, None))
+                    if texts is None:
+                        continue
+                    texts[shard] = message[-1].bytes.decode()
+                    if all(text is not None for text in texts):
+                        del pending_stats[int(message[0].bytes)]
+                        stats_socket.send_multipart(source + [b'', merge_shards(texts).encode()], copy=False)
@@ -0,0 +1,278 @@
+import hashlib
+import heapq
+import time
+from collections import Counter, OrderedDict
+
+import msgpack
+from requests import codes
+
+from nimbus.helpers import frame_to_bytes
+from nimbus.log import get_logger
+
+logger = get_logger(__name__)
+
+CACHEABLE_METHODS = ('GET', 'LIST')
+
+
+def canonical(obj):
+    """
+    Representation of decoded msgpack data that is the same for equal data, whatever the order of the keys of dicts.
+    :param obj:
+    :return:
+    """
+    if isinstance(obj, dict):
+        return sorted(([canonical(k), canonical(v)] for k, v in obj.items()), key=lambda item: msgpack.packb(item[0]))
+    if isinstance(obj, (list, tuple)):
+        return [canonical(o) for o in obj]
+    return obj
+
+
+def request_key(client_request):
+    """
+    :param client_request:
+    :return: key that is the same for ClientRequests with the same method, endpoint, parameters and data, whether
+    the data is in the body or in the header like clients did before the body frame
+    """
+    content = client_request.content
+    key = [client_request.method, client_request.endpoint, canonical(content.get(b'parameters')),
+           canonical(content.get(b'data'))]
+    if client_request.body is not None:
+        key.append(hashlib.sha1(frame_to_bytes(client_request.body)).digest())
+    return msgpack.packb(key)
+
+
+class CacheEntry:
+    __slots__ = ('expires', 'response')
+
+    def __init__(self, expires, response):
+        self.expires = expires
+        self.response = response
+
+
+class ResponseCache:
+    """
+    Cache of the responses of ClientRequests for idempotent endpoints, in the broker.
+    Workers declare which endpoints can be cached, and for how long, when they register. A response is cached by
+    method, endpoint and parameters, so the ClientRequest does not go to a Worker again until it expires. Responses are
+    evicted in least recently used order when there are more than max_entries, or when they take more than max_bytes.
+    Only successful responses are cached, and never those of ClientRequests with a body.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()  # CacheEntry by key, least recently used first
+        self._bytes = 0
+        self._ttl_by_endpoint = dict()  # (method, endpoint) -> seconds a response stays valid
+        self._counters = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """
+        :return: number of bytes taken by the cached keys and responses
+        """
+        return self._bytes
+
+    @property
+    def counters(self):
+        """
+        :return: dict of counter name -> value: hits, misses and evictions
+        """
+        return dict(self._counters)
+
+    @property
+    def enabled(self):
+        return self._max_entries > 0 and self._max_bytes > 0
+
+    def set_ttl(self, method, endpoint, ttl):
+        """
+        Make the responses of an endpoint cacheable, as declared by a Worker.
+        :param method:
+        :param endpoint:
+        :param ttl: seconds a response stays valid, 0 or None to stop caching
+        :return: None
+        """
+        if method not in CACHEABLE_METHODS:
+            logger.warning('Not caching %s %s: only %s can be cached', method, endpoint, CACHEABLE_METHODS)
+            return
+        if ttl:
+            self._ttl_by_endpoint[(method, endpoint)] = ttl
+        else:
+            self._ttl_by_endpoint.pop((method, endpoint), None)
+
+    def key(self, client_request):
+        """
+        :param client_request:
+        :return: key of the response of the ClientRequest, or None if it cannot be cached
+        """
+        if not self.enabled or client_request.body is not None \
+                or (client_request.method, client_request.endpoint) not in self._ttl_by_endpoint:
+            return None
+        return request_key(client_request)
+
+    def get(self, client_request, now=None):
+        """
+        :param client_request:
+        :param now: unix timestamp, the current time if None
+        :return: msgpack of the response, or None if it is not cached
+        """
+        key = self.key(client_request)
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry.expires <= (time.time() if now is None else now):
+            if entry is not None:
+                self._remove(key)
+            self._counters['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self._counters['hits'] += 1
+        return entry.response
+
+    def put(self, client_request, response, now=None):
+        """
+        Cache the response of a ClientRequest, if it can be cached and was successful.
+        :param client_request:
+        :param response: msgpack of the response as received from the Worker, bytes or zmq.Frame
+        :param now: unix timestamp, the current time if None
+        :return: True if the response was cached
+        """
+        key = self.key(client_request)
+        if key is None:
+            return False
+        response = frame_to_bytes(response)
+        if len(key) + len(response) > self._max_bytes \
+                or msgpack.unpackb(response).get(b'status') != codes.OK:
+            return False
+        if key in self._entries:
+            self._remove(key)
+        ttl = self._ttl_by_endpoint[(client_request.method, client_request.endpoint)]
+        self._entries[key] = CacheEntry((time.time() if now is None else now) + ttl, response)
+        self._bytes += len(key) + len(response)
+        while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._counters['evictions'] += 1
+        return True
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= len(key) + len(entry.response)
+
+
+class CoalescedRequests:
+    __slots__ = ('key', 'leader', 'deadline', 'sources')
+
+    def __init__(self, key, leader, deadline):
+        self.key = key
+        self.leader = leader  # id of the ClientRequest that is dispatched
+        self.deadline = deadline
+        self.sources = []  # sources of the clients that wait for the response of the leader
+
+
+class RequestCoalescer:
+    """
+    Single flight of identical read requests. Workers declare which endpoints can be coalesced when they register.
+    As long as a ClientRequest is pending, identical ClientRequests are not queued: their clients get the response of
+    the first one. The deadline of the first ClientRequest is extended to the deadline of the last client that waits
+    for it. ClientRequests without a deadline are never coalesced, because nothing would clean them up.
+    """
+
+    def __init__(self):
+        self._endpoints = set()  # (method, endpoint) that can be coalesced
+        self._group_by_key = dict()
+        self._group_by_leader = dict()
+        self._expiry = []  # heap of (deadline, leader id), entries are removed lazily
+        self._counters = Counter()
+
+    def __len__(self):
+        return len(self._group_by_leader)
+
+    @property
+    def counters(self):
+        """
+        :return: dict of counter name -> value: the number of coalesced ClientRequests
+        """
+        return dict(self._counters)
+
+    def set_coalesce(self, method, endpoint, coalesce=True):
+        """
+        Make identical ClientRequests for an endpoint share a response, as declared by a Worker.
+        :param method:
+        :param endpoint:
+        :param coalesce:
+        :return: None
+        """
+        if method not in CACHEABLE_METHODS:
+            logger.warning('Not coalescing %s %s: only %s can be coalesced', method, endpoint, CACHEABLE_METHODS)
+            return
+        if coalesce:
+            self._endpoints.add((method, endpoint))
+        else:
+            self._endpoints.discard((method, endpoint))
+
+    def follow(self, client_request, is_pending):
+        """
+        Let a ClientRequest wait for an identical pending ClientRequest, or make it the one the next identical
+        ClientRequests wait for.
+        :param client_request:
+        :param is_pending: function that is True for the id of a ClientRequest that still waits for a response
+        :return: id of the ClientRequest to wait for, None if the ClientRequest has to be queued
+        """
+        if client_request.deadline is None or (client_request.method, client_request.endpoint) not in self._endpoints:
+            return None
+        key = request_key(client_request)
+        group = self._group_by_key.get(key)
+        if group is not None and is_pending(group.leader):
+            group.sources.append(client_request.source)
+            if client_request.deadline > group.deadline:
+                group.deadline = client_request.deadline
+                heapq.heappush(self._expiry, (group.deadline, group.leader))
+            self._counters['coalesced'] += 1
+            return group.leader
+        if group is not None:
+            self._remove(group)
+        group = CoalescedRequests(key, client_request.id, client_request.deadline)
+        self._group_by_key[key] = group
+        self._group_by_leader[client_request.id] = group
+        heapq.heappush(self._expiry, (group.deadline, group.leader))
+        return None
+
+    def deadline(self, client_request_id):
+        """
+        :param client_request_id:
+        :return: latest deadline of the clients that wait for the ClientRequest
+        """
+        return self._group_by_leader[client_request_id].deadline
+
+    def sources(self, client_request_id):
+        """
+        Stop coalescing with a ClientRequest, because its response arrived.
+        :param client_request_id:
+        :return: sources of the other clients that wait for the response
+        """
+        group = self._group_by_leader.get(client_request_id)
+        if group is None:
+            return []
+        self._remove(group)
+        return group.sources
+
+    def expire(self, now=None):
+        """
+        Forget the ClientRequests of which all clients stopped waiting.
+        :param now: unix timestamp, the current time if None
+        :return: None
+        """
+        now = time.time() if now is None else now
+        while len(self._expiry) > 0 and self._expiry[0][0] <= now:
+            deadline, leader = heapq.heappop(self._expiry)
+            group = self._group_by_leader.get(leader)
+            if group is not None and group.deadline <= now:
+                self._remove(group)
+
+    def _remove(self, group):
+        del self._group_by_leader[group.leader]
+        if self._group_by_key.get(group.key) is group:
+            del self._group_by_key[group.key]
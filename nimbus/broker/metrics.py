@@ -0,0 +1,202 @@
+import bisect
+import os
+from collections import Counter
+
+# upper bounds in seconds, from the time of a single poll loop iteration to a slow request
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+PREFIX = 'nimbus_broker_'
+
+
+class Histogram:
+    """
+    Distribution of durations in fixed buckets, in constant time and memory per observation.
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket counts the observations above all bounds
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels=''):
+        """
+        :param name: name of the metric
+        :param labels: labels of the metric, as 'key="value",'
+        :return: list of lines in the Prometheus text format, with cumulative buckets
+        """
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+        labels = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, self.count))
+        return lines
+
+
+def merge_shards(texts):
+    """
+    Merge the metrics of the shards of a ShardedBroker, with the shard as label of every sample.
+    :param texts: list of metrics in the Prometheus text format, one per shard
+    :return: metrics in the Prometheus text format
+    """
+    types = dict()  # name -> TYPE line, in the order of the first shard
+    samples = dict()  # name -> sample lines of all shards
+    for shard, text in enumerate(texts):
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                name = line.split()[2]
+                types.setdefault(name, line)
+                samples.setdefault(name, [])
+            elif line and name is not None:
+                metric, brace, rest = line.partition('{')
+                if brace:
+                    samples[name].append('{}{{shard="{}",{}'.format(metric, shard, rest))
+                else:
+                    metric, value = line.split(' ', 1)
+                    samples[name].append('{}{{shard="{}"}} {}'.format(metric, shard, value))
+    lines = []
+    for name, type_line in types.items():
+        lines.append(type_line)
+        lines += samples[name]
+    return '\n'.join(lines) + '\n'
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def worker_label(worker_id):
+    """
+    :param worker_id: tuple of bytes
+    :return: str
+    """
+    return '.'.join(frame.hex() for frame in worker_id)
+
+
+class BrokerMetrics:
+    """
+    Live metrics of a Broker, kept in memory: how long ClientRequests wait in their RequestQueue and how long the
+    Workers take for them, per endpoint, how busy every Worker is and how long an iteration of the broker loop takes.
+    Only a few additions per ClientRequest; queue depths and counters are collected when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self._wait_by_endpoint = dict()  # endpoint -> Histogram from enqueue to dispatch
+        self._service_by_endpoint = dict()  # endpoint -> Histogram from dispatch to response
+        self._loop = Histogram()
+        self._busy_by_worker = Counter()  # worker id -> seconds spent on ClientRequests
+        self._registered_by_worker = dict()  # worker id -> unix timestamp of the registration
+
+    def _histogram(self, histograms, endpoint):
+        try:
+            return histograms[endpoint]
+        except KeyError:
+            histogram = histograms[endpoint] = Histogram()
+            return histogram
+
+    def registered(self, worker_id, now):
+        self._registered_by_worker[worker_id] = now
+        self._busy_by_worker.pop(worker_id, None)
+
+    def dispatched(self, client_request, now):
+        """
+        :param client_request: ClientRequest that is sent to a Worker
+        :param now: unix timestamp
+        :return: None
+        """
+        self._histogram(self._wait_by_endpoint, client_request.endpoint).observe(now - client_request.received)
+
+    def responded(self, client_request, worker_id, now):
+        """
+        :param client_request: ClientRequest of which the response arrived
+        :param worker_id: Worker that processed the ClientRequest, None if it is not known
+        :param now: unix timestamp
+        :return: None
+        """
+        if client_request.dispatched is None:
+            return
+        duration = now - client_request.dispatched
+        self._histogram(self._service_by_endpoint, client_request.endpoint).observe(duration)
+        if worker_id is not None:
+            self._busy_by_worker[worker_id] += duration
+
+    def loop(self, duration):
+        """
+        :param duration: seconds spent in one iteration of the broker loop, without waiting for messages
+        :return: None
+        """
+        self._loop.observe(duration)
+
+    def render(self, request_manager, counters=None, now=None):
+        """
+        :param request_manager: RequestManager of the Broker, for the queue depths and the Workers
+        :param counters: dict of counter name -> value, e.g. of the RequestManager and the ResponseCache
+        :param now: unix timestamp
+        :return: metrics in the Prometheus text format
+        """
+        lines = ['# TYPE {}queue_depth gauge'.format(PREFIX)]
+        for endpoint, depth in sorted(request_manager.queue_depths().items()):
+            lines.append('{}queue_depth{{endpoint="{}"}} {}'.format(PREFIX, _label(endpoint), depth))
+
+        for name, histograms in [('wait_seconds', self._wait_by_endpoint),
+                                 ('service_seconds', self._service_by_endpoint)]:
+            lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+            for endpoint, histogram in sorted(histograms.items()):
+                lines += histogram.lines(PREFIX + name, 'endpoint="{}",'.format(_label(endpoint)))
+
+        lines.append('# TYPE {}loop_seconds histogram'.format(PREFIX))
+        lines += self._loop.lines(PREFIX + 'loop_seconds')
+
+        workers = request_manager.registered_workers
+        for worker_id in list(self._registered_by_worker):
+            if worker_id not in workers:
+                del self._registered_by_worker[worker_id]
+                self._busy_by_worker.pop(worker_id, None)
+        values_by_worker = dict()
+        for worker_id in sorted(workers):
+            capacity = request_manager.capacity(worker_id)
+            busy = self._busy_by_worker.get(worker_id, 0.0)
+            # the share of the time that the credit of the Worker was in use, since its registration
+            registered = now - self._registered_by_worker.get(worker_id, now) if now is not None else 0
+            utilisation = busy / (registered * capacity) if registered > 0 and capacity > 0 else 0.0
+            values_by_worker[worker_label(worker_id)] = {'worker_in_flight': request_manager.in_flight(worker_id),
+                                                         'worker_credit': request_manager.credit(worker_id),
+                                                         'worker_busy_seconds_total': busy,
+                                                         'worker_utilisation': '{:.6f}'.format(utilisation)}
+        for name, type_ in [('worker_in_flight', 'gauge'),
+                            ('worker_credit', 'gauge'),
+                            ('worker_busy_seconds_total', 'counter'),
+                            ('worker_utilisation', 'gauge')]:
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, type_))
+            for label, values in values_by_worker.items():
+                lines.append('{}{}{{worker="{}"}} {}'.format(PREFIX, name, label, values[name]))
+
+        for name, value in sorted((counters or {}).items()):
+            lines.append('# TYPE {}{}_total counter'.format(PREFIX, name))
+            lines.append('{}{}_total {}'.format(PREFIX, name, value))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def write(text, path):
+        """
+        Write the rendered metrics to a file at once, so a scraper never reads half of them.
+        :param text:
+        :param path:
+        :return: None
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
@@ -0,0 +1,59 @@
+import os
+import zlib
+
+SHARD_SEPARATOR = '.'
+SHARD_DIRECTORY_PREFIX = 'shard-'
+
+
+def shard_of(endpoint, shards):
+    """
+    Shard that owns the RequestQueue of an endpoint. Stable across processes and restarts, unlike hash().
+    :param endpoint: str
+    :param shards: number of shards
+    :return: int
+    """
+    return zlib.crc32(endpoint.encode()) % shards
+
+
+def request_id_prefix(shard):
+    """
+    Prefix of the ids of the ClientRequests created by a shard, so that responses can be routed back to it.
+    :param shard:
+    :return: str
+    """
+    return '{}{}'.format(shard, SHARD_SEPARATOR)
+
+
+def shard_of_request(client_request_id):
+    """
+    :param client_request_id: str
+    :return: shard that created the ClientRequest, or None if the id has no shard prefix
+    """
+    shard, separator, _ = client_request_id.partition(SHARD_SEPARATOR)
+    if not separator:
+        return None
+    return int(shard)
+
+
+def shard_storage_path(storage_path, shard):
+    """
+    :param storage_path: directory of the log storage of the ShardedBroker
+    :param shard:
+    :return: directory of the log storage of the shard
+    """
+    return os.path.join(storage_path, '{}{}'.format(SHARD_DIRECTORY_PREFIX, shard))
+
+
+def shard_storage_paths(storage_path):
+    """
+    :param storage_path: directory of the log storage of the ShardedBroker
+    :return: dict of shard -> directory, of the shards that have a log storage in storage_path
+    """
+    if not os.path.isdir(storage_path):
+        return {}
+    paths = {}
+    for name in os.listdir(storage_path):
+        shard = name[len(SHARD_DIRECTORY_PREFIX):]
+        if name.startswith(SHARD_DIRECTORY_PREFIX) and shard.isdigit():
+            paths[int(shard)] = os.path.join(storage_path, name)
+    return paths
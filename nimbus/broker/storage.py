@@ -0,0 +1,550 @@
+import mmap
+import os
+import struct
+import zlib
+
+from redis import StrictRedis
+
+from nimbus.log import get_logger
+
+logger = get_logger(__name__)
+
+STORAGE_MEMORY = 'memory'
+STORAGE_REDIS = 'redis'
+STORAGE_LOG = 'log'
+
+
+class Storage:
+    """
+    Durable copy of the ClientRequests of all RequestQueues, to recover them after a restart of the broker.
+    The RequestQueues keep the ClientRequests in memory, the storage is only read after a restart.
+    Requests are identified by the id of their RequestQueue and their own id.
+    """
+
+    def add(self, queue_id, request_id, client_request, timestamp):
+        """
+        Store a ClientRequest that was appended to a RequestQueue.
+        :param queue_id:
+        :param request_id:
+        :param client_request:
+        :param timestamp:
+        :return: None
+        """
+        raise NotImplementedError
+
+    def get(self, queue_id, request_id):
+        """
+        :param queue_id:
+        :param request_id:
+        :return: cached_data of the ClientRequest, or None if it is not stored
+        """
+        raise NotImplementedError
+
+    def get_many(self, queue_id, request_ids):
+        """
+        :param queue_id:
+        :param request_ids: list of request ids
+        :return: list of the cached_data of the ClientRequests, None for those that are not stored
+        """
+        return [self.get(queue_id, request_id) for request_id in request_ids]
+
+    def processing(self, queue_id, request_id):
+        """
+        Mark a ClientRequest as being processed by a worker.
+        :param queue_id:
+        :param request_id:
+        :return: None
+        """
+        raise NotImplementedError
+
+    def waiting(self, queue_id, request_id):
+        """
+        Mark a ClientRequest that was being processed as waiting again, e.g. because its worker is gone.
+        :param queue_id:
+        :param request_id:
+        :return: None
+        """
+        raise NotImplementedError
+
+    def remove(self, queue_id, request_id):
+        """
+        Remove a ClientRequest, because it was completed or cancelled.
+        :param queue_id:
+        :param request_id:
+        :return: None
+        """
+        raise NotImplementedError
+
+    def load(self, select=None):
+        """
+        Find all stored ClientRequests. ClientRequests that were being processed are waiting again.
+        :param select: function that is True for the ids of the queues to load, all queues are loaded if None
+        :return: dict of queue_id to (list of request ids, list of timestamps), ordered by timestamp
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Make all writes durable. Called once per iteration of the broker loop.
+        :return: None
+        """
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryStorage(Storage):
+    """
+    No storage at all: the RequestQueues only live in memory and are lost when the broker stops.
+    """
+
+    def add(self, queue_id, request_id, client_request, timestamp):
+        pass
+
+    def get(self, queue_id, request_id):
+        return None
+
+    def processing(self, queue_id, request_id):
+        pass
+
+    def waiting(self, queue_id, request_id):
+        pass
+
+    def remove(self, queue_id, request_id):
+        pass
+
+    def load(self, select=None):
+        return {}
+
+
+class RedisBatch:
+    """
+    Buffer redis writes in a single pipeline, so that they are sent to redis in one round trip.
+    """
+
+    def __init__(self, redis, autoflush=False):
+        self._redis = redis
+        self._pipeline = redis.pipeline(transaction=False)
+        self._autoflush = autoflush
+
+    def __len__(self):
+        return len(self._pipeline)
+
+    @property
+    def redis(self):
+        return self._redis
+
+    @property
+    def pipeline(self):
+        return self._pipeline
+
+    def commit(self):
+        """
+        Mark the end of an operation. The buffered writes are only sent immediately when autoflush is enabled.
+        :return: None
+        """
+        if self._autoflush:
+            self.flush()
+
+    def flush(self):
+        """
+        Send all buffered writes to redis.
+        :return: None
+        """
+        if len(self._pipeline) > 0:
+            self._pipeline.execute()
+
+    def get(self, key):
+        """
+        Send all buffered writes and read key, in the same round trip.
+        :param key:
+        :return: bytes or None
+        """
+        self._pipeline.get(key)
+        return self._pipeline.execute()[-1]
+
+    def mget(self, keys):
+        """
+        Send all buffered writes and read the keys, in the same round trip.
+        :param keys:
+        :return: list of bytes or None
+        """
+        self._pipeline.mget(keys)
+        return self._pipeline.execute()[-1]
+
+
+class RedisStorage(Storage):
+    """
+    Store the ClientRequests in redis. All writes go through a RedisBatch.
+    Every ClientRequest has a key for its content, status and timestamp. Every RequestQueue has a sorted set with the
+    ids of its ClientRequests, scored by timestamp, and a set with the ids of the ClientRequests being processed.
+    """
+
+    STATUS_WAITING = 'waiting'
+    STATUS_PROCESSING = 'processing'
+    KEY_PREFIX = 'broker:'
+    KEY_SUFFIX_INDEX = ':requests'
+
+    # return a sorted set as one string: parsing a single reply is much faster than parsing a reply per element
+    LUA_JOIN_SORTED_SET = "return table.concat(redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES'), ' ')"
+
+    def __init__(self, batch, prefix=KEY_PREFIX):
+        """
+        :param batch: RedisBatch
+        :param prefix: prefix of all keys, e.g. to keep the ClientRequests of several brokers apart
+        """
+        self._batch = batch
+        self._prefix = prefix
+
+    @classmethod
+    def connect(cls, redis_host, redis_port, redis_db, autoflush=False, prefix=KEY_PREFIX):
+        return cls(RedisBatch(StrictRedis(host=redis_host, port=redis_port, db=redis_db), autoflush=autoflush),
+                   prefix=prefix)
+
+    @property
+    def batch(self):
+        return self._batch
+
+    def generate_key_content(self, queue_id, request_id):
+        return self._prefix + queue_id + ':request:content:' + request_id
+
+    def generate_key_status(self, queue_id, request_id):
+        return self._prefix + queue_id + ':request:status:' + request_id
+
+    def generate_key_timestamp(self, queue_id, request_id):
+        return self._prefix + queue_id + ':request:timestamp:' + request_id
+
+    def generate_key_index(self, queue_id):
+        """
+        Sorted set of the ids of all ClientRequests in the queue or being processed, scored by timestamp.
+        """
+        return self._prefix + queue_id + self.KEY_SUFFIX_INDEX
+
+    def generate_key_processing(self, queue_id):
+        """
+        Set of the ids of all ClientRequests that are being processed.
+        """
+        return self._prefix + queue_id + ':processing'
+
+    def queue_id_from_key_index(self, key_index):
+        return key_index[len(self._prefix):-len(self.KEY_SUFFIX_INDEX)]
+
+    def add(self, queue_id, request_id, client_request, timestamp):
+        self._batch.pipeline.mset({self.generate_key_content(queue_id, request_id): client_request.cached_data,
+                                   self.generate_key_status(queue_id, request_id): self.STATUS_WAITING,
+                                   self.generate_key_timestamp(queue_id, request_id): timestamp})
+        # execute_command, because the signature of zadd differs between versions of redis-py
+        self._batch.pipeline.execute_command('ZADD', self.generate_key_index(queue_id), timestamp, request_id)
+        self._batch.commit()
+
+    def get(self, queue_id, request_id):
+        return self._batch.get(self.generate_key_content(queue_id, request_id))
+
+    def get_many(self, queue_id, request_ids):
+        """
+        All ClientRequests are read in a single round trip.
+        """
+        if len(request_ids) == 0:
+            return []
+        return self._batch.mget([self.generate_key_content(queue_id, request_id) for request_id in request_ids])
+
+    def processing(self, queue_id, request_id):
+        self._batch.pipeline.set(self.generate_key_status(queue_id, request_id), self.STATUS_PROCESSING)
+        self._batch.pipeline.sadd(self.generate_key_processing(queue_id), request_id)
+        self._batch.commit()
+
+    def waiting(self, queue_id, request_id):
+        self._batch.pipeline.set(self.generate_key_status(queue_id, request_id), self.STATUS_WAITING)
+        self._batch.pipeline.srem(self.generate_key_processing(queue_id), request_id)
+        self._batch.commit()
+
+    def remove(self, queue_id, request_id):
+        self._batch.pipeline.delete(self.generate_key_content(queue_id, request_id),
+                                    self.generate_key_status(queue_id, request_id),
+                                    self.generate_key_timestamp(queue_id, request_id))
+        self._batch.pipeline.zrem(self.generate_key_index(queue_id), request_id)
+        self._batch.pipeline.srem(self.generate_key_processing(queue_id), request_id)
+        self._batch.commit()
+
+    def load(self, select=None):
+        """
+        All RequestQueues are found with SCAN and read in a single pipeline.
+        """
+        redis = self._batch.redis
+        self._batch.flush()
+
+        queue_ids = [self.queue_id_from_key_index(key.decode())
+                     for key in redis.scan_iter(match=self._prefix + '*' + self.KEY_SUFFIX_INDEX, count=1000)]
+        if select is not None:
+            queue_ids = [queue_id for queue_id in queue_ids if select(queue_id)]
+        pipeline = redis.pipeline(transaction=False)
+        for queue_id in queue_ids:
+            pipeline.eval(self.LUA_JOIN_SORTED_SET, 1, self.generate_key_index(queue_id))
+            pipeline.smembers(self.generate_key_processing(queue_id))
+        results = pipeline.execute()
+
+        requests = {}
+        for i, queue_id in enumerate(queue_ids):
+            ids_and_timestamps = results[2 * i].decode().split()
+            requests[queue_id] = (ids_and_timestamps[0::2], list(map(float, ids_and_timestamps[1::2])))
+            processing = results[2 * i + 1]
+            if len(processing) > 0:
+                self._batch.pipeline.mset(dict((self.generate_key_status(queue_id, id_.decode()), self.STATUS_WAITING)
+                                               for id_ in processing))
+                self._batch.pipeline.delete(self.generate_key_processing(queue_id))
+        self._batch.flush()
+        return requests
+
+    def flush(self):
+        self._batch.flush()
+
+
+class LogSegment:
+    """
+    A preallocated, memory-mapped file of LogStorage. Records are appended until the segment is full.
+    """
+
+    FILENAME = 'segment-{:010d}.log'
+
+    def __init__(self, directory, number, size=None):
+        self.number = number
+        self.path = os.path.join(directory, self.FILENAME.format(number))
+        if size is None:
+            self._file = open(self.path, 'r+b')
+        else:
+            self._file = open(self.path, 'w+b')
+            self._file.truncate(size)
+        self.mmap = mmap.mmap(self._file.fileno(), 0)
+        self.position = 0  # end of the written records
+        self.keys = set()  # (queue_id, request_id) of the requests that are added in this segment and still stored
+        self.added = 0  # number of requests that were ever added in this segment
+
+    def __len__(self):
+        return len(self.mmap)
+
+    def fits(self, size):
+        return self.position + size <= len(self.mmap)
+
+    def write(self, data):
+        """
+        :param data:
+        :return: offset of data in the segment
+        """
+        offset = self.position
+        self.mmap[offset:offset + len(data)] = data
+        self.position += len(data)
+        return offset
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.mmap.close()
+        self._file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class LogStorage(Storage):
+    """
+    Store the ClientRequests in a local append-only log, without a network round trip.
+    The log consists of memory-mapped segments. Writes are made durable in batches: once per iteration of the broker
+    loop, when flush is called. The oldest segment is compacted when less than compaction_ratio of the requests that
+    were added in it are still stored: those are appended again and the segment is deleted. Only the oldest segment is
+    compacted, so a removal can never be lost while the original request is still in the log.
+    Every record starts with a CRC32 of the rest of the record. A record that was only partly written when the broker
+    stopped fails the check, and the segment is truncated before it.
+    """
+
+    # CRC32 of the header, the ids and the cached data
+    RECORD_CHECKSUM = struct.Struct('<I')
+    # type, length of queue id, length of request id, timestamp, length of cached data
+    RECORD_HEADER = struct.Struct('<BHHdI')
+    RECORD_ADD = 1
+    RECORD_REMOVE = 2
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, compaction_ratio=0.5):
+        self._path = path
+        self._segment_size = segment_size
+        self._compaction_ratio = compaction_ratio
+        self._segments = []  # in order of creation
+        self._index = dict()  # (queue_id, request_id) -> (segment, offset, length, timestamp)
+        self._dirty = set()  # segments with writes that are not flushed yet
+
+        os.makedirs(path, exist_ok=True)
+        for number in self.segment_numbers(path):
+            segment = LogSegment(path, number)
+            self._segments.append(segment)
+            self._replay(segment)
+        if len(self._segments) == 0:
+            self._new_segment(self._segment_size)
+
+    @staticmethod
+    def segment_numbers(path):
+        """
+        :param path: 
+        :return: sorted numbers of the segments of the log in path, empty if there is no log
+        """
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(name[len('segment-'):-len('.log')])
+                      for name in os.listdir(path)
+                      if name.startswith('segment-') and name.endswith('.log'))
+
+    def _replay(self, segment):
+        checksum_size = self.RECORD_CHECKSUM.size
+        header_size = self.RECORD_HEADER.size
+        position = 0
+        while position + checksum_size + header_size <= len(segment):
+            checksum, = self.RECORD_CHECKSUM.unpack_from(segment.mmap, position)
+            type_, queue_id_length, request_id_length, timestamp, length = \
+                self.RECORD_HEADER.unpack_from(segment.mmap, position + checksum_size)
+            if checksum == 0 and type_ == 0:
+                # end of the written records, the rest of the segment is still empty
+                break
+            end = position + checksum_size + header_size + queue_id_length + request_id_length + length
+            if end > len(segment) or zlib.crc32(segment.mmap[position + checksum_size:end]) != checksum:
+                logger.warning('Truncating %s at %s after a partly written record', segment.path, position)
+                segment.mmap[position:] = bytes(len(segment) - position)
+                segment.flush()
+                break
+            position += checksum_size + header_size
+            queue_id = segment.mmap[position:position + queue_id_length].decode()
+            position += queue_id_length
+            request_id = segment.mmap[position:position + request_id_length].decode()
+            position += request_id_length
+            key = (queue_id, request_id)
+            if type_ == self.RECORD_ADD:
+                # added again by a compaction that stopped before it deleted the segment with the original
+                self._discard(key)
+                self._index[key] = (segment, position, length, timestamp)
+                segment.keys.add(key)
+                segment.added += 1
+            else:
+                self._discard(key)
+            position += length
+        segment.position = position
+
+    def _new_segment(self, size):
+        number = self._segments[-1].number + 1 if len(self._segments) > 0 else 0
+        segment = LogSegment(self._path, number, size)
+        self._segments.append(segment)
+        return segment
+
+    def _append(self, type_, queue_id, request_id, timestamp=0.0, data=b''):
+        queue_id = queue_id.encode()
+        request_id = request_id.encode()
+        record = self.RECORD_HEADER.pack(type_, len(queue_id), len(request_id), timestamp, len(data)) \
+            + queue_id + request_id + data
+        record = self.RECORD_CHECKSUM.pack(zlib.crc32(record)) + record
+        segment = self._segments[-1]
+        if not segment.fits(len(record)):
+            segment = self._new_segment(max(self._segment_size, len(record)))
+        offset = segment.write(record)
+        self._dirty.add(segment)
+        return segment, offset + len(record) - len(data)
+
+    def _discard(self, key):
+        try:
+            segment, offset, length, timestamp = self._index.pop(key)
+        except KeyError:
+            return
+        segment.keys.discard(key)
+
+    def add(self, queue_id, request_id, client_request, timestamp):
+        data = client_request.cached_data
+        segment, offset = self._append(self.RECORD_ADD, queue_id, request_id, timestamp, data)
+        key = (queue_id, request_id)
+        self._index[key] = (segment, offset, len(data), timestamp)
+        segment.keys.add(key)
+        segment.added += 1
+
+    def get(self, queue_id, request_id):
+        try:
+            segment, offset, length, timestamp = self._index[(queue_id, request_id)]
+        except KeyError:
+            return None
+        return segment.mmap[offset:offset + length]
+
+    def processing(self, queue_id, request_id):
+        # not logged: requests that were being processed are waiting again after a restart anyway
+        pass
+
+    def waiting(self, queue_id, request_id):
+        pass
+
+    def remove(self, queue_id, request_id):
+        key = (queue_id, request_id)
+        if key not in self._index:
+            return
+        self._append(self.RECORD_REMOVE, queue_id, request_id)
+        self._discard(key)
+
+    def load(self, select=None):
+        requests = {}
+        for (queue_id, request_id), (segment, offset, length, timestamp) in self._index.items():
+            if select is not None and not select(queue_id):
+                continue
+            requests.setdefault(queue_id, []).append((timestamp, request_id))
+        loaded = {}
+        for queue_id, timestamps_and_ids in requests.items():
+            timestamps_and_ids.sort()
+            loaded[queue_id] = ([request_id for timestamp, request_id in timestamps_and_ids],
+                                [timestamp for timestamp, request_id in timestamps_and_ids])
+        return loaded
+
+    def flush(self):
+        for segment in self._dirty:
+            segment.flush()
+        self._dirty.clear()
+        self._compact()
+
+    def _compact(self):
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            if len(oldest.keys) >= self._compaction_ratio * oldest.added:
+                return
+            for key in list(oldest.keys):
+                segment, offset, length, timestamp = self._index[key]
+                data = segment.mmap[offset:offset + length]
+                new_segment, new_offset = self._append(self.RECORD_ADD, key[0], key[1], timestamp, data)
+                self._index[key] = (new_segment, new_offset, length, timestamp)
+                new_segment.keys.add(key)
+                new_segment.added += 1
+            # the copies must be durable before the original is deleted
+            for segment in self._dirty:
+                segment.flush()
+            self._dirty.clear()
+            logger.debug('Compacted log segment %s with %s of %s requests left',
+                         oldest.number, len(oldest.keys), oldest.added)
+            self._segments.pop(0)
+            oldest.delete()
+
+    def close(self):
+        self.flush()
+        for segment in self._segments:
+            segment.close()
+
+
+def create_storage(storage, redis_host=None, redis_port=None, redis_db=None, path=None, namespace=None):
+    """
+    Create the storage that is selected in the configuration.
+    :param storage: STORAGE_MEMORY, STORAGE_REDIS or STORAGE_LOG
+    :param redis_host:
+    :param redis_port:
+    :param redis_db:
+    :param path: directory of the log, for STORAGE_LOG
+    :param namespace: keeps the ClientRequests apart from those of other brokers on the same redis or path
+    :return: Storage
+    """
+    if storage == STORAGE_MEMORY:
+        return MemoryStorage()
+    elif storage == STORAGE_REDIS:
+        prefix = RedisStorage.KEY_PREFIX if namespace is None else namespace + ':'
+        return RedisStorage.connect(redis_host, redis_port, redis_db, prefix=prefix)
+    elif storage == STORAGE_LOG:
+        return LogStorage(path if namespace is None else os.path.join(path, namespace))
+    raise ValueError('Unknown storage {}'.format(storage))
@@ -1,69 +1,563 @@
+import asyncio
+import contextlib
+import itertools
+import struct
+import threading
+import time
 from collections import namedtuple
 
 import msgpack
 import zmq
+import zmq.asyncio
 
-from nimbus.helpers import decode, get_data_from_zmq
+from nimbus.cluster import Cluster, HashRing
+from nimbus.helpers import decode, get_data_from_zmq, split_message
 from nimbus.log import get_logger
 
 ZMQ_TIMEOUT_SEC = 10
+PIPELINE_WINDOW = 100  # requests of a Pipeline that wait for their response at the same time
+POOL_SIZE = 10  # Clients of a ClientPool
+SECONDS_BEFORE_CLUSTER_REFRESH = 10
 
 logger = get_logger(__name__)
 
 Response = namedtuple('Response', ['response', 'status_code'])
 
 
-class Client:
+def pack_request(method, endpoint, parameters, data, timeout):
+    """
+    :param method: 
+    :param endpoint: 
+    :param parameters: dict, or None
+    :param data: dict, or None
+    :param timeout: seconds the client waits for the response
+    :return: list of frames of the request, without the envelope
+    """
+    header = {
+        'method': method,
+        'endpoint': endpoint,
+        # the broker and worker drop the request once the client stopped waiting for it
+        'deadline': time.time() + timeout,
+    }
+
+    if parameters:
+        header['parameters'] = parameters
+
+    # the data is sent in a separate frame, which the broker forwards to the worker without decoding it
+    message = [msgpack.packb(header)]
+    if data:
+        message.append(msgpack.packb(data))
+    return message
+
+
+def unpack_response(zmq_response, decode_response=True):
+    """
+    :param zmq_response: the response frame
+    :param decode_response: if True, decode the bytes in the response to str
+    :return: Response
+    """
+    zmq_response = msgpack.unpackb(zmq_response)
+    if decode_response:
+        return Response(decode(zmq_response[b'response']),
+                        decode(zmq_response[b'status']))
+    return Response(zmq_response[b'response'],
+                    zmq_response[b'status'])
+
+
+class RequestMethods:
+    """
+    A request per method, for the classes that implement send_and_recv.
+    """
+
+    def get(self, endpoint, parameters=None, data=None, decode_response=True):
+        return self.send_and_recv('GET', endpoint, parameters, data, decode_response)
+
+    def list(self, endpoint, parameters=None, data=None, decode_response=True):
+        return self.send_and_recv('LIST', endpoint, parameters, data, decode_response)
+
+    def post(self, endpoint, parameters=None, data=None, decode_response=True):
+        return self.send_and_recv('POST', endpoint, parameters, data, decode_response)
+
+    def patch(self, endpoint, parameters=None, data=None, decode_response=True):
+        return self.send_and_recv('PATCH', endpoint, parameters, data, decode_response)
+
+    def delete(self, endpoint, parameters=None, data=None, decode_response=True):
+        return self.send_and_recv('DELETE', endpoint, parameters, data, decode_response)
+
+
+class PipelineMethods:
+    """
+    Pipelines of requests, for the classes that implement correlation_id and pipeline_socket, and have a _timeout in
+    milliseconds.
+    """
+
+    def pipeline(self, window=PIPELINE_WINDOW):
+        """
+        :param window: number of requests that wait for their response at the same time, a request is only sent
+        when there is room in the window
+        :return: Pipeline
+        """
+        return Pipeline(self, window=window)
+
+    def send_many(self, requests, window=PIPELINE_WINDOW, decode_response=True):
+        """
+        Send requests without waiting for the response of the previous one.
+        :param requests: iterable of (method, endpoint) or (method, endpoint, parameters, data)
+        :param window: number of requests that wait for their response at the same time
+        :param decode_response: 
+        :return: list of Response, in the order of the requests
+        """
+        with self.pipeline(window=window) as pipeline:
+            for request in requests:
+                method, endpoint, parameters, data = (tuple(request) + (None, None))[:4]
+                pipeline.send_and_recv(method, endpoint, parameters, data, decode_response)
+            return pipeline.execute()
+
+
+class Client(RequestMethods, PipelineMethods):
     def __init__(self,
                  connect,
                  timeout=None):
         self._context = zmq.Context.instance()
         self._socket = self._context.socket(zmq.REQ)
         self._socket.connect(connect)
+        self._connect = connect
+        self._waiting = False  # True between sending a request and receiving its response
+        self._pipeline_socket = None  # DEALER socket of the pipelines, connected by the first pipeline
+        # ids of the requests of all pipelines, which share the socket, so a late response never matches another request
+        self._correlation_ids = itertools.count()
         if not timeout:
             self._timeout = ZMQ_TIMEOUT_SEC * 1000
         else:
             self._timeout = timeout * 1000
 
-    def send_and_recv(self, method, endpoint, parameters=None, data=None, decode_response=True):
-        logger.debug('Request: {} {}'.format(method, endpoint))
-        message = {
-            'method': method,
-            'endpoint': endpoint,
-        }
+    @property
+    def healthy(self):
+        """
+        :return: False if the socket of the Client cannot send a request, e.g. because an exception interrupted the
+        previous request before its response was received
+        """
+        return not self._waiting and not self._socket.closed
+
+    def reset(self):
+        """
+        Replace the socket of the Client by a new one, dropping the response of the previous request.
+        :return: None
+        """
+        logger.info('Resetting client socket to %s', self._connect)
+        self._socket.close(linger=0)
+        self._socket = self._context.socket(zmq.REQ)
+        self._socket.connect(self._connect)
+        self._waiting = False
 
-        if parameters:
-            message['parameters'] = parameters
+    def correlation_id(self):
+        """
+        :return: id of a request of a Pipeline, unique for the Client
+        """
+        return struct.pack('>Q', next(self._correlation_ids))
 
-        if data:
-            message['data'] = data
+    def pipeline_socket(self, endpoint):
+        """
+        :param endpoint: 
+        :return: DEALER socket on which a Pipeline sends the requests for the endpoint
+        """
+        if self._pipeline_socket is None:
+            self._pipeline_socket = self._context.socket(zmq.DEALER)
+            self._pipeline_socket.connect(self._connect)
+        return self._pipeline_socket
 
-        self._socket.send(msgpack.packb(message))
+    def send_and_recv(self, method, endpoint, parameters=None, data=None, decode_response=True):
+        logger.debug('Request: %s %s', method, endpoint)
+        self._socket.send_multipart(pack_request(method, endpoint, parameters, data, self._timeout / 1000.0))
+        self._waiting = True
         zmq_response = get_data_from_zmq(self._socket, self._timeout)
-        zmq_response = msgpack.unpackb(zmq_response)
-        if decode_response:
-            response = Response(decode(zmq_response[b'response']),
-                                decode(zmq_response[b'status']))
-        else:
-            response = Response(zmq_response[b'response'],
-                                zmq_response[b'status'])
-        logger.debug('Response: {} - {}'.format(str(response.status_code), str(response.response)))
+        if zmq_response == {}:
+            # a REQ socket cannot send again before it received the response
+            self.reset()
+            raise TimeoutError('No response for {} {} within {} ms'.format(method, endpoint, self._timeout))
+        self._waiting = False
+        response = unpack_response(zmq_response, decode_response)
+        logger.debug('Response: %s - %s', response.status_code, response.response)
         return response
 
-    def get(self, endpoint, parameters=None, data=None, decode_response=True):
-        return self.send_and_recv('GET', endpoint, parameters, data, decode_response)
+    def close(self):
+        self._socket.close()
+        if self._pipeline_socket is not None:
+            self._pipeline_socket.close()
 
-    def list(self, endpoint, parameters=None, data=None, decode_response=True):
-        return self.send_and_recv('LIST', endpoint, parameters, data, decode_response)
 
-    def post(self, endpoint, parameters=None, data=None, decode_response=True):
-        return self.send_and_recv('POST', endpoint, parameters, data, decode_response)
+class Pipeline(RequestMethods):
+    """
+    Requests of a Client that are sent without waiting for the response of the previous one. The methods of the
+    Client send a request and return None, execute returns the responses in the order of the requests:
 
-    def patch(self, endpoint, parameters=None, data=None, decode_response=True):
-        return self.send_and_recv('PATCH', endpoint, parameters, data, decode_response)
+        with client.pipeline() as pipeline:
+            for endpoint in endpoints:
+                pipeline.get(endpoint)
+            responses = pipeline.execute()
 
-    def delete(self, endpoint, parameters=None, data=None, decode_response=True):
-        return self.send_and_recv('DELETE', endpoint, parameters, data, decode_response)
+    At most window requests wait for their response at the same time: a request waits for the oldest responses
+    when the window is full. The requests carry a correlation id in their envelope, so responses that arrive after
+    the pipeline gave up on them are recognized and dropped.
+    """
+
+    def __init__(self, client, window=PIPELINE_WINDOW):
+        """
+        :param client: Client
+        :param window: number of requests that wait for their response at the same time
+        """
+        self._client = client
+        self._window = max(window, 1)
+        self._timeout = client._timeout
+        self._pending = dict()  # correlation id -> (index of the request, decode_response)
+        self._responses = []  # Response or None per request, in the order of the requests
+        self._poller = zmq.Poller()
+        self._sockets = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def send_and_recv(self, method, endpoint, parameters=None, data=None, decode_response=True):
+        while len(self._pending) >= self._window:
+            self._recv()
+
+        socket = self._client.pipeline_socket(endpoint)
+        if socket not in self._sockets:
+            self._sockets.add(socket)
+            self._poller.register(socket, zmq.POLLIN)
+
+        logger.debug('Request: %s %s', method, endpoint)
+        correlation_id = self._client.correlation_id()
+        socket.send_multipart([correlation_id, b''] +
+                              pack_request(method, endpoint, parameters, data, self._timeout / 1000.0))
+        self._pending[correlation_id] = (len(self._responses), decode_response)
+        self._responses.append(None)
+
+    def _recv(self):
+        """
+        Wait for the response of any pending request.
+        :return: None
+        """
+        sockets = dict(self._poller.poll(self._timeout))
+        if len(sockets) == 0:
+            raise TimeoutError('No response for {} requests within {} ms'.format(len(self._pending), self._timeout))
+        for socket in sockets:
+            while True:
+                try:
+                    source, content = split_message(socket.recv_multipart(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+                try:
+                    index, decode_response = self._pending.pop(source[0])
+                except KeyError:
+                    logger.debug('Dropping response without request')
+                    continue
+                self._responses[index] = unpack_response(content[0], decode_response)
+
+    def execute(self):
+        """
+        Wait for the responses of all requests.
+        :return: list of Response, in the order of the requests
+        """
+        while len(self._pending) > 0:
+            self._recv()
+        responses = self._responses
+        self._responses = []
+        return responses
+
+    def reset(self):
+        """
+        Forget the requests that are waiting for their response.
+        :return: None
+        """
+        self._pending.clear()
+        self._responses = []
 
     def close(self):
-        self._socket.close()
+        self.reset()
+
+
+class ClientPool:
+    """
+    Clients to share between threads. A thread checks out a Client, which no other thread uses until it is checked
+    in again:
+
+        with pool.client() as client:
+            client.get(endpoint)
+
+    The pool creates at most size Clients, when they are needed. A checkout waits when all of them are in use. A
+    Client that is checked in while it is not healthy, e.g. because its thread got an exception while it waited for a
+    response, gets a new socket. A Client resets its socket itself when a request timed out.
+    """
+
+    def __init__(self,
+                 connect,
+                 size=POOL_SIZE,
+                 timeout=None):
+        """
+        :param connect: 
+        :param size: maximum number of Clients
+        :param timeout: timeout of the Clients, in seconds
+        """
+        self._connect = connect
+        self._size = size
+        self._timeout = timeout
+        self._idle = []  # Clients that are checked in, list.pop and list.append are atomic
+        self._created = 0  # number of Clients that exist, idle or checked out
+        self._waiting = 0  # number of threads that wait for a Client
+        self._condition = threading.Condition()
+        self._closed = False
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        """
+        :return: number of Clients that are checked in
+        """
+        return len(self._idle)
+
+    def checkout(self, timeout=None):
+        """
+        :param timeout: seconds to wait for a Client when all of them are in use, or None to wait until one is
+        checked in
+        :return: Client, to check in when the thread is done with it
+        """
+        try:
+            return self._idle.pop()
+        except IndexError:
+            pass
+
+        with self._condition:
+            self._waiting += 1
+            try:
+                while True:
+                    if self._closed:
+                        raise RuntimeError('ClientPool is closed')
+                    try:
+                        return self._idle.pop()
+                    except IndexError:
+                        pass
+                    if self._created < self._size:
+                        self._created += 1
+                        break
+                    if not self._condition.wait(timeout):
+                        raise TimeoutError('No client available within {} seconds'.format(timeout))
+            finally:
+                self._waiting -= 1
+
+        try:
+            return Client(connect=self._connect, timeout=self._timeout)
+        except:
+            with self._condition:
+                self._created -= 1
+                self._condition.notify()
+            raise
+
+    def checkin(self, client):
+        """
+        :param client: Client that was checked out
+        :return: None
+        """
+        if self._closed:
+            client.close()
+            return
+        if not client.healthy:
+            client.reset()
+        self._idle.append(client)
+        if self._waiting > 0:
+            with self._condition:
+                self._condition.notify()
+
+    @contextlib.contextmanager
+    def client(self, timeout=None):
+        """
+        :param timeout: seconds to wait for a Client when all of them are in use
+        :return: context manager that checks out a Client and checks it in again
+        """
+        client = self.checkout(timeout)
+        try:
+            yield client
+        finally:
+            self.checkin(client)
+
+    def close(self):
+        """
+        Close the Clients that are checked in, the others are closed when they are checked in.
+        :return: None
+        """
+        with self._condition:
+            self._closed = True
+            while len(self._idle) > 0:
+                self._idle.pop().close()
+            self._condition.notify_all()
+
+
+class AsyncClient:
+    """
+    Client for asyncio. Any number of requests can wait for their response at the same time: they share a DEALER
+    socket, and every request carries a correlation id in its envelope, which the broker sends back with the response.
+    The responses resolve the futures of their requests in the order they arrive.
+    """
+
+    def __init__(self,
+                 connect,
+                 timeout=None):
+        """
+        :param connect: 
+        :param timeout: seconds a request waits for its response, before it raises asyncio.TimeoutError
+        """
+        # shares the io threads of the Context of the other sockets in this process
+        self._context = zmq.asyncio.Context.shadow(zmq.Context.instance())
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.connect(connect)
+        self._timeout = timeout or ZMQ_TIMEOUT_SEC
+        self._correlation_ids = itertools.count()
+        self._pending = dict()  # correlation id -> Future of the response frame
+        self._receiver = None  # task that receives the responses, started by the first request
+
+    @property
+    def pending(self):
+        """
+        :return: number of requests that wait for their response
+        """
+        return len(self._pending)
+
+    async def _receive(self):
+        while True:
+            try:
+                source, content = split_message(await self._socket.recv_multipart())
+            except ValueError:
+                logger.warning('Dropping response without envelope')
+                continue
+            future = self._pending.pop(source[0], None) if len(source) > 0 else None
+            if future is None or future.done():
+                # the request timed out or was cancelled
+                logger.debug('Dropping response without request')
+                continue
+            future.set_result(content[0])
+
+    async def send_and_recv(self, method, endpoint, parameters=None, data=None, decode_response=True):
+        logger.debug('Request: %s %s', method, endpoint)
+        if self._receiver is None or self._receiver.done():
+            self._receiver = asyncio.ensure_future(self._receive())
+
+        correlation_id = struct.pack('>Q', next(self._correlation_ids))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[correlation_id] = future
+        try:
+            await self._socket.send_multipart([correlation_id, b''] +
+                                              pack_request(method, endpoint, parameters, data, self._timeout))
+            zmq_response = await asyncio.wait_for(future, self._timeout)
+        finally:
+            self._pending.pop(correlation_id, None)
+
+        response = unpack_response(zmq_response, decode_response)
+        logger.debug('Response: %s - %s', response.status_code, response.response)
+        return response
+
+    async def get(self, endpoint, parameters=None, data=None, decode_response=True):
+        return await self.send_and_recv('GET', endpoint, parameters, data, decode_response)
+
+    async def list(self, endpoint, parameters=None, data=None, decode_response=True):
+        return await self.send_and_recv('LIST', endpoint, parameters, data, decode_response)
+
+    async def post(self, endpoint, parameters=None, data=None, decode_response=True):
+        return await self.send_and_recv('POST', endpoint, parameters, data, decode_response)
+
+    async def patch(self, endpoint, parameters=None, data=None, decode_response=True):
+        return await self.send_and_recv('PATCH', endpoint, parameters, data, decode_response)
+
+    async def delete(self, endpoint, parameters=None, data=None, decode_response=True):
+        return await self.send_and_recv('DELETE', endpoint, parameters, data, decode_response)
+
+    def close(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._socket.close(linger=0)
+
+
+class ClusterClient(RequestMethods, PipelineMethods):
+    """
+    Client for a cluster of brokers. Every request is sent to the broker that owns its endpoint on the hash ring, so
+    the requests for an endpoint are queued on one broker. The brokers are discovered in redis, and again every
+    SECONDS_BEFORE_CLUSTER_REFRESH seconds.
+    """
+
+    def __init__(self,
+                 redis_host,
+                 redis_port,
+                 redis_db,
+                 timeout=None):
+        self._cluster = Cluster(redis_host, redis_port, redis_db)
+        self._client_timeout = timeout
+        self._timeout = (timeout or ZMQ_TIMEOUT_SEC) * 1000
+        self._correlation_ids = itertools.count()
+        self._client_by_node = dict()
+        self._refresh()
+
+    def _refresh(self):
+        self._urls_by_node = self._cluster.nodes()
+        self._ring = HashRing(self._urls_by_node)
+        self._refreshed = time.time()
+        for node_id in list(self._client_by_node):
+            if node_id not in self._urls_by_node:
+                self._client_by_node.pop(node_id).close()
+
+    def client_for(self, endpoint):
+        """
+        :param endpoint: 
+        :return: Client connected to the broker that owns the endpoint
+        """
+        if time.time() - self._refreshed > SECONDS_BEFORE_CLUSTER_REFRESH:
+            self._refresh()
+        node_id = self._ring.node_of(endpoint)
+        if node_id is None:
+            raise RuntimeError('No brokers in the cluster')
+        try:
+            return self._client_by_node[node_id]
+        except KeyError:
+            client = Client(connect=self._urls_by_node[node_id][Cluster.CLIENT], timeout=self._client_timeout)
+            self._client_by_node[node_id] = client
+            return client
+
+    @property
+    def healthy(self):
+        """
+        :return: False if the socket of any of the Clients of the brokers cannot send a request
+        """
+        return all(client.healthy for client in self._client_by_node.values())
+
+    def reset(self):
+        """
+        Replace the sockets of the Clients of the brokers that cannot send a request.
+        :return: None
+        """
+        for client in self._client_by_node.values():
+            if not client.healthy:
+                client.reset()
+
+    def correlation_id(self):
+        """
+        :return: id of a request of a Pipeline, unique for the ClusterClient, whichever broker the request is sent to
+        """
+        return struct.pack('>Q', next(self._correlation_ids))
+
+    def send_and_recv(self, method, endpoint, parameters=None, data=None, decode_response=True):
+        return self.client_for(endpoint).send_and_recv(method, endpoint, parameters, data, decode_response)
+
+    def pipeline_socket(self, endpoint):
+        return self.client_for(endpoint).pipeline_socket(endpoint)
+
+    def close(self):
+        for client in self._client_by_node.values():
+            client.close()
+        self._client_by_node.clear()
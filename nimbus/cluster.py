@@ -0,0 +1,184 @@
+import bisect
+import time
+import zlib
+
+import msgpack
+from redis import StrictRedis
+
+from nimbus.helpers import decode
+from nimbus.log import get_logger
+
+logger = get_logger(__name__)
+
+SECONDS_ALIVE = 10
+REPLICAS = 64
+
+
+class HashRing:
+    """
+    Consistent hashing of endpoints over the nodes of a cluster: when a node joins or leaves, only the endpoints of
+    that node move. Every node is placed on the ring a number of times (replicas) to spread the endpoints evenly.
+    """
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self._nodes = frozenset(nodes)
+        points = sorted((self._hash('{}#{}'.format(node, i)), node) for node in self._nodes for i in range(replicas))
+        self._hashes = [hash_ for hash_, node in points]
+        self._points = [node for hash_, node in points]
+
+    def __eq__(self, other):
+        if isinstance(other, HashRing):
+            return self._nodes == other._nodes
+        return NotImplemented
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @staticmethod
+    def _hash(key):
+        return zlib.crc32(key.encode())
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    def node_of(self, endpoint):
+        """
+        :param endpoint:
+        :return: id of the node that owns the endpoint, None if the ring is empty
+        """
+        if len(self._points) == 0:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(endpoint)) % len(self._points)
+        return self._points[i]
+
+
+class Cluster:
+    """
+    Membership of the broker nodes of a cluster, in redis. Brokers join with the urls that clients and workers connect
+    to, and renew a key that expires after SECONDS_ALIVE to show that they are alive. Clients and workers discover the
+    brokers here.
+    A node that stops renewing its key is dead, but stays listed until another node took over its ClientRequests. A
+    node that was only paused notices on its next heartbeat that it was claimed, and joins again.
+    When a node joins, only the new ClientRequests of the endpoints that the ring now gives it go to the new node. The
+    ClientRequests that are already queued stay on the previous owner on purpose: their clients wait for the response
+    on the socket of that node, and the workers of a ClusterWorker are connected to every node, so they are processed
+    there. Moving them would lose their responses, like for a dead node.
+    """
+
+    KEY_NODES = 'cluster:nodes'  # hash of node id -> msgpack of urls
+    KEY_ALIVE = 'cluster:alive:'
+    KEY_TAKEOVER = 'cluster:takeover:'
+
+    CLIENT = 'client'
+    WORKER_CONTROL = 'worker_control'
+    WORKER_RESPONSE = 'worker_response'
+
+    def __init__(self, redis_host, redis_port, redis_db, node_id=None, urls=None, seconds_alive=SECONDS_ALIVE):
+        """
+        :param node_id: id of this broker, None for clients and workers
+        :param urls: dict with the CLIENT, WORKER_CONTROL and WORKER_RESPONSE url of this broker
+        :param seconds_alive:
+        """
+        self._redis = StrictRedis(host=redis_host, port=redis_port, db=redis_db)
+        self._node_id = node_id
+        self._urls = urls
+        self._seconds_alive = seconds_alive
+
+    @property
+    def node_id(self):
+        return self._node_id
+
+    @property
+    def seconds_alive(self):
+        return self._seconds_alive
+
+    @staticmethod
+    def namespace(node_id):
+        """
+        :param node_id:
+        :return: namespace of the storage of the ClientRequests of a node
+        """
+        return 'cluster:' + node_id
+
+    def join(self):
+        logger.info('Joining cluster as %s with %s', self._node_id, self._urls)
+        pipeline = self._redis.pipeline(transaction=False)
+        pipeline.hset(self.KEY_NODES, self._node_id, msgpack.packb(self._urls))
+        pipeline.set(self.KEY_ALIVE + self._node_id, 1, ex=self._seconds_alive)
+        pipeline.delete(self.KEY_TAKEOVER + self._node_id)
+        pipeline.execute()
+
+    def heartbeat(self):
+        """
+        Renew the key that shows this node is alive, unless another node claimed its ClientRequests, e.g. because the
+        key expired during a pause of this node.
+        :return: False if the node was claimed, it has to reload its ClientRequests and join again
+        """
+        pipeline = self._redis.pipeline(transaction=True)
+        pipeline.hexists(self.KEY_NODES, self._node_id)
+        pipeline.exists(self.KEY_TAKEOVER + self._node_id)
+        member, claimed = pipeline.execute()
+        if not member or claimed:
+            logger.warning('Broker %s was taken over by another node', self._node_id)
+            return False
+        self._redis.set(self.KEY_ALIVE + self._node_id, 1, ex=self._seconds_alive)
+        return True
+
+    def wait_for_takeover(self, interval=0.1):
+        """
+        Wait until the node that claimed this node forgot it, or until its claim expired because it did not finish.
+        :param interval: seconds between the checks
+        :return: None
+        """
+        while self._redis.hexists(self.KEY_NODES, self._node_id) \
+                and self._redis.exists(self.KEY_TAKEOVER + self._node_id):
+            time.sleep(interval)
+
+    def leave(self):
+        """
+        Stop being alive. The ClientRequests that are still stored are taken over by another node.
+        :return: None
+        """
+        logger.info('Leaving cluster as %s', self._node_id)
+        self._redis.delete(self.KEY_ALIVE + self._node_id)
+
+    def _all_nodes(self):
+        urls_by_node = dict((decode(node_id), decode(msgpack.unpackb(urls)))
+                            for node_id, urls in self._redis.hgetall(self.KEY_NODES).items())
+        node_ids = list(urls_by_node)
+        alive = self._redis.mget([self.KEY_ALIVE + node_id for node_id in node_ids]) if node_ids else []
+        return urls_by_node, [node_id for node_id, is_alive in zip(node_ids, alive) if is_alive is not None]
+
+    def nodes(self):
+        """
+        :return: dict of node id -> urls, for the nodes that are alive
+        """
+        urls_by_node, alive = self._all_nodes()
+        return dict((node_id, urls_by_node[node_id]) for node_id in alive)
+
+    def dead_nodes(self):
+        """
+        :return: ids of the nodes that are no longer alive, but of which the ClientRequests are not taken over yet
+        """
+        urls_by_node, alive = self._all_nodes()
+        return [node_id for node_id in urls_by_node if node_id not in alive]
+
+    def ring(self):
+        return HashRing(self.nodes())
+
+    def claim(self, node_id):
+        """
+        Claim the ClientRequests of a dead node. Only one node succeeds.
+        :param node_id:
+        :return: True if this node has to take over the ClientRequests
+        """
+        return bool(self._redis.set(self.KEY_TAKEOVER + node_id, self._node_id, nx=True, ex=self._seconds_alive * 6))
+
+    def forget(self, node_id):
+        """
+        Remove a dead node, after its ClientRequests are taken over.
+        :param node_id:
+        :return: None
+        """
+        self._redis.hdel(self.KEY_NODES, node_id)
@@ -10,3 +10,11 @@ def get(*args, **kwargs):
 
 def has_option(*args, **kwargs):
     return cparser.has_option(*args, **kwargs)
+
+
+def has_section(*args, **kwargs):
+    return cparser.has_section(*args, **kwargs)
+
+
+def items(*args, **kwargs):
+    return cparser.items(*args, **kwargs)
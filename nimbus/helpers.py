@@ -31,6 +31,25 @@ def extract_content_from_message(message):
     return content[0]
 
 
+def split_message(message):
+    """
+    Split a multipart message in the source and the content frames, at the first empty frame.
+    Also works for messages received with copy=False, of which the frames are zmq.Frame objects.
+    :param message: list of bytes or zmq.Frame
+    :return: (source, content), both lists
+    """
+    for i, frame in enumerate(message):
+        if len(frame) == 0:
+            return message[:i], message[i + 1:]
+    raise ValueError('Message has no empty delimiter frame')
+
+
+def frame_to_bytes(frame):
+    if isinstance(frame, zmq.Frame):
+        return frame.bytes
+    return frame
+
+
 def unix_to_ts(unix_timestamp):
     return pytz.utc.localize(datetime.datetime.utcfromtimestamp(unix_timestamp))
 
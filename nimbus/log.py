@@ -1,11 +1,17 @@
+import atexit
 import logging
+import os
+import queue
 import sys
-from logging.handlers import SMTPHandler
+from logging.handlers import SMTPHandler, QueueHandler, QueueListener
 
 from nimbus import config
 
+# Messages are logged with %-style arguments, e.g. logger.info('Sending %s to %s', id_, worker), so they are only
+# formatted when a handler emits them. The handlers run in a background thread: the broker and workers only put the
+# records on a queue.
+
 root_logger = logging.getLogger()
-root_logger.setLevel(logging.DEBUG)
 
 
 def get_logger(name):
@@ -22,17 +28,44 @@ log_level_mapper = {
     'debug': logging.DEBUG,
 }
 
+
+def _immutable(value):
+    if isinstance(value, tuple):
+        return all(_immutable(item) for item in value)
+    return isinstance(value, (str, bytes, int, float, type(None)))
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Put records on the queue without formatting their message, which is left to the handlers of the QueueListener.
+    Only the traceback of an exception is rendered here, because it cannot be passed to another thread. A message with
+    a mutable argument, e.g. a list or dict, is formatted here as well, because the argument may change before the
+    listener formats it.
+    """
+
+    def prepare(self, record):
+        if record.args and not _immutable(record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+handlers = []
+
 # Logging to stdout
 stream_handler = logging.StreamHandler(sys.stdout)
 stream_handler.setFormatter(logging.Formatter(log_format))
 stream_handler.setLevel(log_level_mapper[config.get('logging', 'stdout_level')])
-root_logger.addHandler(stream_handler)
+handlers.append(stream_handler)
 
 # Logging to file
 file_handler = logging.FileHandler(config.get('logging', 'file_path'))
 file_handler.setFormatter(logging.Formatter(log_format))
 file_handler.setLevel(log_level_mapper[config.get('logging', 'file_level')])
-root_logger.addHandler(file_handler)
+handlers.append(file_handler)
 
 # Logging to mail
 if config.has_option('logging', 'mail_level'):
@@ -42,4 +75,36 @@ if config.has_option('logging', 'mail_level'):
                                subject='Error in {}'.format(config.get('general', 'name')))
     mail_handler.setFormatter(logging.Formatter(mail_log_format))
     mail_handler.setLevel(log_level_mapper[config.get('logging', 'mail_level')])
-    root_logger.addHandler(mail_handler)
+    handlers.append(mail_handler)
+
+# records below this level are dropped before they are created, by default the lowest level of the handlers
+if config.has_option('logging', 'level'):
+    root_logger.setLevel(log_level_mapper[config.get('logging', 'level')])
+else:
+    root_logger.setLevel(min(handler.level for handler in handlers))
+
+# Level per component, e.g. nimbus.broker = debug in the [logging.levels] section
+if config.has_section('logging.levels'):
+    for name, level in config.items('logging.levels'):
+        logging.getLogger(name).setLevel(log_level_mapper[level])
+
+queue_handler = LazyQueueHandler(queue.SimpleQueue())
+queue_listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+root_logger.addHandler(queue_handler)
+queue_listener.start()
+
+
+def _stop_listener():
+    queue_listener.stop()
+
+
+def _restart_listener():
+    # the thread of the listener does not survive a fork, e.g. of the shards of a ShardedBroker
+    global queue_listener
+    queue_handler.queue = queue.SimpleQueue()
+    queue_listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener)
+atexit.register(_stop_listener)
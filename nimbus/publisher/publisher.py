@@ -18,11 +18,11 @@ class Publisher:
                  redis_db):
         self._context = zmq.Context.instance()
 
-        logger.info('Creating worker socket on {}'.format(worker_bind))
+        logger.info('Creating worker socket on %s', worker_bind)
         self._worker_socket = self._context.socket(zmq.ROUTER)
         self._worker_socket.bind(worker_bind)
 
-        logger.info('Creating client socket on {}'.format(client_bind))
+        logger.info('Creating client socket on %s', client_bind)
         self._client_socket = self._context.socket(zmq.PUB)
         self._client_socket.bind(client_bind)
 
@@ -48,5 +48,5 @@ class Publisher:
 
                 content = msgpack.unpackb(content)
                 content[b'id'] = uuid.uuid4().hex
-                logger.debug('Publishing for topic {}'.format(content[b'topic']))
+                logger.debug('Publishing for topic %s', content[b'topic'])
                 self._client_socket.send(content[b'topic'] + b' ' + msgpack.packb(content))
@@ -1,47 +1,95 @@
-from nimbus.helpers import get_utc_int
+import heapq
+import random
+import time
+
+JITTER = 0.1  # share of seconds_before_contact_check that a ping is postponed at random
 
 
 class ConnectionStateManager:
     """
     Keep track of the state of every worker.
+    A connection is pinged when there was no contact for seconds_before_contact_check, and disconnected when it did
+    not answer within seconds_before_disconnect. The checks are kept in heaps of deadlines on a monotonic clock, so a
+    call only looks at the connections of which a deadline passed. A heap entry is checked against the last contact
+    when it expires instead of being updated on every contact, so contact_from takes constant time.
     """
 
-    def __init__(self, seconds_before_contact_check, seconds_before_disconnect):
-        self._last_contact = dict()
-        self._checking_connection = dict()
+    def __init__(self, seconds_before_contact_check, seconds_before_disconnect, jitter=JITTER, clock=time.monotonic):
+        """
+        :param seconds_before_contact_check:
+        :param seconds_before_disconnect:
+        :param jitter: share of seconds_before_contact_check that a ping is postponed at random, so connections
+        that started together are not pinged together
+        :param clock: function that returns the time in seconds
+        """
+        self._last_contact = dict()  # connection id -> time of the last contact, for connections that are not pinged
+        self._checking_connection = dict()  # connection id -> time of the ping, for connections that are pinged
         self._seconds_before_contact_check = seconds_before_contact_check
         self._seconds_before_disconnect = seconds_before_disconnect
+        self._jitter = jitter
+        self._clock = clock
+        self._ping_heap = []  # (time to check the last contact, connection id)
+        self._ping_due = dict()  # connection id -> time of its entry in the ping heap, other entries are outdated
+        self._disconnect_heap = []  # (time to disconnect if there was no answer, connection id)
+
+    def _schedule_ping(self, connection_id, last_contact):
+        due = last_contact + self._seconds_before_contact_check * (1 + random.uniform(0, self._jitter))
+        self._ping_due[connection_id] = due
+        heapq.heappush(self._ping_heap, (due, connection_id))
 
     def contact_from(self, connection_id):
-        try:
-            del self._checking_connection[connection_id]
-        except KeyError:
-            pass
-        self._last_contact[connection_id] = get_utc_int()
+        """
+        Register any message from a connection: it is alive.
+        :param connection_id:
+        :return: None
+        """
+        now = self._clock()
+        self._checking_connection.pop(connection_id, None)
+        self._last_contact[connection_id] = now
+        if connection_id not in self._ping_due:
+            self._schedule_ping(connection_id, now)
 
     def disconnect(self, connection_id):
-        try:
-            del self._checking_connection[connection_id]
-        except KeyError:
-            pass
-        try:
-            del self._last_contact[connection_id]
-        except KeyError:
-            pass
+        self._checking_connection.pop(connection_id, None)
+        self._last_contact.pop(connection_id, None)
+        self._ping_due.pop(connection_id, None)
 
     def get_connections_to_ping(self):
-        connection_ids = [connection_id
-                          for connection_id, last_contact in self._last_contact.items()
-                          if get_utc_int() - last_contact > self._seconds_before_contact_check]
-        for connection_id in connection_ids:
+        """
+        :return: connections without contact for seconds_before_contact_check, they are pinged from now on
+        """
+        now = self._clock()
+        connection_ids = []
+        while len(self._ping_heap) > 0 and self._ping_heap[0][0] <= now:
+            due, connection_id = heapq.heappop(self._ping_heap)
+            if self._ping_due.get(connection_id) != due:
+                continue
+            del self._ping_due[connection_id]
+            last_contact = self._last_contact.get(connection_id)
+            if last_contact is None:
+                continue
+            if now - last_contact < self._seconds_before_contact_check:
+                # there was contact since the entry was scheduled
+                self._schedule_ping(connection_id, last_contact)
+                continue
             del self._last_contact[connection_id]
-            self._checking_connection[connection_id] = get_utc_int()
+            self._checking_connection[connection_id] = now
+            heapq.heappush(self._disconnect_heap, (now + self._seconds_before_disconnect, connection_id))
+            connection_ids.append(connection_id)
         return connection_ids
 
     def get_connections_to_disconnect(self):
-        connection_ids = [connection_id
-                          for connection_id, check_time in self._checking_connection.items()
-                          if get_utc_int() - check_time > self._seconds_before_disconnect]
-        for connection_id in connection_ids:
+        """
+        :return: connections that did not answer a ping for seconds_before_disconnect, they are forgotten
+        """
+        now = self._clock()
+        connection_ids = []
+        while len(self._disconnect_heap) > 0 and self._disconnect_heap[0][0] <= now:
+            due, connection_id = heapq.heappop(self._disconnect_heap)
+            check_time = self._checking_connection.get(connection_id)
+            if check_time is None or check_time + self._seconds_before_disconnect > now:
+                # answered in time, or pinged again later
+                continue
             del self._checking_connection[connection_id]
+            connection_ids.append(connection_id)
         return connection_ids
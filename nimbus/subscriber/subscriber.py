@@ -20,7 +20,7 @@ class Subscriber:
     def _connect(self):
         self._context = zmq.Context.instance()
 
-        logger.debug('Connecting to publisher socket on {}'.format(self._url_publisher))
+        logger.debug('Connecting to publisher socket on %s', self._url_publisher)
         self._socket_publisher = self._context.socket(zmq.SUB)
         self._socket_publisher.connect(self._url_publisher)
 
@@ -38,20 +38,20 @@ class Subscriber:
         for topic in ctx_subscriber.topics:
             self.subscribe(topic)
 
-        logger.debug('Starting with topics {}'.format(ctx_subscriber.topics))
+        logger.debug('Starting with topics %s', ctx_subscriber.topics)
 
         loop = True
         while loop:
             logger.debug('Listening...')
             sockets = dict(poller.poll())
-            logger.debug('Received: {}'.format(sockets))
+            logger.debug('Received: %s', sockets)
 
             if self._socket_publisher in sockets and sockets[self._socket_publisher] == zmq.POLLIN:
                 message = self._socket_publisher.recv()
                 message = message[message.find(b' ') + 1:]  # filter out the topic and the space
                 message = Publication(message)
                 try:
-                    logger.debug('Received: {}'.format(message.topic))
+                    logger.debug('Received: %s', message.topic)
                     service = ctx_subscriber.get_service_by_topic(message.topic)
                     service(message)
                 except:
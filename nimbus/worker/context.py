@@ -1,4 +1,5 @@
 import functools
+import inspect
 import uuid
 
 from nimbus.log import get_logger
@@ -7,6 +8,12 @@ from nimbus.worker.request import Request
 
 logger = get_logger(__name__)
 
+# how a Worker runs the service of a route
+EXECUTION_INLINE = 'inline'  # in the loop of the Worker, one request at a time
+EXECUTION_THREAD = 'thread'  # in a pool of threads, for services that wait for I/O, e.g. the database
+EXECUTION_PROCESS = 'process'  # in a pool of processes, for services that need the CPU
+EXECUTIONS = (EXECUTION_INLINE, EXECUTION_THREAD, EXECUTION_PROCESS)
+
 
 class RequestContext:
     def __init__(self):
@@ -15,6 +22,41 @@ class RequestContext:
         self._services = {}
         self._endpoints = {}
         self._labels = {}
+        self._cache_ttls = {}
+        self._coalesced = set()
+        self._executions = {}  # (method, endpoint) -> execution, if it is not EXECUTION_INLINE
+
+    @property
+    def cache_ttls(self):
+        """
+        :return: list of [method, endpoint, ttl] of the endpoints of which the broker can cache the responses
+        """
+        return [[method, endpoint, ttl] for (method, endpoint), ttl in sorted(self._cache_ttls.items())]
+
+    @property
+    def coalesced(self):
+        """
+        :return: list of [method, endpoint] of the endpoints of which identical requests can share a response
+        """
+        return [[method, endpoint] for method, endpoint in sorted(self._coalesced)]
+
+    @property
+    def executions(self):
+        """
+        :return: set of the executions of all routes
+        """
+        executions = set(self._executions.values())
+        if len(self._executions) < len(self._services_by_endpoint):
+            executions.add(EXECUTION_INLINE)
+        return executions
+
+    def execution_for(self, endpoint, method='GET'):
+        """
+        :param endpoint: 
+        :param method: 
+        :return: how the service of the route is run, EXECUTION_INLINE for unknown routes
+        """
+        return self._executions.get((method, endpoint), EXECUTION_INLINE)
 
     @property
     def endpoints(self):
@@ -29,12 +71,28 @@ class RequestContext:
         except KeyError:
             raise EndpointDoesNotExist
 
-    def route(self, endpoint, methods, parameters=None, label=None):
+    def route(self, endpoint, methods, parameters=None, label=None, cache_ttl=None, coalesce=False,
+              execution=EXECUTION_INLINE):
+        """
+        :param endpoint: 
+        :param methods: 
+        :param parameters: parameters that are required
+        :param label: 
+        :param cache_ttl: seconds the broker may answer the same GET or LIST request from its cache, None to never
+        cache the responses
+        :param coalesce: if True, the broker sends only one of identical pending GET or LIST requests to a worker,
+        and its response to all their clients
+        :param execution: EXECUTION_INLINE, EXECUTION_THREAD or EXECUTION_PROCESS, async def services always run
+        inline: on the event loop of an AsyncWorker, or on an event loop per request in a Worker
+        :return: decorator
+        """
+        if execution not in EXECUTIONS:
+            raise ValueError('Unknown execution {}, expected one of {}'.format(execution, EXECUTIONS))
+
         def decorator(func):
             nonlocal label
 
-            @functools.wraps(func)
-            def decorated(request, *args, **kwargs):
+            def check(request):
                 nonlocal parameters
                 if parameters is None:
                     parameters = []
@@ -55,7 +113,17 @@ class RequestContext:
                         raise MissingParameter('Function {} requires parameter {}'.format(func.__name__,
                                                                                           parameter))
 
-                return func(request, *args, **kwargs)
+            if inspect.iscoroutinefunction(func):
+                # served concurrently by an AsyncWorker
+                @functools.wraps(func)
+                async def decorated(request, *args, **kwargs):
+                    check(request)
+                    return await func(request, *args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def decorated(request, *args, **kwargs):
+                    check(request)
+                    return func(request, *args, **kwargs)
 
             for method in methods:
 
@@ -71,6 +139,12 @@ class RequestContext:
                 self._services[service_id] = decorated
                 self._endpoints[service_id] = (method, endpoint)
                 self._labels[service_id] = (method, label)
+                if cache_ttl:
+                    self._cache_ttls[(method, endpoint)] = cache_ttl
+                if coalesce:
+                    self._coalesced.add((method, endpoint))
+                if execution != EXECUTION_INLINE and not inspect.iscoroutinefunction(func):
+                    self._executions[(method, endpoint)] = execution
 
             return decorated
 
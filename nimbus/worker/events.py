@@ -22,7 +22,7 @@ class EventContext:
 
     def publish(self, name, *args, **kwargs):
         # TODO: check on arguments depening on the event name
-        logger.debug('Publish event: {} - {} - {}'.format(name, args, kwargs))
+        logger.debug('Publish event: %s - %s - %s', name, args, kwargs)
         for func in self._events.get(name, []):
             func(*args, **kwargs)
 
@@ -1,3 +1,5 @@
+import time
+
 import msgpack
 
 from nimbus.helpers import decode
@@ -7,15 +9,18 @@ logger = get_logger(__name__)
 
 
 class Request:
-    def __init__(self, request):
+    def __init__(self, request, body=None):
         self._id = decode(request[b'id'])  # str
         self._method = decode(request[b'method'])  # str
         self._endpoint = decode(request[b'endpoint'])  # str
+        self._deadline = request.get(b'deadline')  # unix timestamp, or None
         if b'parameters' in request:
             self._parameters = decode(request[b'parameters'])  # dict of str
         else:
             self._parameters = {}
-        if b'data' in request:
+        if body is not None:
+            self._data = msgpack.unpackb(body)  # dict of bytes
+        elif b'data' in request:
             self._data = request[b'data']  # dict of bytes
         else:
             self._data = {}
@@ -41,6 +46,20 @@ class Request:
         """
         return self._endpoint
 
+    @property
+    def deadline(self):
+        """
+        :return: unix timestamp after which the client stopped waiting, or None
+        """
+        return self._deadline
+
+    @property
+    def expired(self):
+        """
+        :return: True if the client stopped waiting for the response
+        """
+        return self._deadline is not None and self._deadline <= time.time()
+
     @property
     def parameters(self):
         """
@@ -1,15 +1,27 @@
+import asyncio
+import configparser
+import inspect
+import multiprocessing
+import os
+import queue
 import sys
+import threading
+import time
 import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import msgpack
 import zmq
+import zmq.asyncio
 from requests import codes
 
 from nimbus import config
-from nimbus.helpers import extract_content_from_message, decode
+from nimbus.cluster import Cluster
+from nimbus.helpers import decode, split_message
 from nimbus.log import get_logger
 from nimbus.statemanager import ConnectionStateManager
-from nimbus.worker.context import ctx_request
+from nimbus.worker.context import ctx_request, EXECUTION_INLINE, EXECUTION_THREAD, EXECUTION_PROCESS
 from nimbus.worker.errors import RequestError
 from nimbus.worker.request import Request
 
@@ -17,6 +29,93 @@ logger = get_logger(__name__)
 
 SECONDS_BEFORE_CONTACT_CHECK = int(config.get('control', 'seconds_before_contact_check'))
 SECONDS_BEFORE_DISCONNECT = int(config.get('control', 'seconds_before_disconnect'))
+CREDIT = int(config.get('control', 'credit', fallback=1))
+LEGACY_RESPONSE = bool(int(config.get('control', 'legacy_response', fallback=0)))
+THREADS = int(config.get('control', 'threads', fallback=4))
+PROCESSES = int(config.get('control', 'processes', fallback=os.cpu_count() or 1))
+TASKS = int(config.get('control', 'tasks', fallback=100))
+SECONDS_BEFORE_CLUSTER_REFRESH = 10
+# how long the loop waits for a message before it checks the heartbeats
+POLL_TIMEOUT_MS = max(int(min(SECONDS_BEFORE_CONTACT_CHECK, SECONDS_BEFORE_DISCONNECT) / 10.0 * 1000), 500)
+
+
+def _with_status(response):
+    if isinstance(response, tuple):
+        return response
+    return response, codes.OK
+
+
+def _failed():
+    """
+    :return: (response, status) for the exception that is being handled
+    """
+    e = sys.exc_info()[1]
+    if isinstance(e, RequestError):
+        return str(e), e.status_code
+    logger.error(sys.exc_info()[0])
+    logger.error(sys.exc_info()[1])
+    logger.error(traceback.extract_tb(sys.exc_info()[2]))
+    return {}, codes.SERVER_ERROR
+
+
+def process_request(message):
+    """
+    Call the service of the request. An async def service runs on its own event loop.
+    :param message: Request
+    :return: (response, status)
+    """
+    try:
+        logger.info('Received: %s %s', message.method, message.endpoint)
+        service = ctx_request.get_service_by_endpoint(message.endpoint, message.method)
+        response = service(message)
+        if inspect.isawaitable(response):
+            response = asyncio.run(response)
+        return _with_status(response)
+    except:
+        return _failed()
+
+
+async def process_request_async(message):
+    """
+    Call the service of the request on the running event loop.
+    :param message: Request
+    :return: (response, status)
+    """
+    try:
+        logger.info('Received: %s %s', message.method, message.endpoint)
+        service = ctx_request.get_service_by_endpoint(message.endpoint, message.method)
+        response = service(message)
+        if inspect.isawaitable(response):
+            response = await response
+        return _with_status(response)
+    except:
+        return _failed()
+
+
+def _exit_with_parent(parent_pid):
+    """
+    Initializer of the processes of a pool: exit when the Worker is gone, e.g. because it was killed, instead of
+    waiting for requests forever.
+    :param parent_pid: process id of the Worker
+    :return: None
+    """
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def _default_session():
+    """
+    :return: the scoped SQLAlchemy session of nimbus.models, or None if the models are not available
+    """
+    try:
+        from nimbus.models import Session
+    except (ImportError, configparser.Error):
+        return None
+    return Session
 
 
 class BrokerStateManager:
@@ -34,35 +133,220 @@ class BrokerStateManager:
         return self._broker in self._manager.get_connections_to_disconnect()
 
 
+def _start_process_pool(processes):
+    """
+    Fork the processes for the routes with EXECUTION_PROCESS. Call it before there are any sockets or threads, because
+    only the forking thread survives in the processes.
+    :param processes: number of processes
+    :return: ProcessPoolExecutor
+    """
+    logger.info('Starting %s processes', processes)
+    process_pool = ProcessPoolExecutor(max_workers=processes,
+                                       mp_context=multiprocessing.get_context('fork'),
+                                       initializer=_exit_with_parent,
+                                       initargs=(os.getpid(),))
+    # the processes are forked on the first request, make sure that happens now
+    process_pool.submit(int).result()
+    return process_pool
+
+
 class Worker:
     def __init__(self,
                  connect_control,
-                 connect_response):
+                 connect_response,
+                 credit=CREDIT,
+                 legacy_response=LEGACY_RESPONSE,
+                 threads=THREADS,
+                 processes=PROCESSES,
+                 session=None,
+                 process_pool=None):
+        """
+        :param connect_control: 
+        :param connect_response: only used with legacy_response
+        :param credit: number of requests the broker sends ahead, so the next request is already waiting when the
+        current one is done
+        :param legacy_response: if True, send responses on the response socket and wait for the broker to
+        acknowledge them, for brokers that do not accept responses on the control socket
+        :param threads: number of threads for the routes with EXECUTION_THREAD
+        :param processes: number of processes for the routes with EXECUTION_PROCESS
+        :param session: scoped session that is removed after every request in a thread, so every thread uses its own
+        session, by default the Session of nimbus.models if it is available
+        :param process_pool: ProcessPoolExecutor that is shared with other Workers, e.g. of a ClusterWorker, for the
+        routes with EXECUTION_PROCESS; it is not shut down when the Worker is closed
+        """
         self._url_connect_control = connect_control
         self._url_connect_response = connect_response
+        self._credit = credit
+        self._legacy_response = legacy_response
+        self._threads = threads
+        self._processes = processes
+        self._session = session
+        self._socket_response = None
+        self._counters = Counter()
+        self._thread_pool = None
+        self._process_pool = process_pool
+        self._shared_process_pool = process_pool is not None
+        self._completed = queue.SimpleQueue()  # (Request, Future) of the requests that completed in a pool
+        self._wakeup_read, self._wakeup_write = None, None  # pipe that wakes up the poller when a request completed
+
+    @property
+    def counters(self):
+        """
+        :return: dict of counter name -> value, e.g. the number of skipped expired requests
+        """
+        return dict(self._counters)
+
+    @property
+    def concurrency(self):
+        """
+        :return: number of requests the worker processes at the same time, with the executions of its routes
+        """
+        executions = ctx_request.executions
+        concurrency = 1 if EXECUTION_INLINE in executions else 0
+        if EXECUTION_THREAD in executions:
+            concurrency += self._threads
+        if EXECUTION_PROCESS in executions:
+            concurrency += self._processes
+        return max(concurrency, 1)
 
     def close(self):
         self._socket_control.close()
-        self._socket_response.close()
+        if self._socket_response is not None:
+            self._socket_response.close()
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+        if self._process_pool is not None and not self._shared_process_pool:
+            self._process_pool.shutdown(wait=False)
+        if self._wakeup_read is not None:
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+
+    def _start_pools(self):
+        executions = ctx_request.executions
+        if EXECUTION_PROCESS in executions and self._process_pool is None:
+            self._process_pool = _start_process_pool(self._processes)
+
+        if EXECUTION_THREAD in executions:
+            logger.info('Starting %s threads', self._threads)
+            if self._session is None:
+                self._session = _default_session()
+            self._thread_pool = ThreadPoolExecutor(max_workers=self._threads, thread_name_prefix='worker')
+
+    def _open_wakeup(self):
+        # the pools write a byte to the pipe when a request completed, so that the poller wakes up
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+
+    def _process_in_thread(self, message):
+        try:
+            return process_request(message)
+        finally:
+            if self._session is not None:
+                # the scoped session of this thread, the next request gets a new one
+                self._session.remove()
+
+    def _submit(self, message, execution):
+        """
+        Process a request in a pool, its response is sent by _send_completed when it is done.
+        :param message: Request
+        :param execution: EXECUTION_THREAD or EXECUTION_PROCESS
+        :return: None
+        """
+        if execution == EXECUTION_THREAD:
+            future = self._thread_pool.submit(self._process_in_thread, message)
+        else:
+            future = self._process_pool.submit(process_request, message)
+
+        def done(future):
+            # called in another thread
+            self._completed.put((message, future))
+            os.write(self._wakeup_write, b'\x00')
+
+        future.add_done_callback(done)
+
+    def _registration(self, credit):
+        return [b'', msgpack.packb({'endpoints': ctx_request.endpoints,
+                                    'credit': credit,
+                                    'cache': ctx_request.cache_ttls,
+                                    'coalesce': ctx_request.coalesced})]
 
     def _connect(self):
         self._context = zmq.Context.instance()
 
-        logger.info('Connecting to broker control socket on {}'.format(self._url_connect_control))
+        logger.info('Connecting to broker control socket on %s', self._url_connect_control)
         self._socket_control = self._context.socket(zmq.DEALER)
         self._socket_control.connect(self._url_connect_control)
 
-        logger.info('Connecting to broker response socket on {}'.format(self._url_connect_response))
-        self._socket_response = self._context.socket(zmq.REQ)
-        self._socket_response.connect(self._url_connect_response)
+        if self._legacy_response:
+            logger.info('Connecting to broker response socket on %s', self._url_connect_response)
+            self._socket_response = self._context.socket(zmq.REQ)
+            self._socket_response.connect(self._url_connect_response)
+
+    def _expired(self, message):
+        """
+        :param message: Request
+        :return: True if the client stopped waiting, the request is then answered with GATEWAY_TIMEOUT without calling
+        the service, which only tells the broker that the request is done
+        """
+        if not message.expired:
+            return False
+        logger.warning('Skipping expired request %s %s', message.method, message.endpoint)
+        self._counters['expired'] += 1
+        return True
+
+    def _process(self, message):
+        """
+        Call the service of the request.
+        :param message: Request
+        :return: (response, status)
+        """
+        return process_request(message)
+
+    def _send_response(self, message, response, status, state_manager):
+        response = msgpack.packb({'status': status, 'response': response})
+        if self._legacy_response:
+            self._send_legacy_response(message, response)
+            state_manager.contact_from_broker()
+        else:
+            # the response also gives back the credit of this request, without waiting for the broker
+            # the broker forwards the response frame to the client without decoding it
+            self._socket_control.send_multipart([b'', msgpack.packb({'done': message.id}), response])
+
+    def _send_completed(self, state_manager):
+        os.read(self._wakeup_read, 4096)
+        while True:
+            try:
+                message, future = self._completed.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                response, status = future.result()
+            except Exception:
+                # e.g. a process of the pool died, or the response could not be pickled
+                logger.exception('Failed to process %s %s', message.method, message.endpoint)
+                response, status = {}, codes.SERVER_ERROR
+            self._send_response(message, response, status, state_manager)
+
+    def _send_legacy_response(self, message, response):
+        # the broker forwards the second frame to the client without decoding it
+        self._socket_response.send_multipart([message.id.encode(), response])
+        # give back the credit of this request, the id tells a sharded broker which shard it belongs to
+        self._socket_control.send_multipart([b'', msgpack.packb({'w': 1, 'id': message.id})])
+        self._socket_response.recv()
 
     def run(self):
+        self._start_pools()
         self._connect()
 
         poller = zmq.Poller()
         poller.register(self._socket_control, zmq.POLLIN)
+        if self._thread_pool is not None or self._process_pool is not None:
+            self._open_wakeup()
+            poller.register(self._wakeup_read, zmq.POLLIN)
 
-        logger.info('Starting with endpoints {}'.format(ctx_request.endpoints))
+        # the broker sends at least as many requests ahead as the worker processes at the same time
+        credit = max(self._credit, self.concurrency)
+        logger.info('Starting with endpoints %s and credit %s', ctx_request.endpoints, credit)
 
         state_manager = BrokerStateManager(seconds_before_contact_check=SECONDS_BEFORE_CONTACT_CHECK,
                                            seconds_before_disconnect=SECONDS_BEFORE_DISCONNECT)
@@ -70,25 +354,20 @@ class Worker:
         loop = True
         init_connection = True
 
-        poller_timeout = max([int(min([SECONDS_BEFORE_CONTACT_CHECK,
-                                       SECONDS_BEFORE_DISCONNECT]) / 10.0 * 1000),
-                              500])
-
         while loop:
             if init_connection:
-                self._socket_control.send_multipart([b'', msgpack.packb({'endpoints': ctx_request.endpoints,
-                                                                         'w': True})])
+                self._socket_control.send_multipart(self._registration(credit))
                 init_connection = False
 
-            sockets = dict(poller.poll(poller_timeout))
+            sockets = dict(poller.poll(POLL_TIMEOUT_MS))
 
             # if sockets:
-            #     logger.debug('Received: {}'.format(sockets))
+            #     logger.debug('Received: %s', sockets)
 
             if self._socket_control in sockets and sockets[self._socket_control] == zmq.POLLIN:
-                # get message content
-                content = extract_content_from_message(self._socket_control.recv_multipart())
-                content = msgpack.unpackb(content)
+                # get message content: a header, for client requests optionally followed by a body with the data
+                source, frames = split_message(self._socket_control.recv_multipart())
+                content = msgpack.unpackb(frames[0])
 
                 state_manager.contact_from_broker()
 
@@ -107,30 +386,20 @@ class Worker:
 
                 # process client request messages
                 else:
-                    message = Request(content)
-                    self._socket_control.send_multipart([b'', msgpack.packb({'r': message.id})])
-                    try:
-                        logger.info('Received: {} {}'.format(message.method, message.endpoint))
-                        service = ctx_request.get_service_by_endpoint(message.endpoint, message.method)
-                        response = service(message)
-                        if isinstance(response, tuple):
-                            response, status = response
-                        else:
-                            status = codes.OK
-                    except RequestError as e:
-                        response = str(e)
-                        status = e.status_code
-                    except:
-                        logger.error(sys.exc_info()[0])
-                        logger.error(sys.exc_info()[1])
-                        logger.error(traceback.extract_tb(sys.exc_info()[2]))
-                        response = {}
-                        status = codes.SERVER_ERROR
-                    self._socket_response.send(msgpack.packb({'id': message.id,
-                                                              'status': status,
-                                                              'response': response}))
-                    self._socket_control.send_multipart([b'', msgpack.packb({'w': True})])
-                    self._socket_response.recv()
+                    message = Request(content, body=frames[1] if len(frames) > 1 else None)
+                    if self._legacy_response:
+                        self._socket_control.send_multipart([b'', msgpack.packb({'r': message.id})])
+                    execution = ctx_request.execution_for(message.endpoint, message.method)
+                    if self._expired(message):
+                        self._send_response(message, {}, codes.GATEWAY_TIMEOUT, state_manager)
+                    elif execution == EXECUTION_INLINE:
+                        response, status = self._process(message)
+                        self._send_response(message, response, status, state_manager)
+                    else:
+                        self._submit(message, execution)
+
+            if self._wakeup_read is not None and self._wakeup_read in sockets:
+                self._send_completed(state_manager)
 
             if state_manager.ping_broker():
                 # logger.debug('Pinging broker')
@@ -140,3 +409,172 @@ class Worker:
                 logger.info('Disconnecting from broker')
                 self._socket_control.send_multipart([b'', msgpack.packb({'disconnect': True})])
                 raise RuntimeError
+
+
+class AsyncWorker(Worker):
+    """
+    Worker on an asyncio event loop. Every request runs in its own task, so async def services that wait for other
+    services or databases process up to `tasks` requests at the same time. Other services run on the loop, or in the
+    pools of their execution like in a Worker. The heartbeats with the broker are checked by a background task.
+    Responses are always sent on the control socket.
+    """
+
+    def __init__(self,
+                 connect_control,
+                 credit=CREDIT,
+                 tasks=TASKS,
+                 threads=THREADS,
+                 processes=PROCESSES,
+                 session=None):
+        """
+        :param connect_control: 
+        :param credit: number of requests the broker sends ahead
+        :param tasks: number of requests that are processed at the same time
+        :param threads: number of threads for the routes with EXECUTION_THREAD
+        :param processes: number of processes for the routes with EXECUTION_PROCESS
+        :param session: scoped session that is removed after every request in a thread
+        """
+        super().__init__(connect_control, connect_response=None, credit=credit, legacy_response=False,
+                         threads=threads, processes=processes, session=session)
+        self._tasks = tasks
+        self._running = set()  # tasks of the requests that were received and are not done
+        self._slots = None  # asyncio.Semaphore that bounds the requests that are processed at the same time
+
+    @property
+    def concurrency(self):
+        """
+        :return: number of requests the worker processes at the same time
+        """
+        return max(self._tasks, 1)
+
+    def _connect(self):
+        # shares the io threads of the Context of the other sockets in this process
+        self._context = zmq.asyncio.Context.shadow(zmq.Context.instance())
+
+        logger.info('Connecting to broker control socket on %s', self._url_connect_control)
+        self._socket_control = self._context.socket(zmq.DEALER)
+        self._socket_control.connect(self._url_connect_control)
+
+    async def _process_async(self, message):
+        """
+        :param message: Request
+        :return: (response, status)
+        """
+        execution = ctx_request.execution_for(message.endpoint, message.method)
+        if execution == EXECUTION_INLINE:
+            return await process_request_async(message)
+        loop = asyncio.get_running_loop()
+        try:
+            if execution == EXECUTION_THREAD:
+                return await loop.run_in_executor(self._thread_pool, self._process_in_thread, message)
+            return await loop.run_in_executor(self._process_pool, process_request, message)
+        except Exception:
+            # e.g. a process of the pool died, or the response could not be pickled
+            logger.exception('Failed to process %s %s', message.method, message.endpoint)
+            return {}, codes.SERVER_ERROR
+
+    async def _handle(self, message):
+        # with a credit above tasks, the requests that are sent ahead wait here for a slot
+        async with self._slots:
+            if self._expired(message):
+                response, status = {}, codes.GATEWAY_TIMEOUT
+            else:
+                response, status = await self._process_async(message)
+        # the response also gives back the credit of this request
+        await self._socket_control.send_multipart([b'', msgpack.packb({'done': message.id}),
+                                                   msgpack.packb({'status': status, 'response': response})])
+
+    async def _receive(self, state_manager, credit):
+        await self._socket_control.send_multipart(self._registration(credit))
+
+        while True:
+            source, frames = split_message(await self._socket_control.recv_multipart())
+            content = msgpack.unpackb(frames[0])
+
+            state_manager.contact_from_broker()
+
+            if b'control' in content:
+                control = decode(content[b'control'])
+                if control == 'ping':
+                    await self._socket_control.send_multipart([b'', msgpack.packb({'pong': True})])
+                elif control == 'kick':
+                    await self._socket_control.send_multipart(self._registration(credit))
+
+            else:
+                message = Request(content, body=frames[1] if len(frames) > 1 else None)
+                task = asyncio.create_task(self._handle(message))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _heartbeat(self, state_manager):
+        while True:
+            await asyncio.sleep(POLL_TIMEOUT_MS / 1000.0)
+
+            if state_manager.ping_broker():
+                await self._socket_control.send_multipart([b'', msgpack.packb({'ping': True})])
+
+            if state_manager.disconnect_broker():
+                logger.info('Disconnecting from broker')
+                await self._socket_control.send_multipart([b'', msgpack.packb({'disconnect': True})])
+                raise RuntimeError
+
+    async def _run(self):
+        self._connect()
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+        credit = max(self._credit, self.concurrency)
+        logger.info('Starting with endpoints %s and credit %s', ctx_request.endpoints, credit)
+
+        state_manager = BrokerStateManager(seconds_before_contact_check=SECONDS_BEFORE_CONTACT_CHECK,
+                                           seconds_before_disconnect=SECONDS_BEFORE_DISCONNECT)
+
+        # the tasks that are still running when the broker is lost are cancelled by asyncio.run
+        await asyncio.gather(self._receive(state_manager, credit), self._heartbeat(state_manager))
+
+    def run(self):
+        self._start_pools()
+        asyncio.run(self._run())
+
+
+class ClusterWorker:
+    """
+    Worker for a cluster of brokers. A Worker is connected to every broker in the cluster, each in its own thread, so
+    the endpoints are served whichever broker owns them. New brokers are discovered every
+    SECONDS_BEFORE_CLUSTER_REFRESH seconds. The processes for the routes with EXECUTION_PROCESS are forked once, before
+    the threads start, and shared by the Workers.
+    """
+
+    def __init__(self, redis_host, redis_port, redis_db, credit=CREDIT, processes=PROCESSES):
+        self._cluster = Cluster(redis_host, redis_port, redis_db)
+        self._credit = credit
+        self._processes = processes
+        self._threads = dict()
+
+    @staticmethod
+    def _run_worker(node_id, worker):
+        try:
+            worker.run()
+        except RuntimeError:
+            logger.info('Lost broker %s', node_id)
+        finally:
+            worker.close()
+
+    def run(self):
+        process_pool = None
+        if EXECUTION_PROCESS in ctx_request.executions:
+            process_pool = _start_process_pool(self._processes)
+        while True:
+            for node_id, urls in self._cluster.nodes().items():
+                thread = self._threads.get(node_id)
+                if thread is not None and thread.is_alive():
+                    continue
+                logger.info('Connecting to broker %s', node_id)
+                worker = Worker(connect_control=urls[Cluster.WORKER_CONTROL],
+                                connect_response=urls[Cluster.WORKER_RESPONSE],
+                                credit=self._credit,
+                                processes=self._processes,
+                                process_pool=process_pool)
+                thread = threading.Thread(target=self._run_worker, args=(node_id, worker), daemon=True)
+                thread.start()
+                self._threads[node_id] = thread
+            time.sleep(SECONDS_BEFORE_CLUSTER_REFRESH)
@@ -1,5 +1,9 @@
+import signal
+import sys
+
 from nimbus import config
-from nimbus.broker import Broker
+from nimbus.broker import Broker, ShardedBroker
+from nimbus.cluster import Cluster
 
 zmq_worker_response_url = 'tcp://{}:{}'.format(config.get('requests', 'worker_response_hostname'),
                                                config.get('requests', 'worker_response_port'))
@@ -12,10 +16,56 @@ redis_host = config.get('redis', 'host')
 redis_port = config.get('redis', 'port')
 redis_db = config.get('redis', 'db')
 
-broker = Broker(worker_response_bind=zmq_worker_response_url,
-                worker_control_bind=zmq_worker_control_url,
-                client_bind=zmq_client_url,
-                redis_host=redis_host,
-                redis_port=redis_port,
-                redis_db=redis_db)
+# memory, redis or log
+storage = config.get('control', 'storage', fallback='redis')
+storage_path = config.get('control', 'storage_path', fallback='nimbus-broker')
+
+# number of broker processes, the endpoints are spread over them
+shards = int(config.get('control', 'shards', fallback=1))
+
+# metrics are served on a stats socket, and written to a file for scrapers
+stats_bind = None
+if config.has_option('stats', 'port'):
+    stats_bind = 'tcp://{}:{}'.format(config.get('stats', 'hostname', fallback='*'), config.get('stats', 'port'))
+stats_path = config.get('stats', 'path', fallback=None)
+
+# a broker in a cluster advertises the urls that clients and workers connect to
+cluster = None
+if config.has_option('cluster', 'hostname'):
+    hostname = config.get('cluster', 'hostname')
+    urls = {Cluster.CLIENT: 'tcp://{}:{}'.format(hostname, config.get('requests', 'client_port')),
+            Cluster.WORKER_CONTROL: 'tcp://{}:{}'.format(hostname, config.get('requests', 'worker_control_port')),
+            Cluster.WORKER_RESPONSE: 'tcp://{}:{}'.format(hostname, config.get('requests', 'worker_response_port'))}
+    cluster = Cluster(redis_host, redis_port, redis_db,
+                      node_id=config.get('cluster', 'node_id',
+                                         fallback='{}-{}'.format(hostname, config.get('requests', 'client_port'))),
+                      urls=urls)
+
+# a broker in a cluster runs as a single process
+if shards > 1 and cluster is None:
+    broker = ShardedBroker(worker_response_bind=zmq_worker_response_url,
+                           worker_control_bind=zmq_worker_control_url,
+                           client_bind=zmq_client_url,
+                           redis_host=redis_host,
+                           redis_port=redis_port,
+                           redis_db=redis_db,
+                           storage=storage,
+                           storage_path=storage_path,
+                           shards=shards,
+                           stats_bind=stats_bind,
+                           stats_path=stats_path)
+else:
+    broker = Broker(worker_response_bind=zmq_worker_response_url,
+                    worker_control_bind=zmq_worker_control_url,
+                    client_bind=zmq_client_url,
+                    redis_host=redis_host,
+                    redis_port=redis_port,
+                    redis_db=redis_db,
+                    storage=storage,
+                    storage_path=storage_path,
+                    cluster=cluster,
+                    stats_bind=stats_bind,
+                    stats_path=stats_path)
+# exit on SIGTERM like on SIGINT, so a broker in a cluster leaves it and its ClientRequests are taken over at once
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 broker.run()
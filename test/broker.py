@@ -1,11 +1,23 @@
 import copy
+import os
+import tempfile
+import time
 import unittest
+import uuid
 from collections import namedtuple
 
 import msgpack
+import zmq
 from redis import StrictRedis
 
-from nimbus.broker import ClientRequest, RequestQueue, EmptyQueue, QueueManager, RequestManager
+from nimbus.broker import Broker, ClientRequest, RequestQueue, EmptyQueue, QueueManager, RequestManager, RedisBatch, \
+    RedisStorage, MemoryStorage, LogStorage, ShardedBroker, ControlRequest, repartition_storage
+from nimbus.broker.cache import ResponseCache, RequestCoalescer
+from nimbus.broker.metrics import BrokerMetrics, Histogram, merge_shards
+from nimbus.broker.storage import LogSegment, STORAGE_LOG
+from nimbus.broker.shard import shard_of, request_id_prefix, shard_of_request, shard_storage_path
+from nimbus.cluster import Cluster, HashRing
+from nimbus.statemanager import ConnectionStateManager
 
 REDIS_HOST = '192.168.0.237'
 REDIS_PORT = 6379
@@ -27,6 +39,10 @@ REQUEST_CONTENT3 = {b'method': METHOD.encode(),
                     b'endpoint': ENDPOINT2.encode(),
                     b'data': b'\x97'}
 
+REQUEST_CONTENT_HEADER = {b'method': METHOD.encode(),
+                          b'endpoint': ENDPOINT1.encode(),
+                          b'parameters': {b'a': b'1'}}
+
 Worker = namedtuple('Worker', 'id endpoints')
 WORKER1 = Worker('w1', [ENDPOINT1])
 WORKER2 = Worker('w2', [ENDPOINT1, ENDPOINT2])
@@ -80,6 +96,36 @@ class TestClientRequest(unittest.TestCase):
                          self.client_request)
 
 
+class TestClientRequestWithBody(unittest.TestCase):
+    def setUp(self):
+        self.body = msgpack.packb({b'counter': 1})
+        self.client_request = ClientRequest(SOURCE,
+                                            msgpack.packb(REQUEST_CONTENT_HEADER),
+                                            self.body)
+
+    def test_content(self):
+        content = copy.deepcopy(REQUEST_CONTENT_HEADER)
+        content.update({b'id': self.client_request.id.encode()})
+        self.assertEqual(content,
+                         self.client_request.content)
+
+    def test_frames(self):
+        self.assertEqual([self.client_request.packed_data, self.body],
+                         self.client_request.frames)
+        self.assertIs(self.body,
+                      self.client_request.frames[1])
+
+    def test_fromcache(self):
+        self.assertEqual(ClientRequest.fromcache(self.client_request.cached_data),
+                         self.client_request)
+
+    def test_frames_without_body(self):
+        client_request = ClientRequest(SOURCE,
+                                       msgpack.packb(REQUEST_CONTENT_HEADER))
+        self.assertEqual([client_request.packed_data],
+                         client_request.frames)
+
+
 class TestRequestQueue(unittest.TestCase):
 
     def setUp(self):
@@ -103,7 +149,7 @@ class TestRequestQueue(unittest.TestCase):
                          self.request_queue.generate_key_timestamp(self.client_request.id))
 
     def test_add_client_request(self):
-        self.assertEqual(len(self.redis.keys('*')), 3)
+        self.assertEqual(len(self.redis.keys('*')), 4)
         self.assertEqual(self.redis.get(self.request_queue.generate_key_content(self.client_request.id)),
                          self.client_request.cached_data)
         self.assertEqual(self.redis.get(self.request_queue.generate_key_status(self.client_request.id)).decode(),
@@ -121,7 +167,7 @@ class TestRequestQueue(unittest.TestCase):
         self.assertEqual(self.client_request,
                          self.request_queue[ID])
         self.assertEqual(2, len(self.request_queue))
-        self.assertEqual(6, len(self.redis.keys('*')))
+        self.assertEqual(7, len(self.redis.keys('*')))
 
     def test_delitem(self):
         ID = 'id_unrelated_to_client_request'
@@ -131,6 +177,20 @@ class TestRequestQueue(unittest.TestCase):
         self.assertEqual(0, len(self.request_queue))
         self.assertEqual(0, len(self.redis.keys('*')))
 
+    def test_delitem_keeps_order(self):
+        client_request2 = ClientRequest(source=SOURCE,
+                                        content=msgpack.packb(REQUEST_CONTENT1))
+        client_request3 = ClientRequest(source=SOURCE,
+                                        content=msgpack.packb(REQUEST_CONTENT1))
+        self.request_queue.append(client_request2)
+        self.request_queue.append(client_request3)
+        del self.request_queue[client_request2.id]
+        self.assertEqual([self.client_request, client_request3],
+                         [r for r in self.request_queue])
+        del self.request_queue[self.client_request.id]
+        self.assertEqual(client_request3.id,
+                         self.request_queue.peek().id)
+
     def test_iter(self):
         client_request2 = ClientRequest(source=SOURCE,
                                         content=msgpack.packb(REQUEST_CONTENT1))
@@ -154,6 +214,219 @@ class TestRequestQueue(unittest.TestCase):
         self.assertEqual(self.client_request.id,
                          self.request_queue.peek().id)
 
+    def test_requeue(self):
+        client_request2 = ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT1))
+        self.request_queue.append(client_request2)
+        self.request_queue.popitem()
+        self.request_queue.requeue(self.client_request.id)
+        self.assertEqual(self.client_request.id,
+                         self.request_queue.peek().id)
+        self.assertEqual(self.redis.get(self.request_queue.generate_key_status(self.client_request.id)).decode(),
+                         RequestQueue.STATUS_WAITING)
+        self.assertEqual(1,
+                         self.request_queue.attempts(self.client_request.id))
+
+
+class TestRequestQueueBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        self.redis.flushdb()
+
+        self.client_request = ClientRequest(SOURCE,
+                                            msgpack.packb(REQUEST_CONTENT1))
+        self.batch = RedisBatch(self.redis)
+        self.request_queue = RequestQueue(redis_host=REDIS_HOST,
+                                          redis_port=REDIS_PORT,
+                                          redis_db=REDIS_DB,
+                                          storage=RedisStorage(self.batch))
+
+    def test_writes_are_buffered(self):
+        self.request_queue.append(self.client_request)
+        self.assertEqual(0, len(self.redis.keys('*')))
+        self.assertEqual(2, len(self.batch))
+        self.batch.flush()
+        self.assertEqual(4, len(self.redis.keys('*')))
+        self.assertEqual(0, len(self.batch))
+
+    def test_read_from_memory(self):
+        self.request_queue.append(self.client_request)
+        self.assertEqual(self.client_request,
+                         self.request_queue[self.client_request.id])
+        self.assertEqual(2, len(self.batch))
+
+    def test_popitem(self):
+        self.request_queue.append(self.client_request)
+        self.assertEqual(self.client_request,
+                         self.request_queue.popitem())
+        self.batch.flush()
+        self.assertEqual(self.redis.get(self.request_queue.generate_key_status(self.client_request.id)).decode(),
+                         RequestQueue.STATUS_PROCESSING)
+
+    def test_delitem(self):
+        self.request_queue.append(self.client_request)
+        del self.request_queue[self.client_request.id]
+        self.batch.flush()
+        self.assertEqual(0, len(self.request_queue))
+        self.assertEqual(0, len(self.redis.keys('*')))
+
+
+class TestMemoryStorage(unittest.TestCase):
+    def setUp(self):
+        self.redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        self.redis.flushdb()
+
+        self.client_request = ClientRequest(SOURCE,
+                                            msgpack.packb(REQUEST_CONTENT1))
+        self.queue_manager = QueueManager(redis_host=REDIS_HOST,
+                                          redis_port=REDIS_PORT,
+                                          redis_db=REDIS_DB,
+                                          storage=MemoryStorage())
+
+    def test_nothing_is_stored(self):
+        self.queue_manager.append(self.client_request)
+        self.queue_manager.flush()
+        self.assertEqual(0, len(self.redis.keys('*')))
+        self.assertEqual(self.client_request,
+                         self.queue_manager.popitem([ENDPOINT1]))
+        self.queue_manager.remove(self.client_request.id)
+        self.assertEqual(0, len(self.queue_manager))
+
+
+class TestLogStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+        self.client_request1 = ClientRequest(SOURCE,
+                                             msgpack.packb(REQUEST_CONTENT1))
+        self.client_request2 = ClientRequest(SOURCE,
+                                             msgpack.packb(REQUEST_CONTENT2))
+        self.client_request3 = ClientRequest(SOURCE,
+                                             msgpack.packb(REQUEST_CONTENT3))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_queue_manager(self, storage):
+        return QueueManager(redis_host=REDIS_HOST,
+                            redis_port=REDIS_PORT,
+                            redis_db=REDIS_DB,
+                            storage=storage)
+
+    def test_load_storage(self):
+        storage = LogStorage(self.path, segment_size=4096)
+        queue_manager = self.create_queue_manager(storage)
+        for cr in [self.client_request1, self.client_request2, self.client_request3]:
+            queue_manager.append(cr)
+        queue_manager.popitem([ENDPOINT1, ENDPOINT2])
+        queue_manager.remove(self.client_request2.id)
+        storage.close()
+
+        queue_manager = self.create_queue_manager(LogStorage(self.path, segment_size=4096))
+        self.assertEqual(2,
+                         queue_manager.load_storage())
+        self.assertEqual(self.client_request1,
+                         queue_manager.popitem([ENDPOINT1, ENDPOINT2]))
+        self.assertEqual(self.client_request3,
+                         queue_manager.popitem([ENDPOINT1, ENDPOINT2]))
+
+    def test_load_storage_expire(self):
+        storage = LogStorage(self.path, segment_size=4096)
+        queue_manager = self.create_queue_manager(storage)
+        expired = ClientRequest(SOURCE, msgpack.packb(dict(REQUEST_CONTENT1, deadline=time.time() + 1)))
+        queue_manager.append(expired)
+        queue_manager.append(self.client_request2)
+        storage.close()
+
+        queue_manager = self.create_queue_manager(LogStorage(self.path, segment_size=4096))
+        self.assertEqual(2,
+                         queue_manager.load_storage())
+        self.assertEqual(1,
+                         queue_manager.expire(time.time() + 5))
+        self.assertEqual(self.client_request2,
+                         queue_manager.popitem([ENDPOINT1, ENDPOINT2]))
+
+    def test_new_segment(self):
+        storage = LogStorage(self.path, segment_size=256)
+        for cr in [self.client_request1, self.client_request2, self.client_request3]:
+            storage.add(cr.endpoint, cr.id, cr, 0.0)
+        storage.close()
+        self.assertEqual(3, len(os.listdir(self.path)))
+        self.assertEqual(cr.cached_data,
+                         LogStorage(self.path, segment_size=256).get(cr.endpoint, cr.id))
+
+    def test_compaction(self):
+        storage = LogStorage(self.path, segment_size=256)
+        for cr in [self.client_request1, self.client_request2, self.client_request3]:
+            storage.add(cr.endpoint, cr.id, cr, 0.0)
+        storage.remove(self.client_request1.endpoint, self.client_request1.id)
+        storage.remove(self.client_request2.endpoint, self.client_request2.id)
+        storage.flush()
+        self.assertEqual(2, len(os.listdir(self.path)))
+        storage.close()
+
+        storage = LogStorage(self.path, segment_size=256)
+        self.assertEqual({ENDPOINT2: ([self.client_request3.id], [0.0])},
+                         storage.load())
+
+    def test_interrupted_compaction(self):
+        storage = LogStorage(self.path, segment_size=512)
+        for cr in [self.client_request1, self.client_request2, self.client_request3]:
+            storage.add(cr.endpoint, cr.id, cr, 0.0)
+        storage.remove(self.client_request1.endpoint, self.client_request1.id)
+        storage.remove(self.client_request2.endpoint, self.client_request2.id)
+        oldest = os.path.join(self.path, LogSegment.FILENAME.format(0))
+        with open(oldest, 'rb') as f:
+            oldest_data = f.read()
+        storage.close()
+        # the broker stopped after the copy of the oldest segment, before it was deleted
+        self.assertFalse(os.path.exists(oldest))
+        with open(oldest, 'wb') as f:
+            f.write(oldest_data)
+
+        storage = LogStorage(self.path, segment_size=512)
+        self.assertEqual({ENDPOINT2: ([self.client_request3.id], [0.0])},
+                         storage.load())
+        storage.flush()
+        self.assertEqual(self.client_request3.cached_data,
+                         storage.get(self.client_request3.endpoint, self.client_request3.id))
+        storage.remove(self.client_request3.endpoint, self.client_request3.id)
+        storage.close()
+        self.assertEqual({},
+                         LogStorage(self.path, segment_size=512).load())
+
+    def test_torn_record(self):
+        for corrupt in [lambda data, offset, length: data[:offset + length // 2] + bytes(length - length // 2),
+                        lambda data, offset, length: data[:offset] + b'\xff' + data[offset + 1:]]:
+            storage = LogStorage(self.path, segment_size=4096)
+            for cr in [self.client_request1, self.client_request2, self.client_request3]:
+                storage.add(cr.endpoint, cr.id, cr, 0.0)
+            # the broker stopped while the last record was written
+            segment, offset, length, timestamp = storage._index[(self.client_request3.endpoint,
+                                                                 self.client_request3.id)]
+            storage.close()
+            with open(segment.path, 'rb') as f:
+                data = f.read()
+            with open(segment.path, 'wb') as f:
+                f.write(corrupt(data, offset, length))
+
+            storage = LogStorage(self.path, segment_size=4096)
+            self.assertEqual({ENDPOINT1: ([self.client_request1.id], [0.0]),
+                              ENDPOINT2: ([self.client_request2.id], [0.0])},
+                             storage.load())
+            # the log continues after the last complete record
+            storage.add(self.client_request3.endpoint, self.client_request3.id, self.client_request3, 0.0)
+            storage.close()
+            storage = LogStorage(self.path, segment_size=4096)
+            self.assertEqual(self.client_request3.cached_data,
+                             storage.get(self.client_request3.endpoint, self.client_request3.id))
+            for cr in [self.client_request1, self.client_request2, self.client_request3]:
+                storage.remove(cr.endpoint, cr.id)
+            storage.close()
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
+
 
 class TestQueueManager(unittest.TestCase):
     def setUp(self):
@@ -175,9 +448,63 @@ class TestQueueManager(unittest.TestCase):
         self.queue_manager.append(self.client_request2)
         self.queue_manager.append(self.client_request3)
 
-    def test_load_redis(self):
-        with self.assertRaises(NotImplementedError):
-            self.queue_manager.load_redis()
+    def test_load_storage(self):
+        self.append_requests()
+        self.queue_manager.popitem([ENDPOINT1, ENDPOINT2])
+        self.queue_manager.flush()
+
+        queue_manager = QueueManager(redis_host=REDIS_HOST,
+                                     redis_port=REDIS_PORT,
+                                     redis_db=REDIS_DB)
+        self.assertEqual(3,
+                         queue_manager.load_storage())
+        self.assertEqual(3,
+                         len(queue_manager))
+        self.assertEqual(self.redis.get(queue_manager.get_queue(ENDPOINT1).generate_key_status(
+            self.client_request1.id)).decode(), RequestQueue.STATUS_WAITING)
+
+        for cr in [self.client_request1, self.client_request2, self.client_request3]:
+            self.assertEqual(cr,
+                             queue_manager.popitem([ENDPOINT1, ENDPOINT2]))
+        with self.assertRaises(EmptyQueue):
+            queue_manager.popitem([ENDPOINT1, ENDPOINT2])
+
+        for cr in [self.client_request1, self.client_request2, self.client_request3]:
+            queue_manager.remove(cr.id)
+        queue_manager.flush()
+        self.assertEqual(0,
+                         len(self.redis.keys('*')))
+
+    def test_load_storage_expire(self):
+        expired = ClientRequest(SOURCE, msgpack.packb(dict(REQUEST_CONTENT1, deadline=time.time() + 1)))
+        waiting = ClientRequest(SOURCE, msgpack.packb(dict(REQUEST_CONTENT2, deadline=time.time() + 10)))
+        for cr in [expired, waiting, self.client_request3]:
+            self.queue_manager.append(cr)
+        self.queue_manager.flush()
+
+        queue_manager = QueueManager(redis_host=REDIS_HOST,
+                                     redis_port=REDIS_PORT,
+                                     redis_db=REDIS_DB)
+        self.assertEqual(3,
+                         queue_manager.load_storage())
+        self.assertEqual(1,
+                         queue_manager.expire(time.time() + 5))
+        self.assertNotIn(expired.id, queue_manager)
+        self.assertEqual(2,
+                         len(queue_manager))
+
+    def test_take_over(self):
+        storage = RedisStorage.connect(REDIS_HOST, REDIS_PORT, REDIS_DB, prefix='cluster:other:')
+        storage.add(ENDPOINT1, self.client_request1.id, self.client_request1, 1.0)
+        storage.add(ENDPOINT2, self.client_request2.id, self.client_request2, 2.0)
+        storage.flush()
+
+        self.assertEqual(2,
+                         self.queue_manager.take_over(storage))
+        self.assertEqual(self.client_request1,
+                         self.queue_manager.popitem([ENDPOINT1, ENDPOINT2]))
+        self.assertEqual(0,
+                         len(self.redis.keys('cluster:other:*')))
 
     def test_append_and_retrieve(self):
         self.append_requests()
@@ -206,6 +533,22 @@ class TestQueueManager(unittest.TestCase):
         with self.assertRaises(KeyError):
             self.queue_manager.remove('unknown_id')
 
+    def test_popitem(self):
+        self.append_requests()
+        self.assertEqual(self.client_request1,
+                         self.queue_manager.popitem([ENDPOINT1, ENDPOINT2]))
+        self.assertEqual(2,
+                         len(self.queue_manager))
+
+        # a ClientRequest that is being processed is retrieved without accessing redis
+        self.redis.flushdb()
+        self.assertEqual(self.client_request1,
+                         self.queue_manager.retrieve(self.client_request1.id))
+
+        self.queue_manager.remove(self.client_request1.id)
+        with self.assertRaises(KeyError):
+            self.queue_manager.retrieve(self.client_request1.id)
+
     def test_get_queue(self):
         self.append_requests()
         for cr in [self.client_request1, self.client_request2, self.client_request3]:
@@ -239,11 +582,36 @@ class TestQueueManager(unittest.TestCase):
         with self.assertRaises(EmptyQueue):
             self.queue_manager.select_queue([ENDPOINT1, ENDPOINT2])
 
+    def test_select_queue_subset(self):
+        self.append_requests()
+        self.assertEqual(self.client_request2,
+                         self.queue_manager.select_queue([ENDPOINT2]).popitem())
+        self.assertEqual(self.client_request1,
+                         self.queue_manager.select_queue([ENDPOINT1, ENDPOINT2]).popitem())
+        self.assertEqual(self.client_request3,
+                         self.queue_manager.select_queue([ENDPOINT1, ENDPOINT2]).popitem())
+        with self.assertRaises(EmptyQueue):
+            self.queue_manager.select_queue([ENDPOINT2])
+
+    def test_select_queue_after_remove(self):
+        self.append_requests()
+        self.queue_manager.select_queue([ENDPOINT1, ENDPOINT2])
+        self.queue_manager.remove(self.client_request1.id)
+        self.queue_manager.remove(self.client_request2.id)
+        self.assertEqual(self.client_request3,
+                         self.queue_manager.select_queue([ENDPOINT1, ENDPOINT2]).popitem())
+
     def test_len(self):
         self.append_requests()
         self.assertEqual(3,
                          len(self.queue_manager))
 
+    def test_flush(self):
+        self.append_requests()
+        self.assertEqual(0, len(self.redis.keys('*')))
+        self.queue_manager.flush()
+        self.assertEqual(11, len(self.redis.keys('*')))
+
 
 class TestRequestManager(unittest.TestCase):
     def setUp(self):
@@ -302,3 +670,684 @@ class TestRequestManager(unittest.TestCase):
 
         self.append_requests()
         self.register_workers()
+
+    def test_call_wakes_waiting_worker(self):
+        self.request_manager.register(WORKER1.id, WORKER1.endpoints)
+        self.assertEqual(0,
+                         len(self.request_manager()))
+
+        self.request_manager.append(self.client_request2)
+        self.assertEqual(0,
+                         len(self.request_manager()))
+
+        self.request_manager.append(self.client_request1)
+        self.assertEqual([(WORKER1.id, self.client_request1)],
+                         list(self.request_manager()))
+        self.assertEqual(0,
+                         len(self.request_manager()))
+
+    def test_call_available_worker(self):
+        self.append_requests()
+        self.request_manager.register(WORKER2.id, WORKER2.endpoints)
+        self.assertEqual([(WORKER2.id, self.client_request1)],
+                         list(self.request_manager()))
+        self.assertEqual(0,
+                         len(self.request_manager()))
+
+        self.request_manager.worker_available(WORKER2.id)
+        self.assertEqual([(WORKER2.id, self.client_request2)],
+                         list(self.request_manager()))
+
+    def test_call_credit(self):
+        self.append_requests()
+        self.request_manager.register(WORKER2.id, WORKER2.endpoints, credit=2)
+        self.assertEqual([(WORKER2.id, self.client_request1), (WORKER2.id, self.client_request2)],
+                         list(self.request_manager()))
+        self.assertEqual(0,
+                         self.request_manager.credit(WORKER2.id))
+
+        self.request_manager.worker_available(WORKER2.id)
+        self.assertEqual([(WORKER2.id, self.client_request3)],
+                         list(self.request_manager()))
+        self.assertEqual(0,
+                         self.request_manager.credit(WORKER2.id))
+
+    def test_call_credit_in_turn(self):
+        self.request_manager.register(WORKER1.id, WORKER1.endpoints, credit=2)
+        self.request_manager.register(WORKER2.id, WORKER2.endpoints, credit=2)
+        self.request_manager()
+        self.request_manager.append(self.client_request1)
+        self.request_manager.append(ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT1)))
+        self.assertEqual([WORKER1.id, WORKER2.id],
+                         [worker_id for worker_id, client_request in self.request_manager()])
+
+    def test_credit_is_capped(self):
+        self.request_manager.register(WORKER1.id, WORKER1.endpoints, credit=2)
+        self.request_manager.worker_available(WORKER1.id, credit=5)
+        self.assertEqual(2,
+                         self.request_manager.credit(WORKER1.id))
+
+    def test_expire(self):
+        expired = ClientRequest(SOURCE, msgpack.packb(dict(REQUEST_CONTENT1, deadline=time.time() - 1)))
+        waiting = ClientRequest(SOURCE, msgpack.packb(dict(REQUEST_CONTENT1, deadline=time.time() + 10)))
+        self.request_manager.append(expired)
+        self.request_manager.append(waiting)
+        self.request_manager.append(self.client_request1)
+        self.assertEqual(1,
+                         self.request_manager.expire())
+        self.assertEqual(2,
+                         len(self.request_manager))
+        self.assertEqual({'expired': 1},
+                         self.request_manager.counters)
+
+    def test_extend_deadline(self):
+        client_request = ClientRequest(SOURCE, msgpack.packb(dict(REQUEST_CONTENT1, deadline=time.time() - 1)))
+        self.request_manager.append(client_request)
+        self.request_manager.extend_deadline(client_request.id, time.time() + 10)
+        self.assertEqual(0,
+                         self.request_manager.expire())
+        self.assertFalse(client_request.expired(time.time()))
+        self.assertEqual(1,
+                         self.request_manager.expire(now=time.time() + 10))
+        self.assertNotIn(client_request.id,
+                         self.request_manager)
+
+    def test_call_drops_expired(self):
+        self.request_manager.append(ClientRequest(SOURCE, msgpack.packb(dict(REQUEST_CONTENT1,
+                                                                             deadline=time.time() - 1))))
+        self.request_manager.append(self.client_request1)
+        self.request_manager.register(WORKER1.id, WORKER1.endpoints)
+        self.assertEqual([(WORKER1.id, self.client_request1)],
+                         list(self.request_manager()))
+        self.assertEqual({'expired': 1},
+                         self.request_manager.counters)
+
+    def test_unregister_redelivers(self):
+        self.request_manager.register(WORKER1.id, WORKER1.endpoints)
+        self.request_manager.append(self.client_request1)
+        self.assertEqual([(WORKER1.id, self.client_request1)],
+                         list(self.request_manager()))
+        self.request_manager.append(ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT1)))
+
+        self.request_manager.unregister(WORKER1.id)
+        self.request_manager.register(WORKER2.id, WORKER2.endpoints)
+        self.assertEqual([(WORKER2.id, self.client_request1)],
+                         list(self.request_manager()))
+        self.assertEqual({'redelivered': 1},
+                         self.request_manager.counters)
+
+    def test_unregister_max_attempts(self):
+        request_manager = RequestManager(redis_host=REDIS_HOST,
+                                         redis_port=REDIS_PORT,
+                                         redis_db=REDIS_DB,
+                                         max_attempts=1)
+        request_manager.register(WORKER1.id, WORKER1.endpoints)
+        request_manager.append(self.client_request1)
+        request_manager()
+        request_manager.unregister(WORKER1.id)
+        self.assertEqual(0,
+                         len(request_manager))
+        self.assertEqual({'attempts_exceeded': 1},
+                         request_manager.counters)
+
+    def test_unregister(self):
+        self.register_workers()
+        self.request_manager.unregister(WORKER1.id)
+        self.request_manager.unregister(WORKER2.id)
+        self.append_requests()
+        self.assertEqual(0,
+                         len(self.request_manager()))
+        self.assertEqual([],
+                         self.request_manager.registered_workers)
+
+    def test_unregister_deletes_heaps(self):
+        scheduler = self.request_manager._manager._scheduler
+        self.register_workers()
+        self.request_manager.register('w3', WORKER1.endpoints)
+        self.request_manager.unregister(WORKER1.id)
+        self.assertEqual({frozenset(WORKER1.endpoints), frozenset(WORKER2.endpoints)},
+                         set(scheduler._heap_by_endpoints))
+
+        self.request_manager.unregister('w3')
+        self.assertEqual({frozenset(WORKER2.endpoints)},
+                         set(scheduler._heap_by_endpoints))
+        self.assertEqual({ENDPOINT1: [frozenset(WORKER2.endpoints)], ENDPOINT2: [frozenset(WORKER2.endpoints)]},
+                         dict((endpoint, [endpoints for endpoints, heap in heaps])
+                              for endpoint, heaps in scheduler._heaps_by_endpoint.items()))
+
+        # the heap of a set of endpoints that is registered again is up to date
+        self.append_requests()
+        self.request_manager.register(WORKER1.id, WORKER1.endpoints)
+        self.request_manager.unregister(WORKER2.id)
+        self.assertEqual([(WORKER1.id, self.client_request1)],
+                         self.request_manager())
+        self.assertEqual({frozenset(WORKER1.endpoints)},
+                         set(scheduler._heap_by_endpoints))
+
+
+class TestShardedBroker(unittest.TestCase):
+    def setUp(self):
+        self.broker = ShardedBroker(worker_response_bind=None,
+                                    worker_control_bind=None,
+                                    client_bind=None,
+                                    shards=2)
+        self.endpoint0 = next(e for e in [ENDPOINT1, ENDPOINT2, 'e1', 'e2', 'e3'] if shard_of(e, 2) == 0)
+        self.endpoint1 = next(e for e in [ENDPOINT1, ENDPOINT2, 'e1', 'e2', 'e3'] if shard_of(e, 2) == 1)
+
+    def test_request_id(self):
+        client_request = ClientRequest(SOURCE,
+                                       msgpack.packb(REQUEST_CONTENT1),
+                                       id_prefix=request_id_prefix(1))
+        self.assertEqual(1,
+                         shard_of_request(client_request.id))
+        self.assertEqual(1,
+                         shard_of_request(ClientRequest.fromcache(client_request.cached_data).id))
+        self.assertIsNone(shard_of_request(ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT1)).id))
+
+    def test_register(self):
+        self.assertEqual([(0, {'endpoints': [self.endpoint0], 'credit': 2}),
+                          (1, {'endpoints': [self.endpoint1], 'credit': 1})],
+                         self.broker._route_control(b'w1', {'endpoints': [self.endpoint0, self.endpoint1],
+                                                            'credit': 3}))
+
+    def test_register_again(self):
+        self.broker._route_control(b'w1', {'endpoints': [self.endpoint0, self.endpoint1]})
+        self.assertEqual([(0, {'disconnect': True}),
+                          (1, {'disconnect': True}),
+                          (1, {'endpoints': [self.endpoint1], 'credit': 1})],
+                         self.broker._route_control(b'w1', {'endpoints': [self.endpoint1]}))
+
+    def test_credit(self):
+        self.broker._route_control(b'w1', {'endpoints': [self.endpoint0, self.endpoint1]})
+        self.assertEqual([(1, {'w': 1, 'id': '1.abc'})],
+                         self.broker._route_control(b'w1', {'w': 1, 'id': '1.abc'}))
+
+        # without an id, the credit goes to the shard of the last received request
+        self.broker._route_control(b'w1', {'r': '0.abc'})
+        self.assertEqual([(0, {'w': True})],
+                         self.broker._route_control(b'w1', {'w': True}))
+
+    def test_credit_below_shards(self):
+        # every shard needs credit, the front-end keeps the worker within its own credit
+        self.assertEqual([(0, {'endpoints': [self.endpoint0], 'credit': 1}),
+                          (1, {'endpoints': [self.endpoint1], 'credit': 1})],
+                         self.broker._route_control((b'w1',), {'endpoints': [self.endpoint0, self.endpoint1],
+                                                               'credit': 1}))
+        request0 = [b'w1', b'', msgpack.packb({'id': '0.abc'})]
+        request1 = [b'w1', b'', msgpack.packb({'id': '1.abc'})]
+        ping = [b'w1', b'', msgpack.packb(ControlRequest(ControlRequest.PING).content)]
+        self.assertEqual([request0], self.broker._hold(request0))
+        self.assertEqual([], self.broker._hold(request1))
+        self.assertEqual([ping], self.broker._hold(ping))
+        self.assertEqual([], self.broker._release((b'w1',)))
+
+        self.broker._route_control((b'w1',), {'done': '0.abc'})
+        self.assertEqual([request1], self.broker._release((b'w1',)))
+        self.assertEqual([], self.broker._release((b'w1',)))
+
+        # other workers are not held back
+        self.broker._route_control((b'w2',), {'endpoints': [self.endpoint0, self.endpoint1], 'credit': 2})
+        request2 = [b'w2', b'', msgpack.packb({'id': '0.def'})]
+        self.assertEqual([request2], self.broker._hold(request2))
+        self.assertEqual([request2], self.broker._hold(request2))
+
+    def test_repartition_storage(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        client_requests = [ClientRequest(SOURCE, msgpack.packb({b'method': METHOD.encode(),
+                                                                b'endpoint': endpoint.encode()}))
+                           for endpoint in [self.endpoint0, self.endpoint1]]
+        storage = LogStorage(directory.name)
+        for client_request in client_requests:
+            storage.add(client_request.endpoint, client_request.id, client_request, time.time())
+        storage.close()
+
+        # from a broker that is not sharded to two shards
+        self.assertEqual(2, repartition_storage(STORAGE_LOG, 2, path=directory.name))
+        self.assertEqual({}, LogStorage(directory.name).load())
+        for shard, client_request in enumerate(client_requests):
+            storage = LogStorage(shard_storage_path(directory.name, shard))
+            ids, timestamps = storage.load()[client_request.endpoint]
+            self.assertEqual(shard, shard_of_request(ids[0]))
+            self.assertEqual(client_request.content[b'endpoint'],
+                             ClientRequest.fromcache(storage.get(client_request.endpoint, ids[0])).content[b'endpoint'])
+            storage.close()
+        self.assertEqual(0, repartition_storage(STORAGE_LOG, 2, path=directory.name))
+
+        # and back
+        self.assertEqual(2, repartition_storage(STORAGE_LOG, 1, path=directory.name))
+        self.assertEqual({self.endpoint0, self.endpoint1}, set(LogStorage(directory.name).load()))
+
+    def test_register_cache(self):
+        self.assertEqual([(0, {'endpoints': [self.endpoint0], 'credit': 1, 'cache': [['GET', self.endpoint0, 10]]}),
+                          (1, {'endpoints': [self.endpoint1], 'credit': 1, 'cache': []})],
+                         self.broker._route_control(b'w1', {'endpoints': [self.endpoint0, self.endpoint1],
+                                                            'credit': 2,
+                                                            'cache': [['GET', self.endpoint0, 10]]}))
+
+    def test_done(self):
+        self.broker._route_control(b'w1', {'endpoints': [self.endpoint0, self.endpoint1]})
+        self.assertEqual([(1, {'done': '1.abc'})],
+                         self.broker._route_control(b'w1', {'done': '1.abc'}))
+        self.assertEqual([],
+                         self.broker._route_control(b'w1', {'done': 'abc'}))
+
+    def test_ping(self):
+        self.assertEqual([(0, {'ping': True})],
+                         self.broker._route_control(b'w1', {'ping': True}))
+        self.broker._route_control(b'w1', {'endpoints': [self.endpoint1]})
+        self.assertEqual([(1, {'ping': True})],
+                         self.broker._route_control(b'w1', {'ping': True}))
+
+
+class TestBrokerControl(unittest.TestCase):
+    def setUp(self):
+        url = 'inproc://test-broker-control-{}-'.format(uuid.uuid4().hex)
+        self.broker = Broker(worker_response_bind=url + 'response',
+                             worker_control_bind=url + 'control',
+                             client_bind=url + 'client')
+        self.client = zmq.Context.instance().socket(zmq.DEALER)
+        self.client.setsockopt(zmq.IDENTITY, b'client')
+        self.client.connect(url + 'client')
+        # the broker only routes to clients it has heard from
+        self.client.send_multipart([b'', b'hello'])
+        self.broker._client_socket.recv_multipart()
+
+        self.request_manager = RequestManager(redis_host=REDIS_HOST,
+                                              redis_port=REDIS_PORT,
+                                              redis_db=REDIS_DB,
+                                              storage=MemoryStorage())
+        self.state_manager = ConnectionStateManager(seconds_before_contact_check=5,
+                                                    seconds_before_disconnect=10)
+        self.response = msgpack.packb({'status': 200, 'response': 'OK'})
+
+    def tearDown(self):
+        self.client.close(linger=0)
+        for socket in [self.broker._worker_response_socket, self.broker._worker_control_socket,
+                       self.broker._client_socket]:
+            socket.close(linger=0)
+
+    def control(self, content, *frames):
+        self.broker.handle_control(self.request_manager, self.state_manager,
+                                   [b'w1', b'', msgpack.packb(content)] + list(frames), time.time())
+
+    def dispatch(self):
+        client_request = ClientRequest([b'client'], msgpack.packb(REQUEST_CONTENT1))
+        self.request_manager.append(client_request)
+        self.assertEqual([((b'w1',), client_request)],
+                         self.request_manager())
+        self.assertEqual(0,
+                         self.request_manager.credit((b'w1',)))
+        return client_request
+
+    def test_done(self):
+        self.control({'endpoints': [ENDPOINT1], 'credit': 1, 'cache': [[METHOD, ENDPOINT1, 10]]})
+        client_request = self.dispatch()
+
+        self.control({'done': client_request.id}, self.response)
+        self.assertTrue(self.client.poll(1000))
+        self.assertEqual([b'', self.response],
+                         self.client.recv_multipart())
+        self.assertEqual(1,
+                         self.request_manager.credit((b'w1',)))
+        self.assertNotIn(client_request.id, self.request_manager)
+        self.assertEqual(self.response,
+                         self.broker.cache.get(ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT1))))
+
+    def test_done_not_cached(self):
+        self.control({'endpoints': [ENDPOINT1], 'credit': 1})
+        client_request = self.dispatch()
+
+        self.control({'done': client_request.id}, self.response)
+        self.assertTrue(self.client.poll(1000))
+        self.assertEqual([b'', self.response],
+                         self.client.recv_multipart())
+        self.assertEqual(1,
+                         self.request_manager.credit((b'w1',)))
+        self.assertIsNone(self.broker.cache.get(ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT1))))
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(max_entries=2, max_bytes=1024)
+        self.cache.set_ttl(METHOD, ENDPOINT1, 10)
+        self.response = msgpack.packb({'status': 200, 'response': 'OK'})
+
+    def client_request(self, parameters=None, endpoint=ENDPOINT1, body=None, data=None):
+        content = {b'method': METHOD.encode(), b'endpoint': endpoint.encode(), b'deadline': time.time()}
+        if parameters is not None:
+            content[b'parameters'] = parameters
+        if data is not None:
+            content[b'data'] = data
+        return ClientRequest(SOURCE, msgpack.packb(content), body)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get(self.client_request({b'a': 1, b'b': 2}), now=0))
+        self.assertTrue(self.cache.put(self.client_request({b'a': 1, b'b': 2}), self.response, now=0))
+        self.assertEqual(self.response,
+                         self.cache.get(self.client_request({b'b': 2, b'a': 1}), now=1))
+        self.assertIsNone(self.cache.get(self.client_request({b'a': 2, b'b': 2}), now=1))
+        self.assertEqual({'hits': 1, 'misses': 2},
+                         self.cache.counters)
+
+    def test_header_data(self):
+        # data in the header, as sent by clients before the body frame
+        self.cache.put(self.client_request(data={b'user': 1}), self.response, now=0)
+        self.assertEqual(self.response,
+                         self.cache.get(self.client_request(data={b'user': 1}), now=1))
+        self.assertIsNone(self.cache.get(self.client_request(data={b'user': 2}), now=1))
+
+    def test_ttl(self):
+        self.cache.put(self.client_request(), self.response, now=0)
+        self.assertIsNone(self.cache.get(self.client_request(), now=10))
+        self.assertEqual(0,
+                         len(self.cache))
+        self.assertEqual(0,
+                         self.cache.size)
+
+    def test_not_cacheable(self):
+        self.assertFalse(self.cache.put(self.client_request(endpoint=ENDPOINT2), self.response))
+        self.assertFalse(self.cache.put(self.client_request(body=b'\x99'), self.response))
+        self.assertFalse(self.cache.put(self.client_request(), msgpack.packb({'status': 500, 'response': {}})))
+        self.cache.set_ttl('POST', ENDPOINT2, 10)
+        self.assertFalse(self.cache.put(ClientRequest(SOURCE, msgpack.packb({b'method': b'POST',
+                                                                              b'endpoint': ENDPOINT2.encode()})),
+                                        self.response))
+        self.assertEqual({},
+                         self.cache.counters)
+
+    def test_lru_eviction(self):
+        for i in range(3):
+            self.cache.put(self.client_request({b'i': i}), self.response, now=0)
+            # the first response stays, because it is used
+            self.cache.get(self.client_request({b'i': 0}), now=0)
+        self.assertIsNotNone(self.cache.get(self.client_request({b'i': 0}), now=0))
+        self.assertIsNone(self.cache.get(self.client_request({b'i': 1}), now=0))
+        self.assertIsNotNone(self.cache.get(self.client_request({b'i': 2}), now=0))
+        self.assertEqual(1,
+                         self.cache.counters['evictions'])
+
+    def test_memory_cap(self):
+        entry_size = len(self.cache.key(self.client_request({b'i': 0}))) + len(self.response)
+        cache = ResponseCache(max_entries=100, max_bytes=2 * entry_size + 1)
+        cache.set_ttl(METHOD, ENDPOINT1, 10)
+        for i in range(10):
+            cache.put(self.client_request({b'i': i}), self.response)
+        self.assertEqual(2 * entry_size,
+                         cache.size)
+        self.assertEqual(2,
+                         len(cache))
+        self.assertFalse(cache.put(self.client_request({b'i': b'x' * 1024}), self.response))
+
+
+class TestRequestCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.coalescer = RequestCoalescer()
+        self.coalescer.set_coalesce(METHOD, ENDPOINT1)
+        self.pending = set()
+
+    def client_request(self, source, parameters=None, body=None, deadline=10):
+        content = {b'method': METHOD.encode(), b'endpoint': ENDPOINT1.encode(), b'deadline': deadline}
+        if parameters is not None:
+            content[b'parameters'] = parameters
+        return ClientRequest([source], msgpack.packb(content), body)
+
+    def follow(self, client_request):
+        leader_id = self.coalescer.follow(client_request, is_pending=self.pending.__contains__)
+        if leader_id is None:
+            self.pending.add(client_request.id)
+        return leader_id
+
+    def test_follow(self):
+        leader = self.client_request(b'c1', {b'a': 1, b'b': 2})
+        self.assertIsNone(self.follow(leader))
+        self.assertEqual(leader.id,
+                         self.follow(self.client_request(b'c2', {b'b': 2, b'a': 1}, deadline=20)))
+        self.assertEqual(leader.id,
+                         self.follow(self.client_request(b'c3', {b'a': 1, b'b': 2})))
+        self.assertEqual(20,
+                         self.coalescer.deadline(leader.id))
+        self.assertEqual([[b'c2'], [b'c3']],
+                         self.coalescer.sources(leader.id))
+        self.assertEqual({'coalesced': 2},
+                         self.coalescer.counters)
+
+        # after the response, the next identical ClientRequest is dispatched again
+        self.assertEqual(0,
+                         len(self.coalescer))
+        self.assertIsNone(self.follow(self.client_request(b'c4', {b'a': 1, b'b': 2})))
+
+    def test_different(self):
+        self.assertIsNone(self.follow(self.client_request(b'c1', {b'a': 1})))
+        self.assertIsNone(self.follow(self.client_request(b'c2', {b'a': 2})))
+        self.assertIsNone(self.follow(self.client_request(b'c3', {b'a': 1}, body=b'\x99')))
+        self.assertIsNone(self.follow(self.client_request(b'c4', {b'a': 1}, body=b'\x98')))
+        self.assertIsNotNone(self.follow(self.client_request(b'c5', {b'a': 1}, body=b'\x98')))
+        self.assertIsNone(self.follow(self.client_request(b'c6', {b'a': 1}, deadline=None)))
+
+    def test_not_pending(self):
+        leader = self.client_request(b'c1')
+        self.follow(leader)
+        self.pending.remove(leader.id)
+        self.assertIsNone(self.follow(self.client_request(b'c2')))
+        self.assertEqual([],
+                         self.coalescer.sources(leader.id))
+
+    def test_expire(self):
+        self.follow(self.client_request(b'c1', deadline=10))
+        self.follow(self.client_request(b'c2', deadline=20))
+        self.coalescer.expire(now=10)
+        self.assertEqual(1,
+                         len(self.coalescer))
+        self.coalescer.expire(now=20)
+        self.assertEqual(0,
+                         len(self.coalescer))
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+        self.assertEqual(['h_bucket{e="x",le="0.1"} 2',
+                          'h_bucket{e="x",le="1.0"} 3',
+                          'h_bucket{e="x",le="+Inf"} 4',
+                          'h_sum{e="x"} 2.65',
+                          'h_count{e="x"} 4'],
+                         histogram.lines('h', 'e="x",'))
+
+
+class TestBrokerMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = BrokerMetrics()
+        self.request_manager = RequestManager(REDIS_HOST, REDIS_PORT, REDIS_DB, storage=MemoryStorage())
+        self.worker_id = (b'\x00w1',)
+
+    def test_render(self):
+        client_request = ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT1))
+        self.request_manager.append(client_request)
+        self.request_manager.append(ClientRequest(SOURCE, msgpack.packb(REQUEST_CONTENT2)))
+        self.request_manager.register(self.worker_id, [ENDPOINT1], credit=2)
+        self.metrics.registered(self.worker_id, client_request.received)
+        [(worker_id, dispatched)] = self.request_manager()
+        dispatched.dispatched = client_request.received + 1
+        self.metrics.dispatched(dispatched, dispatched.dispatched)
+        self.metrics.responded(dispatched, worker_id, client_request.received + 3)
+        self.metrics.loop(0.002)
+
+        lines = self.metrics.render(self.request_manager,
+                                    counters={'expired': 1},
+                                    now=client_request.received + 4).splitlines()
+        self.assertIn('nimbus_broker_queue_depth{endpoint="invoice"} 1', lines)
+        self.assertIn('nimbus_broker_queue_depth{endpoint="account"} 0', lines)
+        self.assertIn('nimbus_broker_wait_seconds_count{endpoint="account"} 1', lines)
+        self.assertIn('nimbus_broker_service_seconds_sum{endpoint="account"} 2.0', lines)
+        self.assertIn('nimbus_broker_loop_seconds_count 1', lines)
+        self.assertIn('nimbus_broker_worker_in_flight{worker="007731"} 1', lines)
+        self.assertIn('nimbus_broker_worker_busy_seconds_total{worker="007731"} 2.0', lines)
+        self.assertIn('nimbus_broker_worker_utilisation{worker="007731"} 0.250000', lines)
+        self.assertIn('nimbus_broker_expired_total 1', lines)
+
+    def test_merge_shards(self):
+        texts = ['# TYPE nimbus_broker_queue_depth gauge\n'
+                 'nimbus_broker_queue_depth{{endpoint="e{0}"}} {0}\n'
+                 '# TYPE nimbus_broker_expired_total counter\n'
+                 'nimbus_broker_expired_total {0}\n'.format(shard) for shard in range(2)]
+        self.assertEqual('# TYPE nimbus_broker_queue_depth gauge\n'
+                         'nimbus_broker_queue_depth{shard="0",endpoint="e0"} 0\n'
+                         'nimbus_broker_queue_depth{shard="1",endpoint="e1"} 1\n'
+                         '# TYPE nimbus_broker_expired_total counter\n'
+                         'nimbus_broker_expired_total{shard="0"} 0\n'
+                         'nimbus_broker_expired_total{shard="1"} 1\n',
+                         merge_shards(texts))
+
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stats', 'broker.prom')
+            BrokerMetrics.write('a 1\n', path)
+            with open(path) as f:
+                self.assertEqual('a 1\n',
+                                 f.read())
+
+
+class TestConnectionStateManager(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.state_manager = ConnectionStateManager(seconds_before_contact_check=5,
+                                                    seconds_before_disconnect=10,
+                                                    jitter=0.1,
+                                                    clock=lambda: self.now)
+
+    def test_ping_and_disconnect(self):
+        self.state_manager.contact_from(b'w1')
+        self.now = 4.9
+        self.assertEqual([],
+                         self.state_manager.get_connections_to_ping())
+        self.now = 5.5
+        self.assertEqual([b'w1'],
+                         self.state_manager.get_connections_to_ping())
+        self.assertEqual([],
+                         self.state_manager.get_connections_to_ping())
+        self.now = 15.4
+        self.assertEqual([],
+                         self.state_manager.get_connections_to_disconnect())
+        self.now = 15.5
+        self.assertEqual([b'w1'],
+                         self.state_manager.get_connections_to_disconnect())
+
+    def test_contact_postpones_ping(self):
+        self.state_manager.contact_from(b'w1')
+        self.now = 4
+        self.state_manager.contact_from(b'w1')
+        self.now = 6
+        self.assertEqual([],
+                         self.state_manager.get_connections_to_ping())
+        self.now = 9.6
+        self.assertEqual([b'w1'],
+                         self.state_manager.get_connections_to_ping())
+
+    def test_answer_prevents_disconnect(self):
+        self.state_manager.contact_from(b'w1')
+        self.now = 6
+        self.state_manager.get_connections_to_ping()
+        self.now = 7
+        self.state_manager.contact_from(b'w1')
+        self.now = 16
+        self.assertEqual([],
+                         self.state_manager.get_connections_to_disconnect())
+        self.assertEqual([b'w1'],
+                         self.state_manager.get_connections_to_ping())
+
+    def test_disconnect(self):
+        self.state_manager.contact_from(b'w1')
+        self.state_manager.disconnect(b'w1')
+        self.now = 100
+        self.assertEqual([],
+                         self.state_manager.get_connections_to_ping())
+        self.assertEqual([],
+                         self.state_manager.get_connections_to_disconnect())
+
+    def test_jitter(self):
+        for i in range(100):
+            self.state_manager.contact_from(i)
+        # the pings are spread between seconds_before_contact_check and 10% later
+        self.now = 5.25
+        pinged = len(self.state_manager.get_connections_to_ping())
+        self.assertTrue(0 < pinged < 100)
+        self.now = 5.5
+        self.assertEqual(100 - pinged,
+                         len(self.state_manager.get_connections_to_ping()))
+
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.endpoints = ['endpoint{}'.format(i) for i in range(1000)]
+
+    def test_node_of(self):
+        ring = HashRing(['n1', 'n2', 'n3'])
+        nodes = [ring.node_of(endpoint) for endpoint in self.endpoints]
+        self.assertEqual(nodes,
+                         [HashRing(['n3', 'n2', 'n1']).node_of(endpoint) for endpoint in self.endpoints])
+        for node in ['n1', 'n2', 'n3']:
+            self.assertGreater(nodes.count(node), 200)
+
+    def test_only_endpoints_of_leaving_node_move(self):
+        ring = HashRing(['n1', 'n2', 'n3'])
+        smaller_ring = HashRing(['n1', 'n2'])
+        for endpoint in self.endpoints:
+            if ring.node_of(endpoint) != 'n3':
+                self.assertEqual(ring.node_of(endpoint),
+                                 smaller_ring.node_of(endpoint))
+
+    def test_empty(self):
+        self.assertIsNone(HashRing([]).node_of(ENDPOINT1))
+
+
+class TestCluster(unittest.TestCase):
+    def setUp(self):
+        self.redis = StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        self.redis.flushdb()
+
+        self.urls = {Cluster.CLIENT: 'tcp://n1:5000',
+                     Cluster.WORKER_CONTROL: 'tcp://n1:5001',
+                     Cluster.WORKER_RESPONSE: 'tcp://n1:5002'}
+        self.node = Cluster(REDIS_HOST, REDIS_PORT, REDIS_DB, node_id='n1', urls=self.urls)
+        self.other_node = Cluster(REDIS_HOST, REDIS_PORT, REDIS_DB, node_id='n2', urls=self.urls)
+        self.client = Cluster(REDIS_HOST, REDIS_PORT, REDIS_DB)
+
+    def test_join(self):
+        self.node.join()
+        self.assertEqual({'n1': self.urls},
+                         self.client.nodes())
+        self.assertEqual(HashRing(['n1']),
+                         self.client.ring())
+
+    def test_leave_and_take_over(self):
+        self.node.join()
+        self.node.leave()
+        self.assertEqual({},
+                         self.client.nodes())
+        self.assertEqual(['n1'],
+                         self.other_node.dead_nodes())
+        self.assertTrue(self.other_node.claim('n1'))
+        self.assertFalse(Cluster(REDIS_HOST, REDIS_PORT, REDIS_DB, node_id='n3').claim('n1'))
+        self.other_node.forget('n1')
+        self.assertEqual([],
+                         self.other_node.dead_nodes())
+
+    def test_heartbeat_after_take_over(self):
+        self.node.join()
+        self.assertTrue(self.node.heartbeat())
+        # the key expired during a pause of n1
+        self.redis.delete(Cluster.KEY_ALIVE + 'n1')
+        self.assertTrue(self.other_node.claim('n1'))
+        self.assertFalse(self.node.heartbeat())
+        self.assertEqual({},
+                         self.client.nodes())
+        self.other_node.forget('n1')
+        self.node.wait_for_takeover()
+        self.assertFalse(self.node.heartbeat())
+        self.node.join()
+        self.assertTrue(self.node.heartbeat())
+        self.assertEqual({'n1': self.urls},
+                         self.client.nodes())
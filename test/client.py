@@ -0,0 +1,249 @@
+import asyncio
+import threading
+import unittest
+import uuid
+from unittest import mock
+
+import msgpack
+import zmq
+
+from nimbus.client import AsyncClient, Client, ClientPool, ClusterClient, Response, pack_request, unpack_response
+from nimbus.cluster import Cluster
+from nimbus.helpers import split_message
+
+
+
+class TestPackRequest(unittest.TestCase):
+    def test_pack_request(self):
+        frames = pack_request('GET', 'endpoint', {'a': 1}, {'b': 2}, 10)
+        self.assertEqual(2, len(frames))
+        header = msgpack.unpackb(frames[0])
+        self.assertEqual(b'GET', header[b'method'])
+        self.assertEqual({b'a': 1}, header[b'parameters'])
+        self.assertEqual({b'b': 2}, msgpack.unpackb(frames[1]))
+
+    def test_unpack_response(self):
+        zmq_response = msgpack.packb({'status': 200, 'response': 'OK'})
+        self.assertEqual(Response('OK', 200), unpack_response(zmq_response))
+        self.assertEqual(Response(b'OK', 200), unpack_response(zmq_response, decode_response=False))
+
+
+class TestAsyncClient(unittest.TestCase):
+    def setUp(self):
+        # a new address for every test, the socket of the previous test may not be closed yet
+        self.url = 'inproc://test-client-{}'.format(uuid.uuid4().hex)
+        self.broker = zmq.Context.instance().socket(zmq.ROUTER)
+        self.broker.bind(self.url)
+
+    def tearDown(self):
+        self.broker.close(linger=0)
+
+    def _respond(self, count):
+        """
+        Receive count requests and respond to them in reverse order, with the endpoint as response.
+        """
+        requests = []
+        for _ in range(count):
+            source, content = split_message(self.broker.recv_multipart())
+            requests.append((source, msgpack.unpackb(content[0])[b'endpoint']))
+        for source, endpoint in reversed(requests):
+            self.broker.send_multipart(source + [b'', msgpack.packb({'status': 200, 'response': endpoint})])
+
+    def test_out_of_order(self):
+        async def run():
+            client = AsyncClient(self.url, timeout=5)
+            requests = [client.get('endpoint{}'.format(i)) for i in range(10)]
+            responder = asyncio.get_running_loop().run_in_executor(None, self._respond, 10)
+            responses = await asyncio.gather(*requests)
+            await responder
+            self.assertEqual(0, client.pending)
+            client.close()
+            return responses
+
+        responses = asyncio.run(run())
+        self.assertEqual([Response('endpoint{}'.format(i), 200) for i in range(10)], responses)
+
+    def test_timeout(self):
+        async def run():
+            client = AsyncClient(self.url, timeout=0.1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await client.get('endpoint')
+            self.assertEqual(0, client.pending)
+            client.close()
+
+        asyncio.run(run())
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        # a new address for every test, the socket of the previous test may not be closed yet
+        self.url = 'inproc://test-client-{}'.format(uuid.uuid4().hex)
+        self.broker = zmq.Context.instance().socket(zmq.ROUTER)
+        self.broker.bind(self.url)
+        self.client = Client(self.url, timeout=5)
+        self.beyond_window = []
+
+    def tearDown(self):
+        self.client.close()
+        self.broker.close(linger=0)
+
+    def _respond(self, count, window):
+        """
+        Receive the requests window by window, and respond to every window in reverse order.
+        """
+        while count > 0:
+            requests = []
+            for _ in range(min(window, count)):
+                source, content = split_message(self.broker.recv_multipart())
+                requests.append((source, msgpack.unpackb(content[0])[b'endpoint']))
+            # nothing more is sent until there are responses
+            self.beyond_window.append(self.broker.poll(50))
+            for source, endpoint in reversed(requests):
+                self.broker.send_multipart(source + [b'', msgpack.packb({'status': 200, 'response': endpoint})])
+            count -= len(requests)
+
+    def test_send_many(self):
+        responder = threading.Thread(target=self._respond, args=(7, 3))
+        responder.start()
+        responses = self.client.send_many([('GET', 'endpoint{}'.format(i)) for i in range(7)], window=3)
+        responder.join()
+        self.assertEqual([Response('endpoint{}'.format(i), 200) for i in range(7)], responses)
+        self.assertEqual([0, 0, 0], self.beyond_window)
+
+    def test_pipeline(self):
+        responder = threading.Thread(target=self._respond, args=(2, 2))
+        responder.start()
+        with self.client.pipeline() as pipeline:
+            pipeline.get('endpoint0')
+            pipeline.post('endpoint1', data={'a': 1})
+            responses = pipeline.execute()
+        responder.join()
+        self.assertEqual([Response('endpoint0', 200), Response('endpoint1', 200)], responses)
+
+    def test_timeout(self):
+        client = Client(self.url, timeout=0.1)
+        with client.pipeline() as pipeline:
+            pipeline.get('endpoint')
+            with self.assertRaises(TimeoutError):
+                pipeline.execute()
+        client.close()
+
+    def test_late_response(self):
+        client = Client(self.url, timeout=0.1)
+        with client.pipeline() as pipeline:
+            pipeline.get('slow')
+            with self.assertRaises(TimeoutError):
+                pipeline.execute()
+        slow, _ = split_message(self.broker.recv_multipart())
+
+        with client.pipeline() as pipeline:
+            pipeline.get('fast')
+            fast, _ = split_message(self.broker.recv_multipart())
+            # the response of the first pipeline arrives after it gave up on it
+            for source, endpoint in [(slow, 'slow'), (fast, 'fast')]:
+                self.broker.send_multipart(source + [b'', msgpack.packb({'status': 200, 'response': endpoint})])
+            self.assertEqual([Response('fast', 200)], pipeline.execute())
+        client.close()
+
+
+class TestClusterClient(unittest.TestCase):
+    def setUp(self):
+        self.brokers = dict()
+        urls_by_node = dict()
+        for node_id in ['n1', 'n2']:
+            url = 'inproc://test-cluster-client-{}'.format(uuid.uuid4().hex)
+            self.brokers[node_id] = zmq.Context.instance().socket(zmq.ROUTER)
+            self.brokers[node_id].bind(url)
+            urls_by_node[node_id] = {Cluster.CLIENT: url}
+        with mock.patch.object(Cluster, 'nodes', return_value=urls_by_node):
+            self.client = ClusterClient('localhost', 6379, 0, timeout=5)
+        self.endpoints = ['endpoint{}'.format(i) for i in range(6)]
+        self.received_by_node = dict((node_id, []) for node_id in self.brokers)
+
+    def tearDown(self):
+        self.client.close()
+        for broker in self.brokers.values():
+            broker.close(linger=0)
+
+    def _respond(self, count):
+        poller = zmq.Poller()
+        node_by_socket = dict((broker, node_id) for node_id, broker in self.brokers.items())
+        for broker in self.brokers.values():
+            poller.register(broker, zmq.POLLIN)
+        while count > 0:
+            for socket, _ in poller.poll(5000):
+                source, content = split_message(socket.recv_multipart())
+                endpoint = msgpack.unpackb(content[0])[b'endpoint']
+                self.received_by_node[node_by_socket[socket]].append(endpoint.decode())
+                socket.send_multipart(source + [b'', msgpack.packb({'status': 200, 'response': endpoint})])
+                count -= 1
+
+    def test_send_many(self):
+        responder = threading.Thread(target=self._respond, args=(len(self.endpoints),))
+        responder.start()
+        responses = self.client.send_many([('GET', endpoint) for endpoint in self.endpoints], window=4)
+        responder.join()
+        self.assertEqual([Response(endpoint, 200) for endpoint in self.endpoints], responses)
+        for node_id, endpoints in self.received_by_node.items():
+            self.assertTrue(all(self.client._ring.node_of(endpoint) == node_id for endpoint in endpoints))
+        self.assertTrue(self.client.healthy)
+
+    def test_pipeline(self):
+        responder = threading.Thread(target=self._respond, args=(2,))
+        responder.start()
+        with self.client.pipeline() as pipeline:
+            self.assertFalse(hasattr(pipeline, 'send_many'))
+            pipeline.get(self.endpoints[0])
+            pipeline.delete(self.endpoints[1])
+            responses = pipeline.execute()
+        responder.join()
+        self.assertEqual([Response(self.endpoints[0], 200), Response(self.endpoints[1], 200)], responses)
+
+
+class TestClientPool(unittest.TestCase):
+    def setUp(self):
+        # a new address for every test, the socket of the previous test may not be closed yet
+        self.url = 'inproc://test-client-{}'.format(uuid.uuid4().hex)
+        self.broker = zmq.Context.instance().socket(zmq.ROUTER)
+        self.broker.bind(self.url)
+        self.pool = ClientPool(self.url, size=2, timeout=0.2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.broker.close(linger=0)
+
+    def _respond(self):
+        source, content = split_message(self.broker.recv_multipart())
+        self.broker.send_multipart(source + [b'', msgpack.packb({'status': 200, 'response': 'OK'})])
+
+    def test_checkout(self):
+        self.assertEqual(0, self.pool.idle)
+        client = self.pool.checkout()
+        self.pool.checkin(client)
+        self.assertEqual(1, self.pool.idle)
+        self.assertIs(client, self.pool.checkout())
+
+    def test_size(self):
+        clients = [self.pool.checkout(), self.pool.checkout()]
+        with self.assertRaises(TimeoutError):
+            self.pool.checkout(timeout=0.05)
+        threading.Timer(0.05, self.pool.checkin, args=(clients[0],)).start()
+        self.assertIs(clients[0], self.pool.checkout(timeout=5))
+
+    def test_timeout(self):
+        with self.pool.client() as client:
+            with self.assertRaises(TimeoutError):
+                client.get('endpoint')
+            # the response of the timed out request is dropped with its socket
+            self.broker.recv_multipart()
+            self.assertTrue(client.healthy)
+            responder = threading.Thread(target=self._respond)
+            responder.start()
+            self.assertEqual(Response('OK', 200), client.get('endpoint'))
+            responder.join()
+
+    def test_unhealthy(self):
+        client = self.pool.checkout()
+        client._waiting = True
+        self.pool.checkin(client)
+        self.assertTrue(self.pool.checkout().healthy)
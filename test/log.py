@@ -0,0 +1,43 @@
+import logging
+import queue
+import sys
+import unittest
+
+from nimbus.log import LazyQueueHandler
+
+
+class TestLazyQueueHandler(unittest.TestCase):
+    def setUp(self):
+        self.handler = LazyQueueHandler(queue.SimpleQueue())
+
+    def record(self, msg, args, exc_info=None):
+        return logging.LogRecord('nimbus', logging.INFO, __file__, 1, msg, args, exc_info)
+
+    def test_deferred(self):
+        record = self.handler.prepare(self.record('Sending %s to %s', ('abc', (b'w1',))))
+        self.assertEqual('Sending %s to %s', record.msg)
+        self.assertEqual(('abc', (b'w1',)), record.args)
+        self.assertEqual("Sending abc to (b'w1',)", record.getMessage())
+
+    def test_eager(self):
+        to_process = [('w1', 'abc')]
+        record = self.handler.prepare(self.record('To process: %s', (to_process,)))
+        to_process.clear()
+        self.assertIsNone(record.args)
+        self.assertEqual("To process: [('w1', 'abc')]", record.getMessage())
+
+    def test_eager_mapping(self):
+        record = self.handler.prepare(self.record('%(endpoint)s', ({'endpoint': 'account'},)))
+        self.assertEqual('account', record.getMessage())
+
+    def test_exception(self):
+        try:
+            raise ValueError('failed')
+        except ValueError:
+            record = self.handler.prepare(self.record('Failed', (), exc_info=sys.exc_info()))
+        self.assertIsNone(record.exc_info)
+        self.assertIn('ValueError: failed', record.exc_text)
+
+    def test_emit(self):
+        self.handler.emit(self.record('Sending %s', ('abc',)))
+        self.assertEqual('Sending abc', self.handler.queue.get_nowait().getMessage())
@@ -1,11 +1,22 @@
+import asyncio
+import inspect
+import os
 import random
+import select
+import threading
+import time
 import unittest
+import uuid
+from unittest import mock
 
 import msgpack
+import zmq
+import zmq.asyncio
 
-from nimbus.worker.context import RequestContext
+from nimbus.worker.context import ctx_request, RequestContext, EXECUTION_INLINE, EXECUTION_THREAD, EXECUTION_PROCESS
 from nimbus.worker.errors import EndpointDoesNotExist
 from nimbus.worker.request import Request
+from nimbus.worker.worker import AsyncWorker, ClusterWorker, Worker, process_request, process_request_async
 
 ENDPOINT = 'endpoint'
 METHODS = ['GET', 'POST']
@@ -67,3 +78,227 @@ class TestContext(unittest.TestCase):
         for method in METHODS:
             self.assertEqual(func_to_decorate(self.request, a, b),
                              self.context.get_service_by_endpoint(ENDPOINT, method)(self.request, a, b))
+
+
+class TestContextCache(unittest.TestCase):
+    def test_cache_ttls(self):
+        context = RequestContext()
+        context.route(ENDPOINT, METHODS, cache_ttl=10)(lambda request: None)
+        context.route('other', ['GET'], label='other')(lambda request: None)
+        self.assertEqual([['GET', ENDPOINT, 10], ['POST', ENDPOINT, 10]],
+                         context.cache_ttls)
+
+    def test_coalesced(self):
+        context = RequestContext()
+        context.route(ENDPOINT, ['GET'], coalesce=True)(lambda request: None)
+        self.assertEqual([['GET', ENDPOINT]],
+                         context.coalesced)
+
+
+class TestContextExecution(unittest.TestCase):
+    def test_execution_for(self):
+        context = RequestContext()
+        context.route(ENDPOINT, ['GET'], execution=EXECUTION_THREAD)(lambda request: None)
+        context.route(ENDPOINT, ['POST'], label='post')(lambda request: None)
+        self.assertEqual(EXECUTION_THREAD, context.execution_for(ENDPOINT, 'GET'))
+        self.assertEqual(EXECUTION_INLINE, context.execution_for(ENDPOINT, 'POST'))
+        self.assertEqual(EXECUTION_INLINE, context.execution_for('unknown', 'GET'))
+
+    def test_executions(self):
+        context = RequestContext()
+        context.route(ENDPOINT, ['GET'], execution=EXECUTION_PROCESS)(lambda request: None)
+        self.assertEqual({EXECUTION_PROCESS}, context.executions)
+        context.route('other', ['GET'], label='other')(lambda request: None)
+        self.assertEqual({EXECUTION_INLINE, EXECUTION_PROCESS}, context.executions)
+
+    def test_unknown_execution(self):
+        context = RequestContext()
+        with self.assertRaises(ValueError):
+            context.route(ENDPOINT, ['GET'], execution='unknown')
+
+    def test_async_inline(self):
+        context = RequestContext()
+
+        async def service(request):
+            return 'OK'
+
+        decorated = context.route(ENDPOINT, ['GET'], execution=EXECUTION_THREAD)(service)
+        self.assertTrue(inspect.iscoroutinefunction(decorated))
+        self.assertEqual(EXECUTION_INLINE, context.execution_for(ENDPOINT, 'GET'))
+
+
+class TestProcessRequest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        @ctx_request.route('test_process_request_async', ['GET'])
+        async def async_service(request):
+            await asyncio.sleep(0)
+            return 'OK', 201
+
+        @ctx_request.route('test_process_request', ['GET'])
+        def service(request):
+            return 'OK'
+
+    @staticmethod
+    def _request(endpoint):
+        return Request(msgpack.unpackb(msgpack.packb(dict(REQUEST_CONTENT1, endpoint=endpoint))))
+
+    def test_process_request(self):
+        self.assertEqual(('OK', 200), process_request(self._request('test_process_request')))
+        self.assertEqual(('OK', 201), process_request(self._request('test_process_request_async')))
+
+    def test_process_request_async(self):
+        self.assertEqual(('OK', 200), asyncio.run(process_request_async(self._request('test_process_request'))))
+        self.assertEqual(('OK', 201),
+                         asyncio.run(process_request_async(self._request('test_process_request_async'))))
+
+    def test_unknown_endpoint(self):
+        self.assertEqual(500, asyncio.run(process_request_async(self._request('unknown')))[1])
+
+
+class TestRequest(unittest.TestCase):
+    def test_no_deadline(self):
+        request = Request(msgpack.unpackb(msgpack.packb(REQUEST_CONTENT1)))
+        self.assertIsNone(request.deadline)
+        self.assertFalse(request.expired)
+
+    def test_expired(self):
+        content = dict(REQUEST_CONTENT1, deadline=time.time() - 1)
+        self.assertTrue(Request(msgpack.unpackb(msgpack.packb(content))).expired)
+        content = dict(REQUEST_CONTENT1, deadline=time.time() + 10)
+        self.assertFalse(Request(msgpack.unpackb(msgpack.packb(content))).expired)
+
+
+class TestAsyncWorker(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.calls = 0
+        cls.running = 0
+        cls.peak = 0
+
+        @ctx_request.route('test_async_worker', ['GET'], label='test_async_worker')
+        async def service(request):
+            cls.calls += 1
+            cls.running += 1
+            cls.peak = max(cls.peak, cls.running)
+            await asyncio.sleep(0.05)
+            cls.running -= 1
+            return 'OK'
+
+    def setUp(self):
+        type(self).calls = type(self).peak = 0
+
+    @staticmethod
+    def _content(i, deadline=None):
+        content = dict(REQUEST_CONTENT1, id='request-{}'.format(i), endpoint='test_async_worker')
+        if deadline is not None:
+            content['deadline'] = deadline
+        return content
+
+    async def _exchange(self, contents, tasks):
+        """
+        :return: dict of request id -> (status, response) that the worker sent on its control socket
+        """
+        url = 'inproc://test-async-worker-{}'.format(uuid.uuid4().hex)
+        context = zmq.asyncio.Context.shadow(zmq.Context.instance())
+        broker = context.socket(zmq.ROUTER)
+        broker.bind(url)
+        worker = AsyncWorker(connect_control=url, credit=len(contents), tasks=tasks)
+        run = asyncio.create_task(worker._run())
+        try:
+            worker_id, _, registration = await asyncio.wait_for(broker.recv_multipart(), 5)
+            self.assertEqual(len(contents), msgpack.unpackb(registration)[b'credit'])
+            for content in contents:
+                await broker.send_multipart([worker_id, b'', msgpack.packb(content)])
+            responses = dict()
+            while len(responses) < len(contents):
+                frames = await asyncio.wait_for(broker.recv_multipart(), 5)
+                control = msgpack.unpackb(frames[2])
+                if b'done' in control:
+                    response = msgpack.unpackb(frames[3])
+                    responses[control[b'done'].decode()] = (response[b'status'], response[b'response'])
+            return responses
+        finally:
+            run.cancel()
+            try:
+                await run
+            except asyncio.CancelledError:
+                pass
+            worker.close()
+            broker.close()
+
+    def test_tasks(self):
+        responses = asyncio.run(self._exchange([self._content(i) for i in range(6)], tasks=2))
+        self.assertEqual(dict(('request-{}'.format(i), (200, b'OK')) for i in range(6)),
+                         responses)
+        self.assertEqual(6, self.calls)
+        self.assertEqual(2, self.peak)
+
+    def test_expired(self):
+        responses = asyncio.run(self._exchange([self._content(0, deadline=time.time() - 1),
+                                                self._content(1, deadline=time.time() + 10)], tasks=2))
+        self.assertEqual(504, responses['request-0'][0])
+        self.assertEqual((200, b'OK'), responses['request-1'])
+        self.assertEqual(1, self.calls)
+
+
+class TestWorkerPools(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        @ctx_request.route('test_worker_thread', ['GET'], label='test_worker_thread', execution=EXECUTION_THREAD)
+        def thread_service(request):
+            return threading.current_thread().name
+
+        @ctx_request.route('test_worker_process', ['GET'], label='test_worker_process', execution=EXECUTION_PROCESS)
+        def process_service(request):
+            return os.getpid()
+
+    def test_pools(self):
+        url = 'inproc://test-worker-pools-{}'.format(uuid.uuid4().hex)
+        broker = zmq.Context.instance().socket(zmq.ROUTER)
+        broker.bind(url)
+        worker = Worker(connect_control=url, connect_response=None, threads=2, processes=1, session=mock.Mock())
+        worker._start_pools()
+        worker._connect()
+        worker._open_wakeup()
+        try:
+            for execution, endpoint in [(EXECUTION_THREAD, 'test_worker_thread'),
+                                        (EXECUTION_PROCESS, 'test_worker_process')]:
+                content = dict(REQUEST_CONTENT1, id=endpoint, endpoint=endpoint)
+                worker._submit(Request(msgpack.unpackb(msgpack.packb(content))), execution)
+
+            responses = dict()
+            while len(responses) < 2:
+                # the pools write to the wakeup pipe when a request completed
+                self.assertTrue(select.select([worker._wakeup_read], [], [], 10)[0])
+                worker._send_completed(None)
+                while broker.poll(100):
+                    worker_id, _, control, response = broker.recv_multipart()
+                    response = msgpack.unpackb(response)
+                    self.assertEqual(200, response[b'status'])
+                    responses[msgpack.unpackb(control)[b'done'].decode()] = response[b'response']
+            self.assertTrue(responses['test_worker_thread'].startswith(b'worker'))
+            self.assertNotEqual(os.getpid(), responses['test_worker_process'])
+        finally:
+            worker.close()
+            broker.close()
+
+    def test_cluster_worker_process_pool(self):
+        class Stop(Exception):
+            pass
+
+        cluster_worker = ClusterWorker('localhost', 6379, 0, processes=1)
+        nodes = {'n1': {'worker_control': 'tcp://n1:1', 'worker_response': 'tcp://n1:2'},
+                 'n2': {'worker_control': 'tcp://n2:1', 'worker_response': 'tcp://n2:2'}}
+        process_pool = object()
+        with mock.patch.object(cluster_worker._cluster, 'nodes', return_value=nodes), \
+                mock.patch('nimbus.worker.worker._start_process_pool', return_value=process_pool) as start, \
+                mock.patch('nimbus.worker.worker.Worker') as worker_class, \
+                mock.patch('nimbus.worker.worker.time.sleep', side_effect=[None, Stop]):
+            with self.assertRaises(Stop):
+                cluster_worker.run()
+        # forked once, and shared by the Workers of all brokers, also when they connect again
+        start.assert_called_once_with(1)
+        self.assertGreaterEqual(worker_class.call_count, 2)
+        for call in worker_class.call_args_list:
+            self.assertIs(process_pool, call[1]['process_pool'])